@@ -0,0 +1,252 @@
+import errno
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import threading
+from typing import List, Optional
+
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE = 4096 * 1024 * 1024
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+LINK_MODES = ("reflink", "copy")
+
+# Everything the fixed up and universal libraries depend on.
+CACHE_MODULES = (
+    "artifact_cache.py",
+    "bundle_fix_up.py",
+    "construct_universal_dylib.py",
+    "dotnet_bundle.py",
+    "macho.py",
+)
+
+
+def hash_file(path: Path) -> str:
+    file_hash = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        buffer = memoryview(bytearray(1024 * 1024))
+
+        while True:
+            size = file.readinto(buffer)
+
+            if not size:
+                break
+
+            file_hash.update(buffer[:size])
+
+    return file_hash.hexdigest()
+
+
+def get_script_version(*paths: str) -> str:
+    # Any change to the modules producing an artifact invalidates it.
+    script_hash = hashlib.sha256(str(CACHE_VERSION).encode("utf-8"))
+    script_directory = Path(__file__).resolve().parent
+
+    for name in CACHE_MODULES:
+        with open(script_directory / name, "rb") as file:
+            script_hash.update(name.encode("utf-8") + b"\0" + file.read())
+
+    for path in paths:
+        with open(path, "rb") as file:
+            script_hash.update(file.read())
+
+    return script_hash.hexdigest()
+
+
+def reflink_file(source: Path, destination: Path) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                return False
+
+            raise
+
+    return True
+
+
+class ArtifactCache(object):
+    directory: Path
+    max_size: int
+    link_mode: str
+    version: str
+    hits: int
+    misses: int
+    restored_bytes: int
+
+    def __init__(
+        self,
+        directory: Path,
+        version: str,
+        max_size: int = DEFAULT_CACHE_SIZE,
+        link_mode: str = "reflink",
+    ) -> None:
+        if link_mode not in LINK_MODES:
+            raise Exception(f"Unknown cache link mode {link_mode}")
+
+        self.directory = directory
+        self.version = version
+        self.max_size = max_size
+        self.link_mode = link_mode
+        self.hits = 0
+        self.misses = 0
+        self.restored_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory / "objects", exist_ok=True)
+
+    def compute_key(self, kind: str, inputs: List[Path], parameters: List[str]) -> str:
+        key_hash = hashlib.sha256()
+        key_hash.update(kind.encode("utf-8") + b"\0")
+        key_hash.update(self.version.encode("utf-8") + b"\0")
+
+        for input_path in inputs:
+            key_hash.update(hash_file(input_path).encode("utf-8") + b"\0")
+
+        for parameter in parameters:
+            key_hash.update(parameter.encode("utf-8") + b"\0")
+
+        return key_hash.hexdigest()
+
+    def get_entry_path(self, key: str) -> Path:
+        return self.directory / "objects" / key[:2] / key
+
+    def materialize(self, entry_path: Path, output_path: Path):
+        # Go through a temporary file so that the output is replaced atomically.
+        # Restored files are later edited in place, so they never share the entry data.
+        (fd, temp_path) = tempfile.mkstemp(
+            dir=output_path.parent, prefix=f".{output_path.name}."
+        )
+        os.close(fd)
+        temp_path = Path(temp_path)
+
+        try:
+            if self.link_mode != "reflink" or not reflink_file(entry_path, temp_path):
+                shutil.copyfile(entry_path, temp_path)
+
+            if output_path.exists():
+                shutil.copymode(output_path, temp_path)
+            else:
+                os.chmod(temp_path, 0o644)
+
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if temp_path.exists():
+                os.remove(temp_path)
+
+            raise
+
+    def restore(self, key: str, output_path: Path) -> bool:
+        entry_path = self.get_entry_path(key)
+
+        try:
+            # Mark it as recently used for the LRU eviction.
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+
+            return False
+
+        self.materialize(entry_path, output_path)
+
+        with self._lock:
+            self.hits += 1
+            self.restored_bytes += os.stat(output_path).st_size
+
+        return True
+
+    def store(self, key: str, output_path: Path):
+        entry_path = self.get_entry_path(key)
+        os.makedirs(entry_path.parent, exist_ok=True)
+
+        (fd, temp_path) = tempfile.mkstemp(dir=entry_path.parent, prefix=".tmp.")
+        os.close(fd)
+
+        try:
+            shutil.copyfile(output_path, temp_path)
+            # Entries are never modified, anything trying to fails loudly.
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, entry_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            raise
+
+    def evict(self) -> int:
+        entries = []
+        total_size = 0
+
+        for root, _, file_names in os.walk(self.directory / "objects"):
+            for file_name in file_names:
+                path = Path(root) / file_name
+                stat = path.stat()
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        entries.sort()
+        evicted = 0
+
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+
+            os.remove(path)
+            total_size -= size
+            evicted += 1
+
+        return evicted
+
+    def get_report(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0
+
+        return (
+            f"Cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%}), "
+            f"{self.restored_bytes / (1024 * 1024):.1f} MiB restored"
+        )
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache-directory",
+        default=os.environ.get("RYUJINX_PACKAGING_CACHE"),
+        help="Directory of the artifact cache (defaults to RYUJINX_PACKAGING_CACHE)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+        help="Maximum size of the artifact cache in MiB",
+    )
+    parser.add_argument(
+        "--cache-link-mode",
+        choices=LINK_MODES,
+        default="reflink",
+        help="How cached artifacts are restored, reflink falls back to a copy",
+    )
+
+
+def create_cache_from_arguments(args, *script_paths: str) -> Optional[ArtifactCache]:
+    if args.cache_directory is None:
+        return None
+
+    return ArtifactCache(
+        Path(args.cache_directory),
+        get_script_version(*script_paths),
+        args.cache_size * 1024 * 1024,
+        args.cache_link_mode,
+    )
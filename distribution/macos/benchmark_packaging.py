@@ -0,0 +1,709 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+from add_tar_exec import create_tar  # noqa: E402
+from bundle_fix_up import LibraryIndex, fixup_dylibs  # noqa: E402
+from codesign import sign_file  # noqa: E402
+from construct_universal_dylib import construct_universal_tree  # noqa: E402
+from dotnet_bundle import (  # noqa: E402
+    BUNDLE_SIGNATURE,
+    FILE_TYPE_ASSEMBLY,
+    FILE_TYPE_DEPS_JSON,
+    FILE_TYPE_RUNTIME_CONFIG_JSON,
+    FILE_TYPE_UNKNOWN,
+    decompress_entry_data,
+    fixup_linkedit,
+    get_dotnet_bundle_data,
+    map_file,
+)
+from macho import (  # noqa: E402
+    CPU_TYPE_ARM64,
+    CPU_TYPE_X86_64,
+    LC_ID_DYLIB,
+    LC_LOAD_DYLIB,
+    LC_RPATH,
+    LC_SEGMENT_64,
+    LC_SYMTAB,
+    MH_MAGIC_64,
+    MachOFile,
+    align_up,
+    get_page_size,
+    write_fat_file,
+)
+from optimize_bundle import optimize_layout, rewrite_executable  # noqa: E402
+from verify_app_bundle import verify_app_bundle  # noqa: E402
+
+MH_EXECUTE = 0x2
+MH_DYLIB = 0x6
+
+CPU_SUBTYPE_X86_64_ALL = 0x3
+
+SCALES = {
+    "small": {
+        "libraries": 16,
+        "dependencies": 4,
+        "rpaths": 1,
+        "entries": 100,
+        "bundle_size": 16 * 1024 * 1024,
+    },
+    "medium": {
+        "libraries": 64,
+        "dependencies": 8,
+        "rpaths": 4,
+        "entries": 500,
+        "bundle_size": 64 * 1024 * 1024,
+    },
+    "large": {
+        "libraries": 256,
+        "dependencies": 16,
+        "rpaths": 8,
+        "entries": 2000,
+        "bundle_size": 256 * 1024 * 1024,
+    },
+}
+
+
+def build_string_command(cmd: int, header_format: str, fields: tuple, string: str):
+    raw_string = string.encode("utf-8") + b"\0"
+    header_size = 8 + struct.calcsize("<" + header_format)
+    cmdsize = align_up(header_size + len(raw_string), 8)
+
+    return (
+        struct.pack("<II" + header_format, cmd, cmdsize, *fields)
+        + raw_string
+        + b"\0" * (cmdsize - header_size - len(raw_string))
+    )
+
+
+def build_segment_command(
+    name: str,
+    vmaddr: int,
+    vmsize: int,
+    fileoff: int,
+    filesize: int,
+    prot: int,
+    sections: List[tuple],
+) -> bytes:
+    res = struct.pack(
+        "<II16sQQQQiiII",
+        LC_SEGMENT_64,
+        72 + 80 * len(sections),
+        name.encode("utf-8"),
+        vmaddr,
+        vmsize,
+        fileoff,
+        filesize,
+        prot,
+        prot,
+        len(sections),
+        0,
+    )
+
+    for section_name, address, size, offset in sections:
+        res += struct.pack(
+            "<16s16sQQIIIIIIII",
+            section_name.encode("utf-8"),
+            name.encode("utf-8"),
+            address,
+            size,
+            offset,
+            2,
+            0,
+            0,
+            0x80000400,
+            0,
+            0,
+            0,
+        )
+
+    return res
+
+
+def generate_thin_macho(
+    cputype: int,
+    filetype: int = MH_DYLIB,
+    dylib_id: Optional[str] = None,
+    dependencies: List[str] = [],
+    rpaths: List[str] = [],
+    text_content: bytes = b"",
+    linkedit_content: bytes = b"\0" * 16,
+    header_padding: int = 0x1000,
+) -> bytearray:
+    page_size = get_page_size(cputype)
+
+    commands = []
+
+    if dylib_id is not None:
+        commands.append(
+            build_string_command(
+                LC_ID_DYLIB, "IIII", (24, 1, 0x10000, 0x10000), dylib_id
+            )
+        )
+
+    for dependency in ["/usr/lib/libSystem.B.dylib"] + dependencies:
+        commands.append(
+            build_string_command(
+                LC_LOAD_DYLIB, "IIII", (24, 2, 0x10000, 0x10000), dependency
+            )
+        )
+
+    for rpath in rpaths:
+        commands.append(build_string_command(LC_RPATH, "I", (12,), rpath))
+
+    # Leave some room for the load commands to grow, like ld64 -headerpad does.
+    commands_size = sum(len(command) for command in commands) + 152 + 72 + 24
+    text_offset = align_up(0x20 + commands_size + header_padding, 16)
+    text_size = align_up(text_offset + max(len(text_content), 16), page_size)
+    linkedit_size = len(linkedit_content)
+
+    segments = [
+        build_segment_command(
+            "__TEXT",
+            0,
+            text_size,
+            0,
+            text_size,
+            5,
+            [("__text", text_offset, text_size - text_offset, text_offset)],
+        ),
+        build_segment_command(
+            "__LINKEDIT",
+            text_size,
+            align_up(linkedit_size, page_size),
+            text_size,
+            linkedit_size,
+            1,
+            [],
+        ),
+        struct.pack("<IIIIII", LC_SYMTAB, 24, 0, 0, text_size, linkedit_size),
+    ]
+    commands = segments + commands
+    raw_commands = b"".join(commands)
+
+    res = bytearray(
+        struct.pack(
+            "<IiiIIIII",
+            MH_MAGIC_64,
+            cputype,
+            CPU_SUBTYPE_X86_64_ALL if cputype == CPU_TYPE_X86_64 else 0,
+            filetype,
+            len(commands),
+            len(raw_commands),
+            0x200085,
+            0,
+        )
+    )
+    res += raw_commands
+    res += b"\0" * (text_offset - len(res))
+    res += text_content
+    res += b"\0" * (text_size - len(res))
+    res += linkedit_content
+
+    return res
+
+
+def generate_payload(rnd: random.Random, size: int) -> bytes:
+    # Half random, half repetitive so that compression has something to do.
+    random_size = size // 2
+    text = b"Ryujinx packaging benchmark payload\n"
+
+    return rnd.randbytes(random_size) + (text * (size // len(text) + 1))[
+        : size - random_size
+    ]
+
+
+def write_embedded_string(string: str) -> bytes:
+    raw_str = string.encode("utf-8")
+
+    if len(raw_str) > 0x7F:
+        return bytes([len(raw_str) & 0x7F | 0x80, len(raw_str) >> 7]) + raw_str
+
+    return bytes([len(raw_str)]) + raw_str
+
+
+def generate_bundle_executable(
+    path: Path,
+    cputype: int,
+    entry_count: int,
+    total_size: int,
+    seed: int = 0,
+):
+    rnd = random.Random(seed)
+    entry_size = max(total_size // max(entry_count, 1), 1)
+
+    # The marker is patched afterward, once the header offset is known.
+    marker = b"\0" * 8 + BUNDLE_SIGNATURE
+    executable = generate_thin_macho(
+        cputype, MH_EXECUTE, text_content=b"\0" * 0x100 + marker
+    )
+    marker_offset = executable.index(BUNDLE_SIGNATURE) - 8
+    bundle_offset = len(executable)
+
+    entries = []
+
+    with open(path, "wb") as file:
+        file.write(executable)
+        offset = bundle_offset
+
+        for index in range(entry_count):
+            if index == 0:
+                file_type = FILE_TYPE_DEPS_JSON
+                relative_path = "Ryujinx.deps.json"
+            elif index == 1:
+                file_type = FILE_TYPE_RUNTIME_CONFIG_JSON
+                relative_path = "Ryujinx.runtimeconfig.json"
+            elif index % 4 == 0:
+                file_type = FILE_TYPE_UNKNOWN
+                relative_path = f"Resources/resource{index}.json"
+            else:
+                file_type = FILE_TYPE_ASSEMBLY
+                relative_path = f"Ryujinx.Benchmark{index}.dll"
+
+            if file_type == FILE_TYPE_ASSEMBLY and offset % 4096 != 0:
+                padding_size = 4096 - offset % 4096
+                file.write(b"\0" * padding_size)
+                offset += padding_size
+
+            if file_type in (FILE_TYPE_DEPS_JSON, FILE_TYPE_RUNTIME_CONFIG_JSON):
+                payload = json.dumps({"targets": {}, "runtimeOptions": {}}).encode()
+            else:
+                payload = generate_payload(
+                    rnd, rnd.randint(entry_size // 2, entry_size * 3 // 2)
+                )
+
+            size = len(payload)
+            file.write(payload)
+            entries.append((offset, size, file_type, relative_path))
+            offset += size
+
+        header_offset = offset
+        header = struct.pack("<iiI", 6, 0, len(entries))
+        header += write_embedded_string("benchmark")
+        header += struct.pack("<qq", entries[0][0], entries[0][1])
+        header += struct.pack("<qq", entries[1][0], entries[1][1])
+        header += struct.pack("<q", 0)
+
+        for entry_offset, size, file_type, relative_path in entries:
+            header += struct.pack("<QQQb", entry_offset, size, 0, file_type)
+            header += write_embedded_string(relative_path)
+
+        file.write(header)
+        end_offset = file.tell()
+
+        # Like the .NET host writer, extend __LINKEDIT and the string table over
+        # the bundle.
+        file.seek(marker_offset)
+        file.write(struct.pack("<q", header_offset))
+        linkedit_command_offset = 0x20 + 152
+        symtab_command_offset = linkedit_command_offset + 72
+        linkedit_fileoff = bundle_offset - 16
+        file.seek(linkedit_command_offset + 32)
+        file.write(
+            struct.pack(
+                "<QQQ",
+                align_up(end_offset - linkedit_fileoff, get_page_size(cputype)),
+                linkedit_fileoff,
+                end_offset - linkedit_fileoff,
+            )
+        )
+        file.seek(symtab_command_offset + 20)
+        file.write(struct.pack("<I", end_offset - linkedit_fileoff))
+
+
+def get_bundle_entry_digests(path: Path) -> Dict[str, str]:
+    res = {}
+
+    with open(path, "rb") as file:
+        data = map_file(file)
+        (_, _, bundle) = get_dotnet_bundle_data(data)
+
+        for entry in bundle.files:
+            entry_data = data[entry.offset : entry.offset + entry.stored_size]
+
+            if entry.compressed_size != 0:
+                entry_data = decompress_entry_data(entry_data, entry.size)
+
+            res[entry.relative_path] = hashlib.sha256(entry_data).hexdigest()
+
+    return res
+
+
+def generate_library_tree(
+    directory: Path,
+    cputype: int,
+    library_count: int,
+    dependency_count: int,
+    rpath_count: int,
+):
+    os.makedirs(directory, exist_ok=True)
+    names = [f"libbenchmark{index}.dylib" for index in range(library_count)]
+
+    for index, name in enumerate(names):
+        dependencies = [
+            f"/opt/homebrew/lib/{names[(index + offset) % library_count]}"
+            for offset in range(1, min(dependency_count, library_count - 1) + 1)
+        ]
+        rpaths = [f"/opt/homebrew/lib/rpath{offset}" for offset in range(rpath_count)]
+
+        with open(directory / name, "wb") as file:
+            file.write(
+                generate_thin_macho(
+                    cputype,
+                    MH_DYLIB,
+                    f"/opt/homebrew/lib/{name}",
+                    dependencies,
+                    rpaths,
+                    text_content=bytes(index % 256 for _ in range(0x4000)),
+                )
+            )
+
+
+def generate_fat_macho(path: Path, thin_paths: List[Path]):
+    write_fat_file(path, thin_paths)
+
+
+def measure(
+    name: str,
+    scale: str,
+    setup: Callable[[], object],
+    run: Callable[[object], None],
+    repeat: int,
+    size: int = 0,
+) -> dict:
+    runs = []
+
+    for _ in range(repeat):
+        state = setup()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run(state)
+            runs.append(time.perf_counter() - start)
+
+    res = {
+        "name": name,
+        "scale": scale,
+        "best": min(runs),
+        "mean": sum(runs) / len(runs),
+        "runs": runs,
+    }
+
+    if size:
+        res["bytes"] = size
+        res["throughput_mib_s"] = size / (1024 * 1024) / min(runs)
+
+    return res
+
+
+def run_scale(
+    scale: str, config: Dict[str, int], work_directory: Path, repeat: int, jobs: int
+) -> List[dict]:
+    results = []
+
+    app_directory = work_directory / "Ryujinx.app"
+    contents_directory = app_directory / "Contents"
+    frameworks_directory = contents_directory / "Frameworks"
+    executable_path = contents_directory / "MacOS" / "Ryujinx"
+    arm64_directory = work_directory / "arm64"
+    x86_64_directory = work_directory / "x86_64"
+    universal_directory = work_directory / "universal"
+
+    os.makedirs(executable_path.parent, exist_ok=True)
+    generate_bundle_executable(
+        executable_path, CPU_TYPE_ARM64, config["entries"], config["bundle_size"]
+    )
+    executable_size = os.stat(executable_path).st_size
+
+    # .NET bundle parsing and writing
+    def setup_parse():
+        with open(executable_path, "rb") as file:
+            return map_file(file)
+
+    results.append(
+        measure(
+            "get_dotnet_bundle_data",
+            scale,
+            setup_parse,
+            get_dotnet_bundle_data,
+            repeat,
+        )
+    )
+
+    def setup_write():
+        source_file = open(executable_path, "rb")
+        (_, _, bundle) = get_dotnet_bundle_data(map_file(source_file))
+        output = open(work_directory / "bundle.out", "wb")
+
+        return (bundle, source_file, output)
+
+    def run_write(state):
+        (bundle, source_file, output) = state
+
+        with source_file, output:
+            bundle.write(output, source_file)
+
+    results.append(
+        measure(
+            "BundleManifest.write",
+            scale,
+            setup_write,
+            run_write,
+            repeat,
+            executable_size,
+        )
+    )
+
+    def setup_linkedit():
+        shutil.copyfile(executable_path, work_directory / "linkedit.out")
+        output = open(work_directory / "linkedit.out", "r+b")
+
+        return (output, map_file(output))
+
+    def run_linkedit(state):
+        (output, data) = state
+
+        with output:
+            fixup_linkedit(output, data, len(data))
+
+    results.append(
+        measure("fixup_linkedit", scale, setup_linkedit, run_linkedit, repeat)
+    )
+
+    # The new layout grows the bundle over the old code signature.
+    signed_path = work_directory / "signed.out"
+
+    def setup_signed():
+        shutil.copyfile(executable_path, signed_path)
+        sign_file(signed_path, "Ryujinx", jobs=jobs)
+
+    def run_signed(_):
+        rewrite_executable(
+            signed_path,
+            signed_path,
+            lambda bundle: optimize_layout(bundle, 0x4000, []),
+        )
+
+    results.append(
+        measure(
+            "rewrite_executable_signed",
+            scale,
+            setup_signed,
+            run_signed,
+            repeat,
+            executable_size,
+        )
+    )
+
+    if get_bundle_entry_digests(signed_path) != get_bundle_entry_digests(
+        executable_path
+    ):
+        raise Exception("Rewriting a signed executable corrupted the .NET bundle")
+
+    # Library fixup
+    def setup_fixup():
+        shutil.rmtree(frameworks_directory, ignore_errors=True)
+        generate_library_tree(
+            frameworks_directory,
+            CPU_TYPE_ARM64,
+            config["libraries"],
+            config["dependencies"],
+            config["rpaths"],
+        )
+
+    def run_fixup(_):
+        library_index = LibraryIndex.build(contents_directory)
+        fixup_dylibs(library_index, [frameworks_directory], jobs)
+
+    results.append(measure("fixup_dylib", scale, setup_fixup, run_fixup, repeat))
+
+    # Universal merging
+    for directory, cputype in (
+        (arm64_directory, CPU_TYPE_ARM64),
+        (x86_64_directory, CPU_TYPE_X86_64),
+    ):
+        shutil.rmtree(directory, ignore_errors=True)
+        generate_library_tree(
+            directory,
+            cputype,
+            config["libraries"],
+            config["dependencies"],
+            config["rpaths"],
+        )
+
+    def setup_universal():
+        shutil.rmtree(universal_directory, ignore_errors=True)
+
+    def run_universal(_):
+        construct_universal_tree(
+            arm64_directory, x86_64_directory, universal_directory, "*.dylib", jobs
+        )
+
+    results.append(
+        measure("construct_universal", scale, setup_universal, run_universal, repeat)
+    )
+
+    # Fat inputs
+    fat_contents_directory = work_directory / "fat" / "Contents"
+    fat_frameworks_directory = fat_contents_directory / "Frameworks"
+    fat_universal_directory = work_directory / "fat_universal"
+
+    shutil.rmtree(fat_contents_directory, ignore_errors=True)
+    os.makedirs(fat_frameworks_directory)
+
+    for path in sorted(arm64_directory.glob("*.dylib")):
+        generate_fat_macho(
+            fat_frameworks_directory / path.name, [path, x86_64_directory / path.name]
+        )
+
+    fat_paths = sorted(fat_frameworks_directory.glob("*.dylib"))
+
+    def run_open_fat(_):
+        for path in fat_paths:
+            MachOFile.open(path).get_dylib_dependencies()
+
+    results.append(
+        measure("MachOFile.open_fat", scale, lambda: None, run_open_fat, repeat)
+    )
+
+    def setup_fixup_fat():
+        for path in fat_paths:
+            generate_fat_macho(
+                path, [arm64_directory / path.name, x86_64_directory / path.name]
+            )
+
+    def run_fixup_fat(_):
+        library_index = LibraryIndex.build(fat_contents_directory)
+        fixup_dylibs(library_index, [fat_frameworks_directory], jobs)
+
+    results.append(
+        measure("fixup_dylib_fat", scale, setup_fixup_fat, run_fixup_fat, repeat)
+    )
+
+    def setup_universal_fat():
+        shutil.rmtree(fat_universal_directory, ignore_errors=True)
+
+    def run_universal_fat(_):
+        construct_universal_tree(
+            fat_frameworks_directory,
+            x86_64_directory,
+            fat_universal_directory,
+            "*.dylib",
+            jobs,
+        )
+
+    results.append(
+        measure(
+            "construct_universal_fat",
+            scale,
+            setup_universal_fat,
+            run_universal_fat,
+            repeat,
+        )
+    )
+
+    # Archive creation
+    tar_path = work_directory / "Ryujinx.app.tar.gz"
+    executable_tar_path = "Ryujinx.app/Contents/MacOS/Ryujinx"
+
+    def run_tar(_):
+        create_tar(str(tar_path), "Ryujinx.app", [executable_tar_path], jobs)
+
+    current_directory = os.getcwd()
+    os.chdir(work_directory)
+
+    try:
+        results.append(
+            measure(
+                "create_tar",
+                scale,
+                lambda: None,
+                run_tar,
+                repeat,
+                sum(
+                    path.stat().st_size
+                    for path in app_directory.rglob("*")
+                    if path.is_file()
+                ),
+            )
+        )
+    finally:
+        os.chdir(current_directory)
+
+    # Structural verification of the packaged bundle
+    results.append(
+        measure(
+            "verify_app_bundle",
+            scale,
+            lambda: None,
+            lambda _: verify_app_bundle(app_directory, "MacOS/Ryujinx", jobs),
+            repeat,
+        )
+    )
+
+    for result in results:
+        result["config"] = config
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the packaging scripts")
+    parser.add_argument(
+        "--scale",
+        action="append",
+        choices=list(SCALES.keys()),
+        help="Scale to run, can be repeated (defaults to small and medium)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1, help="Number of parallel jobs"
+    )
+    parser.add_argument("--work-directory", help="Directory for the generated files")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+
+    args = parser.parse_args()
+
+    scales = args.scale or ["small", "medium"]
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=args.work_directory) as work_directory:
+        for scale in scales:
+            scale_directory = Path(work_directory) / scale
+            os.makedirs(scale_directory)
+
+            results.extend(
+                run_scale(
+                    scale, SCALES[scale], scale_directory, args.repeat, args.jobs
+                )
+            )
+            shutil.rmtree(scale_directory)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "jobs": args.jobs,
+        "results": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
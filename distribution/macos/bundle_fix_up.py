@@ -1,539 +1,213 @@
 import argparse
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
-import platform
-import shutil
 import struct
-import subprocess
-from typing import List, Optional, Tuple
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from artifact_cache import (
+    ArtifactCache,
+    add_cache_arguments,
+    create_cache_from_arguments,
+)
+from dotnet_bundle import (
+    BundleManifest,
+    BundleSource,
+    find_bundle_signature,
+    fixup_linkedit,
+    get_dotnet_bundle_data,
+    map_file,
+)
+from macho import FAT_MAGIC, FAT_MAGIC_64, MH_MAGIC, MH_MAGIC_64, MachOFile, read_magic
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
 
 parser = argparse.ArgumentParser(description="Fixup for MacOS application bundle")
 parser.add_argument("input_directory", help="Input directory (Application path)")
 parser.add_argument("executable_sub_path", help="Main executable sub path")
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of libraries to fixup in parallel",
+)
+add_cache_arguments(parser)
 
-# Use Apple LLVM on Darwin, otherwise standard LLVM.
-if platform.system() == "Darwin":
-    OTOOL = "otool"
-    INSTALL_NAME_TOOL = "install_name_tool"
-else:
-    OTOOL = shutil.which("llvm-otool")
-    if OTOOL is None:
-        for llvm_ver in [15, 14, 13]:
-            otool_path = shutil.which(f"llvm-otool-{llvm_ver}")
-            if otool_path is not None:
-                OTOOL = otool_path
-                INSTALL_NAME_TOOL = shutil.which(f"llvm-install-name-tool-{llvm_ver}")
-                break
-    else:
-        INSTALL_NAME_TOOL = shutil.which("llvm-install-name-tool")
 
+def add_dylib_rpath(dylib_path: Path, rpath: str):
+    macho_file = MachOFile.open(dylib_path)
+    macho_file.add_rpath(rpath)
+    macho_file.write()
 
-args = parser.parse_args()
 
+LIBRARY_SUFFIXES = (".dylib", ".so")
+MACHO_MAGICS = (MH_MAGIC, MH_MAGIC_64, FAT_MAGIC, FAT_MAGIC_64)
+SYSTEM_LIBRARY_PREFIXES = ("/usr/lib", "/System/Library")
 
-def get_dylib_id(dylib_path: Path) -> str:
-    res = subprocess.check_output([OTOOL, "-D", str(dylib_path.absolute())]).decode(
-        "utf-8"
-    )
 
-    return res.split("\n")[1]
+class LibraryIndex(object):
+    content_directory: Path
+    libraries: List[Path]
+    directories: Dict[Path, Tuple[str, Dict[str, Path]]]
 
+    def __init__(self, content_directory: Path) -> None:
+        self.content_directory = content_directory
+        self.libraries = []
+        self.directories = {}
 
-def get_dylib_dependencies(dylib_path: Path) -> List[str]:
-    output = (
-        subprocess.check_output([OTOOL, "-L", str(dylib_path.absolute())])
-        .decode("utf-8")
-        .split("\n")[1:]
-    )
+    @staticmethod
+    def build(content_directory: Path) -> "LibraryIndex":
+        res = LibraryIndex(content_directory)
 
-    res = []
+        # Walk the bundle once, the rest of the resolution is dict lookups.
+        for root, _, file_names in os.walk(content_directory):
+            directory = Path(root)
+            directory_files = {}
 
-    for line in output:
-        line = line.strip()
-        index = line.find(" (compatibility version ")
-        if index == -1:
-            continue
+            for file_name in sorted(file_names):
+                path = directory / file_name
 
-        line = line[:index]
+                try:
+                    with open(path, "rb") as file:
+                        magic = read_magic(file.read(4))
+                except OSError:
+                    continue
 
-        res.append(line)
+                if magic not in MACHO_MAGICS:
+                    continue
 
-    return res
+                directory_files[file_name] = path
 
+                # Symlinks are resolvable but only their target gets fixed up.
+                if file_name.endswith(LIBRARY_SUFFIXES) and not path.is_symlink():
+                    res.libraries.append(path)
 
-def replace_dylib_id(dylib_path: Path, new_id: str):
-    subprocess.check_call(
-        [INSTALL_NAME_TOOL, "-id", new_id, str(dylib_path.absolute())]
-    )
+            if directory_files:
+                res.directories[directory] = (
+                    get_path_related_to_target_exec(
+                        content_directory, next(iter(directory_files.values()))
+                    ),
+                    directory_files,
+                )
 
+        return res
 
-def change_dylib_link(dylib_path: Path, old: str, new: str):
-    subprocess.check_call(
-        [INSTALL_NAME_TOOL, "-change", old, new, str(dylib_path.absolute())]
-    )
+    def get_replacement_path(self, path: Path) -> str:
+        return self.directories[path.parent][0]
 
+    def find(self, name: str, search_path: List[Path]) -> Optional[Path]:
+        for library_base_path in search_path:
+            directory = self.directories.get(library_base_path)
 
-def add_dylib_rpath(dylib_path: Path, rpath: str):
-    subprocess.check_call(
-        [INSTALL_NAME_TOOL, "-add_rpath", rpath, str(dylib_path.absolute())]
-    )
+            if directory is not None and name in directory[1]:
+                return directory[1][name]
+
+        return None
+
+    def resolve(self, name: str, search_path: List[Path]) -> Optional[str]:
+        path = self.find(name, search_path)
+
+        if path is None:
+            return None
+
+        return self.get_replacement_path(path) + "/" + name
 
 
 def fixup_dylib(
     dylib_path: Path,
     replacement_path: str,
-    search_path: List[str],
-    content_directory: Path,
+    search_path: List[Path],
+    library_index: LibraryIndex,
+    cache: Optional[ArtifactCache] = None,
 ):
-    dylib_id = get_dylib_id(dylib_path)
-    new_dylib_id = replacement_path + "/" + os.path.basename(dylib_id)
-    replace_dylib_id(dylib_path, new_dylib_id)
+    with build_trace.span(str(dylib_path), "fixup_dylib") as trace_args:
+        trace_args["cached"] = fixup_dylib_file(
+            dylib_path, replacement_path, search_path, library_index, cache
+        )
+
+
+def fixup_dylib_file(
+    dylib_path: Path,
+    replacement_path: str,
+    search_path: List[Path],
+    library_index: LibraryIndex,
+    cache: Optional[ArtifactCache],
+) -> bool:
+    macho_file = MachOFile.open(dylib_path)
+
+    dylib_id = macho_file.get_dylib_id()
+    new_dylib_id = None
+    if dylib_id is not None:
+        new_dylib_id = replacement_path + "/" + os.path.basename(dylib_id)
+        macho_file.set_dylib_id(new_dylib_id)
+    else:
+        dylib_id = str(dylib_path)
 
-    dylib_dependencies = get_dylib_dependencies(dylib_path)
+    dylib_dependencies = macho_file.get_dylib_dependencies()
     dylib_new_mapping = {}
 
     for dylib_dependency in dylib_dependencies:
         if (
             not dylib_dependency.startswith("@executable_path")
-            and not dylib_dependency.startswith("/usr/lib")
-            and not dylib_dependency.startswith("/System/Library")
+            and not dylib_dependency.startswith(SYSTEM_LIBRARY_PREFIXES)
         ):
             dylib_dependency_name = os.path.basename(dylib_dependency)
-            library_found = False
-            for library_base_path in search_path:
-                lib_path = Path(os.path.join(library_base_path, dylib_dependency_name))
-
-                if lib_path.exists():
-                    target_replacement_path = get_path_related_to_target_exec(
-                        content_directory, lib_path
-                    )
-
-                    dylib_new_mapping[dylib_dependency] = (
-                        target_replacement_path
-                        + "/"
-                        + os.path.basename(dylib_dependency)
-                    )
-                    library_found = True
-
-            if not library_found:
+            new_dependency = library_index.resolve(dylib_dependency_name, search_path)
+
+            if new_dependency is None:
                 raise Exception(
                     f"{dylib_id}: Cannot find dependency {dylib_dependency_name} for fixup"
                 )
 
-    for key in dylib_new_mapping:
-        change_dylib_link(dylib_path, key, dylib_new_mapping[key])
-
-
-FILE_TYPE_ASSEMBLY = 1
-
-ALIGN_REQUIREMENTS = 4096
-
-
-def parse_embedded_string(data: bytes) -> Tuple[bytes, str]:
-    first_byte = data[0]
-
-    if (first_byte & 0x80) == 0:
-        size = first_byte
-        data = data[1:]
-    else:
-        second_byte = data[1]
-
-        assert (second_byte & 0x80) == 0
-
-        size = (second_byte << 7) | (first_byte & 0x7F)
-
-        data = data[2:]
-
-    res = data[:size].decode("utf-8")
-    data = data[size:]
-
-    return (data, res)
-
-
-def write_embedded_string(file, string: str):
-    raw_str = string.encode("utf-8")
-    raw_str_len = len(raw_str)
-
-    assert raw_str_len < 0x7FFF
-
-    if raw_str_len > 0x7F:
-        file.write(struct.pack("b", raw_str_len & 0x7F | 0x80))
-        file.write(struct.pack("b", raw_str_len >> 7))
-    else:
-        file.write(struct.pack("b", raw_str_len))
-
-    file.write(raw_str)
-
-
-class BundleFileEntry(object):
-    offset: int
-    size: int
-    compressed_size: int
-    file_type: int
-    relative_path: str
-    data: bytes
-
-    def __init__(
-        self,
-        offset: int,
-        size: int,
-        compressed_size: int,
-        file_type: int,
-        relative_path: str,
-        data: bytes,
-    ) -> None:
-        self.offset = offset
-        self.size = size
-        self.compressed_size = compressed_size
-        self.file_type = file_type
-        self.relative_path = relative_path
-        self.data = data
-
-    def write(self, file):
-        self.offset = file.tell()
-
-        if (
-            self.file_type == FILE_TYPE_ASSEMBLY
-            and (self.offset % ALIGN_REQUIREMENTS) != 0
-        ):
-            padding_size = ALIGN_REQUIREMENTS - (self.offset % ALIGN_REQUIREMENTS)
-            file.write(b"\0" * padding_size)
-            self.offset += padding_size
+            dylib_new_mapping[dylib_dependency] = new_dependency
 
-        file.write(self.data)
-
-    def write_header(self, file):
-        file.write(
-            struct.pack(
-                "QQQb", self.offset, self.size, self.compressed_size, self.file_type
-            )
+    # The result only depends on the input content and the edits to apply.
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.compute_key(
+            "fixup",
+            [dylib_path],
+            [str(new_dylib_id)]
+            + [f"{key}={value}" for key, value in dylib_new_mapping.items()],
         )
-        write_embedded_string(file, self.relative_path)
-
-
-class BundleManifest(object):
-    major: int
-    minor: int
-    bundle_id: str
-    deps_json: BundleFileEntry
-    runtimeconfig_json: BundleFileEntry
-    flags: int
-    files: List[BundleFileEntry]
-
-    def __init__(
-        self,
-        major: int,
-        minor: int,
-        bundle_id: str,
-        deps_json: BundleFileEntry,
-        runtimeconfig_json: BundleFileEntry,
-        flags: int,
-        files: List[BundleFileEntry],
-    ) -> None:
-        self.major = major
-        self.minor = minor
-        self.bundle_id = bundle_id
-        self.deps_json = deps_json
-        self.runtimeconfig_json = runtimeconfig_json
-        self.flags = flags
-        self.files = files
-
-    def write(self, file) -> int:
-        for bundle_file in self.files:
-            bundle_file.write(file)
-
-        bundle_header_offset = file.tell()
-        file.write(struct.pack("iiI", self.major, self.minor, len(self.files)))
-        write_embedded_string(file, self.bundle_id)
-
-        if self.deps_json is not None:
-            deps_json_location_offset = self.deps_json.offset
-            deps_json_location_size = self.deps_json.size
-        else:
-            deps_json_location_offset = 0
-            deps_json_location_size = 0
-
-        if self.runtimeconfig_json is not None:
-            runtimeconfig_json_location_offset = self.runtimeconfig_json.offset
-            runtimeconfig_json_location_size = self.runtimeconfig_json.size
-        else:
-            runtimeconfig_json_location_offset = 0
-            runtimeconfig_json_location_size = 0
-
-        file.write(
-            struct.pack("qq", deps_json_location_offset, deps_json_location_size)
-        )
-        file.write(
-            struct.pack(
-                "qq",
-                runtimeconfig_json_location_offset,
-                runtimeconfig_json_location_size,
-            )
-        )
-        file.write(struct.pack("q", self.flags))
-
-        for bundle_file in self.files:
-            bundle_file.write_header(file)
-
-        return bundle_header_offset
-
-
-def read_file_entry(
-    raw_data: bytes, header_bytes: bytes
-) -> Tuple[bytes, BundleFileEntry]:
-    (
-        offset,
-        size,
-        compressed_size,
-        file_type,
-    ) = struct.unpack("QQQb", header_bytes[:0x19])
-    (header_bytes, relative_path) = parse_embedded_string(header_bytes[0x19:])
-
-    target_size = compressed_size
-
-    if target_size == 0:
-        target_size = size
-
-    return (
-        header_bytes,
-        BundleFileEntry(
-            offset,
-            size,
-            compressed_size,
-            file_type,
-            relative_path,
-            raw_data[offset : offset + target_size],
-        ),
-    )
-
 
-def get_dotnet_bundle_data(data: bytes) -> Optional[Tuple[int, int, BundleManifest]]:
-    offset = data.find(hashlib.sha256(b".net core bundle\n").digest())
-
-    if offset == -1:
-        return None
-
-    raw_header_offset = data[offset - 8 : offset]
-    (header_offset,) = struct.unpack("q", raw_header_offset)
-    header_bytes = data[header_offset:]
-
-    (
-        major,
-        minor,
-        files_count,
-    ) = struct.unpack("iiI", header_bytes[:0xC])
-    header_bytes = header_bytes[0xC:]
-
-    (header_bytes, bundle_id) = parse_embedded_string(header_bytes)
-
-    # v2 header
-    (
-        deps_json_location_offset,
-        deps_json_location_size,
-    ) = struct.unpack("qq", header_bytes[:0x10])
-    (
-        runtimeconfig_json_location_offset,
-        runtimeconfig_json_location_size,
-    ) = struct.unpack("qq", header_bytes[0x10:0x20])
-    (flags,) = struct.unpack("q", header_bytes[0x20:0x28])
-    header_bytes = header_bytes[0x28:]
-
-    files = []
-
-    deps_json = None
-    runtimeconfig_json = None
-
-    for _ in range(files_count):
-        (header_bytes, file_entry) = read_file_entry(data, header_bytes)
-
-        files.append(file_entry)
-
-        if file_entry.offset == deps_json_location_offset:
-            deps_json = file_entry
-        elif file_entry.offset == runtimeconfig_json_location_offset:
-            runtimeconfig_json = file_entry
-
-    file_entry = files[0]
-
-    return (
-        file_entry.offset,
-        header_offset,
-        BundleManifest(
-            major, minor, bundle_id, deps_json, runtimeconfig_json, flags, files
-        ),
-    )
+        if cache.restore(cache_key, dylib_path):
+            return True
 
+    # Apply every edit to the load commands at once, with a single write.
+    for key in dylib_new_mapping:
+        macho_file.change_dylib_link(key, dylib_new_mapping[key])
 
-LC_SYMTAB = 0x2
-LC_SEGMENT_64 = 0x19
-LC_CODE_SIGNATURE = 0x1D
-
-
-def fixup_linkedit(file, data: bytes, new_size: int):
-    offset = 0
-
-    (
-        macho_magic,
-        macho_cputype,
-        macho_cpusubtype,
-        macho_filetype,
-        macho_ncmds,
-        macho_sizeofcmds,
-        macho_flags,
-        macho_reserved,
-    ) = struct.unpack("IiiIIIII", data[offset : offset + 0x20])
-
-    offset += 0x20
-
-    linkedit_offset = None
-    symtab_offset = None
-    codesign_offset = None
-
-    for _ in range(macho_ncmds):
-        (cmd, cmdsize) = struct.unpack("II", data[offset : offset + 8])
-
-        if cmd == LC_SEGMENT_64:
-            (
-                cmd,
-                cmdsize,
-                segname_raw,
-                vmaddr,
-                vmsize,
-                fileoff,
-                filesize,
-                maxprot,
-                initprot,
-                nsects,
-                flags,
-            ) = struct.unpack("II16sQQQQiiII", data[offset : offset + 72])
-            segname = segname_raw.decode("utf-8").split("\0")[0]
-
-            if segname == "__LINKEDIT":
-                linkedit_offset = offset
-        elif cmd == LC_SYMTAB:
-            symtab_offset = offset
-        elif cmd == LC_CODE_SIGNATURE:
-            codesign_offset = offset
-
-        offset += cmdsize
-        pass
-
-    assert linkedit_offset is not None and symtab_offset is not None
-
-    # If there is a codesign section, clean it up.
-    if codesign_offset is not None:
-        (
-            codesign_cmd,
-            codesign_cmdsize,
-            codesign_dataoff,
-            codesign_datasize,
-        ) = struct.unpack("IIII", data[codesign_offset : codesign_offset + 16])
-        file.seek(codesign_offset)
-        file.write(b"\0" * codesign_cmdsize)
-
-        macho_ncmds -= 1
-        macho_sizeofcmds -= codesign_cmdsize
-        file.seek(0)
-        file.write(
-            struct.pack(
-                "IiiIIIII",
-                macho_magic,
-                macho_cputype,
-                macho_cpusubtype,
-                macho_filetype,
-                macho_ncmds,
-                macho_sizeofcmds,
-                macho_flags,
-                macho_reserved,
-            )
-        )
+    macho_file.write()
 
-        file.seek(codesign_dataoff)
-        file.write(b"\0" * codesign_datasize)
-
-    (
-        symtab_cmd,
-        symtab_cmdsize,
-        symtab_symoff,
-        symtab_nsyms,
-        symtab_stroff,
-        symtab_strsize,
-    ) = struct.unpack("IIIIII", data[symtab_offset : symtab_offset + 24])
-
-    symtab_strsize = new_size - symtab_stroff
-
-    new_symtab = struct.pack(
-        "IIIIII",
-        symtab_cmd,
-        symtab_cmdsize,
-        symtab_symoff,
-        symtab_nsyms,
-        symtab_stroff,
-        symtab_strsize,
-    )
+    if cache_key is not None:
+        cache.store(cache_key, dylib_path)
 
-    file.seek(symtab_offset)
-    file.write(new_symtab)
-
-    (
-        linkedit_cmd,
-        linkedit_cmdsize,
-        linkedit_segname_raw,
-        linkedit_vmaddr,
-        linkedit_vmsize,
-        linkedit_fileoff,
-        linkedit_filesize,
-        linkedit_maxprot,
-        linkedit_initprot,
-        linkedit_nsects,
-        linkedit_flags,
-    ) = struct.unpack("II16sQQQQiiII", data[linkedit_offset : linkedit_offset + 72])
-
-    linkedit_filesize = new_size - linkedit_fileoff
-    linkedit_vmsize = linkedit_filesize
-
-    new_linkedit = struct.pack(
-        "II16sQQQQiiII",
-        linkedit_cmd,
-        linkedit_cmdsize,
-        linkedit_segname_raw,
-        linkedit_vmaddr,
-        linkedit_vmsize,
-        linkedit_fileoff,
-        linkedit_filesize,
-        linkedit_maxprot,
-        linkedit_initprot,
-        linkedit_nsects,
-        linkedit_flags,
-    )
-    file.seek(linkedit_offset)
-    file.write(new_linkedit)
+    return False
 
 
 def write_bundle_data(
     output,
-    old_bundle_base_offset: int,
+    data: BundleSource,
     new_bundle_base_offset: int,
     bundle: BundleManifest,
+    source_file=None,
 ) -> int:
     # Write bundle data
-    bundle_header_offset = bundle.write(output)
+    bundle_header_offset = bundle.write(output, source_file)
     total_size = output.tell()
 
     # Patch the header position
-    offset = file_data.find(hashlib.sha256(b".net core bundle\n").digest())
+    offset = find_bundle_signature(data)
     output.seek(offset - 8)
     output.write(struct.pack("q", bundle_header_offset))
 
     return total_size - new_bundle_base_offset
 
 
-input_directory: Path = Path(args.input_directory)
-content_directory: Path = Path(os.path.join(args.input_directory, "Contents"))
-executable_path: Path = Path(os.path.join(content_directory, args.executable_sub_path))
-
-
 def get_path_related_to_other_path(a: Path, b: Path) -> str:
     temp = b
 
@@ -555,55 +229,131 @@ def get_path_related_to_target_exec(input_directory: Path, path: Path):
     )
 
 
-search_path = [
-    Path(os.path.join(content_directory, "Frameworks")),
-    Path(os.path.join(content_directory, "Resources/lib")),
-]
+def fixup_dylibs(
+    library_index: LibraryIndex,
+    search_path: List[Path],
+    jobs: int,
+    cache: Optional[ArtifactCache] = None,
+    paths: Optional[List[Path]] = None,
+):
+    def fixup(path: Path):
+        current_search_path = [path.parent]
+        current_search_path.extend(search_path)
+
+        fixup_dylib(
+            path,
+            library_index.get_replacement_path(path),
+            current_search_path,
+            library_index,
+            cache,
+        )
 
+    # Every library only touches its own file, errors are reported together at the end.
+    errors = []
 
-for path in content_directory.rglob("**/*.dylib"):
-    current_search_path = [path.parent]
-    current_search_path.extend(search_path)
+    if paths is None:
+        paths = library_index.libraries
 
-    fixup_dylib(
-        path,
-        get_path_related_to_target_exec(content_directory, path),
-        current_search_path,
-        content_directory,
-    )
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [(path, executor.submit(fixup, path)) for path in paths]
 
-for path in content_directory.rglob("**/*.so"):
-    current_search_path = [path.parent]
-    current_search_path.extend(search_path)
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f"{path}: {e}")
 
-    fixup_dylib(
-        path,
-        get_path_related_to_target_exec(content_directory, path),
-        current_search_path,
-        content_directory,
-    )
+    if errors:
+        for error in errors:
+            print(error)
+
+        raise Exception(f"Fixup failed for {len(errors)} of {len(paths)} libraries")
+
+
+def fixup_executable(executable_path: Path):
+    # The executable is mapped rather than read, bundle entries are only paged in when needed.
+    # It stays open so that bundle entries can be streamed from it if they need to be readded.
+    with open(executable_path, "rb") as executable_file:
+        executable_inode = os.fstat(executable_file.fileno()).st_ino
+        file_data = map_file(executable_file)
+
+        with build_trace.span("parse bundle") as trace_args:
+            (bundle_base_offset, bundle_header_offset, bundle) = get_dotnet_bundle_data(
+                file_data
+            )
+            trace_args["entries"] = len(bundle.files)
+
+        with build_trace.span("add executable rpath"):
+            add_dylib_rpath(executable_path, "@executable_path/../Frameworks/")
+
+        # Recent "vanilla" version of LLVM (LLVM 13 and upper) seems to really dislike how .NET package its assemblies.
+        # As a result, after execution of install_name_tool it will have "fixed" the symtab resulting in a missing .NET bundle...
+        # The load commands are now edited in place so this should not happen anymore, but we still check if the bundle offset
+        # inside the binary is valid and readd .NET bundle if not.
+        output_stat = os.stat(executable_path)
+        output_file_size = output_stat.st_size
+        if output_file_size < bundle_header_offset:
+            print("LLVM broke the .NET bundle, readding bundle data...")
+
+            # Bundle entries are read back from the original file.
+            # This only works if it was replaced rather than truncated.
+            if output_stat.st_ino == executable_inode:
+                raise Exception(
+                    "The executable was truncated in place, cannot readd bundle data"
+                )
+
+            with open(executable_path, "r+b") as output, build_trace.span(
+                "readd bundle"
+            ):
+                output_data = map_file(output)
+                output.seek(output_file_size)
+                bundle_data_size = write_bundle_data(
+                    output,
+                    output_data,
+                    output_file_size,
+                    bundle,
+                    executable_file,
+                )
+
+                # Now patch the __LINKEDIT section
+                new_size = output_file_size + bundle_data_size
+                fixup_linkedit(output, output_data, new_size)
+
+
+def fixup_app_bundle(
+    input_directory: Path,
+    executable_sub_path: str,
+    jobs: int,
+    cache: Optional[ArtifactCache] = None,
+):
+    content_directory = input_directory / "Contents"
+    search_path = [
+        content_directory / "Frameworks",
+        content_directory / "Resources/lib",
+    ]
+
+    with build_trace.span("build library index", bundle=str(input_directory)):
+        library_index = LibraryIndex.build(content_directory)
 
+    with build_trace.span("fixup dylibs", libraries=len(library_index.libraries)):
+        fixup_dylibs(library_index, search_path, jobs, cache)
 
-with open(executable_path, "rb") as input:
-    file_data = input.read()
+    fixup_executable(content_directory / executable_sub_path)
 
 
-(bundle_base_offset, bundle_header_offset, bundle) = get_dotnet_bundle_data(file_data)
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("bundle_fix_up")
 
-add_dylib_rpath(executable_path, "@executable_path/../Frameworks/")
+    cache = create_cache_from_arguments(args)
 
-# Recent "vanilla" version of LLVM (LLVM 13 and upper) seems to really dislike how .NET package its assemblies.
-# As a result, after execution of install_name_tool it will have "fixed" the symtab resulting in a missing .NET bundle...
-# To mitigate that, we check if the bundle offset inside the binary is valid after install_name_tool and readd .NET bundle if not.
-output_file_size = os.stat(executable_path).st_size
-if output_file_size < bundle_header_offset:
-    print("LLVM broke the .NET bundle, readding bundle data...")
-    with open(executable_path, "r+b") as output:
-        file_data = output.read()
-        bundle_data_size = write_bundle_data(
-            output, bundle_base_offset, output_file_size, bundle
+    try:
+        fixup_app_bundle(
+            Path(args.input_directory), args.executable_sub_path, args.jobs, cache
         )
+    finally:
+        if cache is not None:
+            with build_trace.span("evict cache"):
+                cache.evict()
 
-        # Now patch the __LINKEDIT section
-        new_size = output_file_size + bundle_data_size
-        fixup_linkedit(output, file_data, new_size)
+            print(cache.get_report())
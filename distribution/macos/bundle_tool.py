@@ -0,0 +1,337 @@
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from dotnet_bundle import (
+    COMPRESSION_MIN_MAJOR_VERSION,
+    FILE_TYPE_ASSEMBLY,
+    FILE_TYPE_DEPS_JSON,
+    FILE_TYPE_NATIVE_BINARY,
+    FILE_TYPE_RUNTIME_CONFIG_JSON,
+    FILE_TYPE_SYMBOLS,
+    FILE_TYPE_UNKNOWN,
+    UNCOMPRESSED_FILE_TYPES,
+    BundleFileEntry,
+    BundleManifest,
+    decompress_entry_data,
+    get_dotnet_bundle_data,
+    map_file,
+)
+from optimize_bundle import compress_entry, rewrite_executable
+
+MANIFEST_NAME = ".bundle_manifest.json"
+BUNDLE_ID_LENGTH = 12
+
+FILE_TYPE_NAMES = {
+    FILE_TYPE_UNKNOWN: "unknown",
+    FILE_TYPE_ASSEMBLY: "assembly",
+    FILE_TYPE_NATIVE_BINARY: "native",
+    FILE_TYPE_DEPS_JSON: "deps.json",
+    FILE_TYPE_RUNTIME_CONFIG_JSON: "runtimeconfig.json",
+    FILE_TYPE_SYMBOLS: "symbols",
+}
+
+parser = argparse.ArgumentParser(
+    description="List, extract and repack the .NET bundle of an executable"
+)
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+list_parser = subparsers.add_parser("list", help="List the bundle entries")
+list_parser.add_argument("executable_path", help="Executable containing the bundle")
+
+extract_parser = subparsers.add_parser("extract", help="Extract bundle entries")
+extract_parser.add_argument("executable_path", help="Executable containing the bundle")
+extract_parser.add_argument("output_directory", help="Output directory")
+extract_parser.add_argument(
+    "patterns", nargs="*", help="Only extract entries matching those glob patterns"
+)
+extract_parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of entries to extract in parallel",
+)
+
+repack_parser = subparsers.add_parser(
+    "repack", help="Replace the bundle with the content of a directory"
+)
+repack_parser.add_argument("executable_path", help="Executable containing the bundle")
+repack_parser.add_argument("input_directory", help="Directory to bundle")
+repack_parser.add_argument("--output", help="Output executable path, in place if unset")
+repack_parser.add_argument("--level", type=int, default=9, help="Compression level")
+repack_parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of entries to compress in parallel",
+)
+
+
+def read_bundle(data) -> BundleManifest:
+    bundle_data = get_dotnet_bundle_data(data)
+
+    if bundle_data is None:
+        raise Exception("The executable does not contain a .NET bundle")
+
+    return bundle_data[2]
+
+
+def get_file_type(relative_path: str) -> int:
+    # Same classification as the SDK bundler, based on the file name.
+    name = os.path.basename(relative_path)
+
+    if name.endswith(".deps.json"):
+        return FILE_TYPE_DEPS_JSON
+    elif name.endswith(".runtimeconfig.json"):
+        return FILE_TYPE_RUNTIME_CONFIG_JSON
+    elif name.endswith((".dll", ".exe")):
+        return FILE_TYPE_ASSEMBLY
+    elif name.endswith(".pdb"):
+        return FILE_TYPE_SYMBOLS
+    elif name.endswith((".dylib", ".so")):
+        return FILE_TYPE_NATIVE_BINARY
+
+    return FILE_TYPE_UNKNOWN
+
+
+def list_bundle(executable_path: Path):
+    with open(executable_path, "rb") as file:
+        bundle = read_bundle(map_file(file))
+
+    print(
+        f"Bundle {bundle.bundle_id}, version {bundle.major}.{bundle.minor}, "
+        f"flags {bundle.flags:#x}, {len(bundle.files)} entries"
+    )
+    print(f"{'Offset':>12} {'Size':>12} {'Compressed':>12} {'Type':<18} Path")
+
+    for entry in bundle.files:
+        print(
+            f"{entry.offset:>12} {entry.size:>12} {entry.compressed_size:>12} "
+            f"{FILE_TYPE_NAMES.get(entry.file_type, entry.file_type):<18} "
+            f"{entry.relative_path}"
+        )
+
+    print(
+        f"Total: {sum(entry.size for entry in bundle.files)} bytes, "
+        f"{sum(entry.stored_size for entry in bundle.files)} bytes stored"
+    )
+
+
+def get_entry_path(output_directory: Path, relative_path: str) -> Path:
+    path = (output_directory / relative_path).resolve()
+
+    if output_directory.resolve() not in path.parents:
+        raise Exception(f"{relative_path} is outside of the output directory")
+
+    return path
+
+
+def extract_entry(entry: BundleFileEntry, path: Path):
+    os.makedirs(path.parent, exist_ok=True)
+
+    data = entry.data
+
+    if entry.compressed_size != 0:
+        data = decompress_entry_data(data, entry.size)
+
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def extract_bundle(
+    executable_path: Path, output_directory: Path, patterns: List[str], jobs: int
+) -> int:
+    with open(executable_path, "rb") as file:
+        bundle = read_bundle(map_file(file))
+
+    entries = [
+        entry
+        for entry in bundle.files
+        if not patterns
+        or any(fnmatch.fnmatch(entry.relative_path, pattern) for pattern in patterns)
+    ]
+    paths = [get_entry_path(output_directory, entry.relative_path) for entry in entries]
+
+    # Entries are sliced from the mapping, writes and inflate release the GIL.
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for future in [
+            executor.submit(extract_entry, entry, path)
+            for entry, path in zip(entries, paths)
+        ]:
+            future.result()
+
+    # What the directory does not tell is kept on the side for repacking.
+    manifest = {
+        "major": bundle.major,
+        "minor": bundle.minor,
+        "bundle_id": bundle.bundle_id,
+        "flags": bundle.flags,
+        "files": [
+            {
+                "path": entry.relative_path,
+                "type": entry.file_type,
+                "compressed": entry.compressed_size != 0,
+            }
+            for entry in bundle.files
+        ],
+    }
+
+    with open(output_directory / MANIFEST_NAME, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    return len(entries)
+
+
+def scan_directory(input_directory: Path) -> List[str]:
+    res = []
+
+    for directory, _, file_names in os.walk(input_directory):
+        for file_name in file_names:
+            relative_path = (Path(directory) / file_name).relative_to(input_directory)
+
+            if relative_path.as_posix() != MANIFEST_NAME:
+                res.append(relative_path.as_posix())
+
+    return sorted(res)
+
+
+def load_manifest(input_directory: Path) -> Optional[dict]:
+    path = input_directory / MANIFEST_NAME
+
+    if not path.exists():
+        return None
+
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def hash_entry(entry: BundleFileEntry) -> bytes:
+    data = entry.data
+
+    if entry.compressed_size != 0:
+        data = decompress_entry_data(data, entry.size)
+
+    return hashlib.sha256(data).digest()
+
+
+def get_bundle_id(entry_hashes: List[bytes]) -> str:
+    # Same derivation as the SDK bundler, from the content hash of every entry.
+    bundle_hash = hashlib.sha256(b"".join(entry_hashes)).digest()
+
+    return (
+        base64.b64encode(bundle_hash)
+        .decode("ascii")[BUNDLE_ID_LENGTH:]
+        .replace("/", "_")
+    )
+
+
+def repack_bundle(bundle: BundleManifest, input_directory: Path, level: int, jobs: int):
+    manifest = load_manifest(input_directory) or {"files": []}
+    file_infos = {info["path"]: info for info in manifest["files"]}
+    paths = scan_directory(input_directory)
+
+    # Entries keep their original order, new files are added at the end.
+    order = {info["path"]: index for index, info in enumerate(manifest["files"])}
+    paths.sort(key=lambda path: order.get(path, len(order)))
+
+    files = []
+    contents: List[Tuple[str, bytes]] = []
+
+    for relative_path in paths:
+        with open(input_directory / relative_path, "rb") as file:
+            data = file.read()
+
+        contents.append((relative_path, hashlib.sha256(data).digest()))
+        info = file_infos.get(relative_path, {})
+        files.append(
+            BundleFileEntry(
+                0,
+                len(data),
+                0,
+                info.get("type", get_file_type(relative_path)),
+                relative_path,
+                data=data,
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        original_contents = list(
+            zip(
+                [entry.relative_path for entry in bundle.files],
+                executor.map(hash_entry, bundle.files),
+            )
+        )
+
+    # The host extracts native libraries to a directory named after the bundle id,
+    # the current id is only kept if the content is exactly the same.
+    if contents != original_contents:
+        bundle.bundle_id = get_bundle_id([entry_hash for (_, entry_hash) in contents])
+
+    bundle.major = manifest.get("major", bundle.major)
+    bundle.minor = manifest.get("minor", bundle.minor)
+    bundle.flags = manifest.get("flags", bundle.flags)
+    bundle.files = files
+    bundle.layout = None
+    bundle.deps_json = None
+    bundle.runtimeconfig_json = None
+
+    for entry in files:
+        if entry.file_type == FILE_TYPE_DEPS_JSON:
+            bundle.deps_json = entry
+        elif entry.file_type == FILE_TYPE_RUNTIME_CONFIG_JSON:
+            bundle.runtimeconfig_json = entry
+
+    compressed_entries = [
+        entry
+        for entry in files
+        if file_infos.get(entry.relative_path, {}).get("compressed")
+        and entry.file_type not in UNCOMPRESSED_FILE_TYPES
+    ]
+
+    if compressed_entries and bundle.major < COMPRESSION_MIN_MAJOR_VERSION:
+        raise Exception(f"Bundle version {bundle.major} does not support compression")
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(
+            executor.map(lambda entry: compress_entry(entry, level), compressed_entries)
+        )
+
+    for entry, stored_size, data, _ in results:
+        if data is not None:
+            entry.data = data
+            entry.compressed_size = stored_size
+
+    print(
+        f"Repacked {len(files)} entries, {sum(entry.size for entry in files)} bytes "
+        f"({len(compressed_entries)} compressed)"
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    executable_path = Path(args.executable_path)
+
+    if args.command == "list":
+        list_bundle(executable_path)
+    elif args.command == "extract":
+        output_directory = Path(args.output_directory)
+        os.makedirs(output_directory, exist_ok=True)
+
+        count = extract_bundle(
+            executable_path, output_directory, args.patterns, args.jobs
+        )
+        print(f"Extracted {count} entries to {output_directory}")
+    else:
+        rewrite_executable(
+            executable_path,
+            Path(args.output or args.executable_path),
+            lambda bundle: repack_bundle(
+                bundle, Path(args.input_directory), args.level, args.jobs
+            ),
+        )
@@ -0,0 +1,611 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import plistlib
+import shutil
+import struct
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+from dotnet_bundle import write_padding
+from macho import (
+    FAT_MAGIC,
+    FAT_MAGIC_64,
+    LC_CODE_SIGNATURE,
+    MH_EXECUTE,
+    MH_MAGIC,
+    MH_MAGIC_64,
+    MachOLoadCommand,
+    MachOSlice,
+    align_up,
+    get_page_size,
+    read_fat_archs,
+    read_magic,
+    write_fat_file,
+)
+
+parser = argparse.ArgumentParser(
+    description="Ad-hoc sign a Mach-O file or an application bundle"
+)
+parser.add_argument("input_path", help="Mach-O file or application bundle to sign")
+parser.add_argument("--entitlements", help="Entitlements plist of the main executable")
+parser.add_argument("--identifier", help="Signing identifier of a single Mach-O file")
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files and pages to hash in parallel",
+)
+
+# From the xnu cs_blobs.h
+CSMAGIC_REQUIREMENTS = 0xFADE0C01
+CSMAGIC_CODEDIRECTORY = 0xFADE0C02
+CSMAGIC_EMBEDDED_SIGNATURE = 0xFADE0CC0
+CSMAGIC_EMBEDDED_ENTITLEMENTS = 0xFADE7171
+CSMAGIC_EMBEDDED_DER_ENTITLEMENTS = 0xFADE7172
+CSMAGIC_BLOBWRAPPER = 0xFADE0B01
+
+CSSLOT_CODEDIRECTORY = 0
+CSSLOT_INFOSLOT = 1
+CSSLOT_REQUIREMENTS = 2
+CSSLOT_RESOURCEDIR = 3
+CSSLOT_ENTITLEMENTS = 5
+CSSLOT_DER_ENTITLEMENTS = 7
+CSSLOT_SIGNATURESLOT = 0x10000
+
+CS_SUPPORTSEXECSEG = 0x20400
+CS_ADHOC = 0x2
+CS_HASHTYPE_SHA256 = 2
+CS_SHA256_LEN = 32
+CS_CDHASH_LEN = 20
+
+CS_EXECSEG_MAIN_BINARY = 0x1
+CS_EXECSEG_ALLOW_UNSIGNED = 0x10
+CS_EXECSEG_DEBUGGER = 0x20
+CS_EXECSEG_JIT = 0x40
+CS_EXECSEG_SKIP_LV = 0x80
+CS_EXECSEG_CAN_LOAD_CDHASH = 0x100
+CS_EXECSEG_CAN_EXEC_CDHASH = 0x200
+
+# Same entitlements codesign looks at to fill the executable segment flags.
+EXECSEG_ENTITLEMENTS = {
+    "get-task-allow": CS_EXECSEG_ALLOW_UNSIGNED,
+    "run-unsigned-code": CS_EXECSEG_ALLOW_UNSIGNED,
+    "com.apple.private.cs.debugger": CS_EXECSEG_DEBUGGER,
+    "dynamic-codesigning": CS_EXECSEG_JIT,
+    "com.apple.private.skip-library-validation": CS_EXECSEG_SKIP_LV,
+    "com.apple.private.amfi.can-load-cdhash": CS_EXECSEG_CAN_LOAD_CDHASH,
+    "com.apple.private.amfi.can-execute-cdhash": CS_EXECSEG_CAN_EXEC_CDHASH,
+}
+
+MACHO_MAGICS = (MH_MAGIC, MH_MAGIC_64, FAT_MAGIC, FAT_MAGIC_64)
+
+CODE_PAGE_SHIFT = 12
+CODE_PAGE_SIZE = 1 << CODE_PAGE_SHIFT
+
+# Pages are hashed in batches so that every task is worth scheduling.
+PAGES_PER_TASK = 1024
+
+# Default codesign resource rules for application bundles.
+RESOURCE_RULES = {
+    "^Resources/": True,
+    "^Resources/.*\\.lproj/": {"optional": True, "weight": 1000.0},
+    "^Resources/.*\\.lproj/locversion.plist$": {"omit": True, "weight": 1100.0},
+    "^Resources/Base\\.lproj/": {"weight": 1010.0},
+    "^version.plist$": True,
+}
+
+RESOURCE_RULES2 = {
+    ".*\\.dSYM($|/)": {"weight": 11.0},
+    "^(.*/)?\\.DS_Store$": {"omit": True, "weight": 2000.0},
+    "^(Frameworks|SharedFrameworks|PlugIns|Plug-ins|XPCServices|Helpers|MacOS|"
+    "Library/(Automator|Spotlight|LoginItems))/": {"nested": True, "weight": 10.0},
+    "^.*": True,
+    "^Info\\.plist$": {"omit": True, "weight": 20.0},
+    "^PkgInfo$": {"omit": True, "weight": 20.0},
+    "^Resources/": {"weight": 20.0},
+    "^Resources/.*\\.lproj/": {"optional": True, "weight": 1000.0},
+    "^Resources/.*\\.lproj/locversion.plist$": {"omit": True, "weight": 1100.0},
+    "^Resources/Base\\.lproj/": {"weight": 1010.0},
+    "^[^/]+$": {"nested": True, "weight": 10.0},
+    "^embedded\\.provisionprofile$": {"weight": 20.0},
+    "^version\\.plist$": {"weight": 20.0},
+}
+
+NESTED_CODE_DIRECTORIES = ("Frameworks", "SharedFrameworks", "PlugIns", "MacOS")
+
+
+def build_blob(magic: int, data: bytes) -> bytes:
+    return struct.pack(">II", magic, 8 + len(data)) + data
+
+
+def encode_der(tag: int, content: bytes) -> bytes:
+    size = len(content)
+
+    if size < 0x80:
+        return bytes([tag, size]) + content
+
+    raw_size = size.to_bytes((size.bit_length() + 7) // 8, "big")
+
+    return bytes([tag, 0x80 | len(raw_size)]) + raw_size + content
+
+
+def encode_der_value(value) -> bytes:
+    if isinstance(value, bool):
+        return encode_der(0x01, b"\xff" if value else b"\x00")
+    elif isinstance(value, int):
+        size = max(1, (value.bit_length() + 8) // 8)
+
+        return encode_der(0x02, value.to_bytes(size, "big", signed=True))
+    elif isinstance(value, str):
+        return encode_der(0x0C, value.encode("utf-8"))
+    elif isinstance(value, list):
+        return encode_der(0x30, b"".join(encode_der_value(item) for item in value))
+    elif isinstance(value, dict):
+        # Dictionaries are a context specific set of key value pairs, sorted by key.
+        return encode_der(
+            0xB0,
+            b"".join(
+                encode_der(0x30, encode_der_value(key) + encode_der_value(value[key]))
+                for key in sorted(value.keys())
+            ),
+        )
+
+    raise Exception(f"Cannot encode {type(value).__name__} entitlements as DER")
+
+
+def encode_der_entitlements(entitlements: dict) -> bytes:
+    return encode_der(0x70, encode_der(0x02, b"\x01") + encode_der_value(entitlements))
+
+
+def get_execseg_flags(filetype: int, entitlements: Optional[dict]) -> int:
+    flags = CS_EXECSEG_MAIN_BINARY if filetype == MH_EXECUTE else 0
+
+    for key, flag in EXECSEG_ENTITLEMENTS.items():
+        if entitlements is not None and entitlements.get(key) is True:
+            flags |= flag
+
+    return flags
+
+
+def build_code_directory(
+    identifier: str,
+    code_limit: int,
+    page_hashes: List[bytes],
+    special_hashes: Dict[int, bytes],
+    execseg_base: int,
+    execseg_limit: int,
+    execseg_flags: int,
+) -> bytes:
+    raw_identifier = identifier.encode("utf-8") + b"\0"
+    special_slot_count = max(special_hashes.keys(), default=0)
+
+    header_size = 88
+    identifier_offset = header_size
+    hash_offset = identifier_offset + len(raw_identifier) + special_slot_count * 32
+    size = hash_offset + len(page_hashes) * 32
+
+    header = struct.pack(
+        ">9I4B4I4Q",
+        CSMAGIC_CODEDIRECTORY,
+        size,
+        CS_SUPPORTSEXECSEG,
+        CS_ADHOC,
+        hash_offset,
+        identifier_offset,
+        special_slot_count,
+        len(page_hashes),
+        min(code_limit, 0xFFFFFFFF),
+        CS_SHA256_LEN,
+        CS_HASHTYPE_SHA256,
+        0,
+        CODE_PAGE_SHIFT,
+        0,
+        0,
+        0,
+        0,
+        code_limit if code_limit > 0xFFFFFFFF else 0,
+        execseg_base,
+        execseg_limit,
+        execseg_flags,
+    )
+
+    # Special slots are indexed backward from the code hashes.
+    special_slots = b"".join(
+        special_hashes.get(slot, bytes(CS_SHA256_LEN))
+        for slot in range(special_slot_count, 0, -1)
+    )
+
+    return header + raw_identifier + special_slots + b"".join(page_hashes)
+
+
+def build_super_blob(blobs: List[Tuple[int, bytes]]) -> bytes:
+    offset = 12 + 8 * len(blobs)
+    index = b""
+
+    for slot, blob in blobs:
+        index += struct.pack(">II", slot, offset)
+        offset += len(blob)
+
+    return (
+        struct.pack(">III", CSMAGIC_EMBEDDED_SIGNATURE, offset, len(blobs))
+        + index
+        + b"".join(blob for (_, blob) in blobs)
+    )
+
+
+def hash_pages(data: mmap.mmap, code_limit: int, jobs: int) -> List[bytes]:
+    page_count = (code_limit + CODE_PAGE_SIZE - 1) // CODE_PAGE_SIZE
+
+    def hash_page_range(first_page: int) -> List[bytes]:
+        res = []
+
+        with memoryview(data) as view:
+            for page in range(first_page, min(first_page + PAGES_PER_TASK, page_count)):
+                start = page * CODE_PAGE_SIZE
+                end = min(start + CODE_PAGE_SIZE, code_limit)
+                res.append(hashlib.sha256(view[start:end]).digest())
+
+        return res
+
+    first_pages = range(0, page_count, PAGES_PER_TASK)
+
+    if len(first_pages) <= 1 or jobs <= 1:
+        results = map(hash_page_range, first_pages)
+    else:
+        # hashlib releases the GIL, page ranges are hashed in parallel.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(hash_page_range, first_pages))
+
+    return [page_hash for page_hashes in results for page_hash in page_hashes]
+
+
+def sign_thin_file(
+    path: Path,
+    identifier: str,
+    entitlements: Optional[bytes],
+    special_hashes: Dict[int, bytes],
+    jobs: int,
+) -> bytes:
+    with open(path, "r+b") as file:
+        file.seek(0, os.SEEK_END)
+        macho_slice = MachOSlice.parse(file, 0, file.tell())
+
+        if not macho_slice.is_64:
+            raise Exception(f"{path}: only 64-bit Mach-O files can be signed")
+
+        text_command = macho_slice.get_segment_command(b"__TEXT")
+        linkedit_command = macho_slice.get_segment_command(b"__LINKEDIT")
+
+        if text_command is None or linkedit_command is None:
+            raise Exception(f"{path}: missing __TEXT or __LINKEDIT segment")
+
+        (linkedit_vmsize, linkedit_fileoff, linkedit_filesize) = struct.unpack(
+            "<QQQ", linkedit_command.data[32:56]
+        )
+
+        # The signature goes at the end of __LINKEDIT, replacing any previous one.
+        signature_commands = macho_slice.find_commands(LC_CODE_SIGNATURE)
+
+        if signature_commands:
+            signature_command = signature_commands[0]
+            (code_limit,) = struct.unpack("<I", signature_command.data[8:12])
+        else:
+            code_limit = align_up(linkedit_fileoff + linkedit_filesize, 16)
+            signature_command = MachOLoadCommand(LC_CODE_SIGNATURE, b"")
+            macho_slice.commands.append(signature_command)
+
+        blobs = []
+        slot_hashes = dict(special_hashes)
+
+        requirements = build_blob(CSMAGIC_REQUIREMENTS, struct.pack(">I", 0))
+        blobs.append((CSSLOT_REQUIREMENTS, requirements))
+
+        entitlements_dict = None
+
+        if entitlements is not None:
+            entitlements_dict = plistlib.loads(entitlements)
+            blobs.append(
+                (
+                    CSSLOT_ENTITLEMENTS,
+                    build_blob(CSMAGIC_EMBEDDED_ENTITLEMENTS, entitlements),
+                )
+            )
+            blobs.append(
+                (
+                    CSSLOT_DER_ENTITLEMENTS,
+                    build_blob(
+                        CSMAGIC_EMBEDDED_DER_ENTITLEMENTS,
+                        encode_der_entitlements(entitlements_dict),
+                    ),
+                )
+            )
+
+        for slot, blob in blobs:
+            slot_hashes[slot] = hashlib.sha256(blob).digest()
+
+        # Ad-hoc signatures still carry an empty CMS blob.
+        blobs.append((CSSLOT_SIGNATURESLOT, build_blob(CSMAGIC_BLOBWRAPPER, b"")))
+
+        page_count = (code_limit + CODE_PAGE_SIZE - 1) // CODE_PAGE_SIZE
+        (text_fileoff, text_filesize) = struct.unpack("<QQ", text_command.data[40:56])
+
+        def build_signature(page_hashes: List[bytes]) -> Tuple[bytes, bytes]:
+            code_directory = build_code_directory(
+                identifier,
+                code_limit,
+                page_hashes,
+                slot_hashes,
+                text_fileoff,
+                text_filesize,
+                get_execseg_flags(macho_slice.filetype, entitlements_dict),
+            )
+
+            return (
+                code_directory,
+                build_super_blob([(CSSLOT_CODEDIRECTORY, code_directory)] + blobs),
+            )
+
+        # The signature size is known upfront, the header is final before hashing.
+        (_, signature) = build_signature([bytes(CS_SHA256_LEN)] * page_count)
+        signature_size = align_up(len(signature), 16)
+
+        signature_command.data = struct.pack(
+            "<IIII", LC_CODE_SIGNATURE, 16, code_limit, signature_size
+        )
+
+        new_linkedit_filesize = code_limit + signature_size - linkedit_fileoff
+        new_linkedit_vmsize = max(
+            linkedit_vmsize,
+            align_up(new_linkedit_filesize, get_page_size(macho_slice.cputype)),
+        )
+        linkedit_command.data = (
+            linkedit_command.data[:32]
+            + struct.pack(
+                "<QQQ", new_linkedit_vmsize, linkedit_fileoff, new_linkedit_filesize
+            )
+            + linkedit_command.data[56:]
+        )
+
+        file.seek(0)
+        file.write(macho_slice.build_header())
+        file.truncate(code_limit)
+        file.flush()
+
+        with mmap.mmap(file.fileno(), code_limit, access=mmap.ACCESS_READ) as data:
+            page_hashes = hash_pages(data, code_limit, jobs)
+
+        (code_directory, signature) = build_signature(page_hashes)
+
+        file.seek(code_limit)
+        file.write(signature)
+        write_padding(file, signature_size - len(signature))
+
+    return hashlib.sha256(code_directory).digest()[:CS_CDHASH_LEN]
+
+
+def sign_file(
+    path: Path,
+    identifier: str,
+    entitlements: Optional[bytes] = None,
+    special_hashes: Dict[int, bytes] = {},
+    jobs: int = 1,
+) -> List[bytes]:
+    with open(path, "rb") as file:
+        magic = read_magic(file.read(4))
+
+        if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+            return [
+                sign_thin_file(path, identifier, entitlements, special_hashes, jobs)
+            ]
+
+        fat_archs = read_fat_archs(file)
+
+        # Every slice is signed on its own, the fat file is then rebuilt around them.
+        with tempfile.TemporaryDirectory(dir=path.parent) as temp_directory:
+            slice_paths = []
+
+            for index, (_, _, offset, size, _) in enumerate(fat_archs):
+                slice_path = Path(temp_directory) / f"slice{index}"
+
+                with open(slice_path, "wb") as slice_file:
+                    file.seek(offset)
+                    slice_file.write(file.read(size))
+
+                slice_paths.append(slice_path)
+
+            cdhashes = [
+                sign_thin_file(
+                    slice_path, identifier, entitlements, special_hashes, jobs
+                )
+                for slice_path in slice_paths
+            ]
+
+            output_path = Path(temp_directory) / "output"
+            write_fat_file(output_path, slice_paths)
+            shutil.copymode(path, output_path)
+            os.replace(output_path, path)
+
+    return cdhashes
+
+
+def is_macho_file(path: Path) -> bool:
+    if path.is_symlink() or not path.is_file():
+        return False
+
+    with open(path, "rb") as file:
+        return read_magic(file.read(4)) in MACHO_MAGICS
+
+
+def get_file_identifier(path: Path) -> str:
+    if path.suffix == ".dylib":
+        return path.stem
+
+    return path.name
+
+
+def build_code_resources(
+    contents_directory: Path, main_executable: Path, cdhashes: Dict[Path, List[bytes]]
+) -> bytes:
+    files = {}
+    files2 = {}
+
+    for root, directory_names, file_names in os.walk(contents_directory):
+        # Symlinks to directories are not followed, they are recorded as files.
+        names = file_names + [
+            name for name in directory_names if os.path.islink(os.path.join(root, name))
+        ]
+
+        for file_name in sorted(names):
+            path = Path(root) / file_name
+            relative_path = path.relative_to(contents_directory).as_posix()
+
+            if (
+                path == main_executable
+                or relative_path in ("Info.plist", "PkgInfo")
+                or relative_path.startswith("_CodeSignature/")
+                or file_name == ".DS_Store"
+            ):
+                continue
+
+            if path.is_symlink():
+                files2[relative_path] = {"symlink": os.readlink(path)}
+                continue
+
+            is_nested = (
+                relative_path.split("/")[0] in NESTED_CODE_DIRECTORIES
+                or "/" not in relative_path
+            )
+
+            # Nested code is pinned by its code directory hash rather than its content.
+            if is_nested and path in cdhashes:
+                files2[relative_path] = {
+                    "cdhash": cdhashes[path][0],
+                    "requirement": " or ".join(
+                        f'cdhash H"{cdhash.hex()}"' for cdhash in cdhashes[path]
+                    ),
+                }
+                continue
+
+            with open(path, "rb") as file:
+                data = file.read()
+
+            sha1_hash = hashlib.sha1(data).digest()
+
+            if relative_path.startswith("Resources/"):
+                files[relative_path] = sha1_hash
+
+            files2[relative_path] = {
+                "hash": sha1_hash,
+                "hash2": hashlib.sha256(data).digest(),
+            }
+
+    return plistlib.dumps(
+        {
+            "files": files,
+            "files2": files2,
+            "rules": RESOURCE_RULES,
+            "rules2": RESOURCE_RULES2,
+        }
+    )
+
+
+def sign_nested_files(paths: List[Path], jobs: int) -> Dict[Path, List[bytes]]:
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return dict(
+            zip(
+                paths,
+                executor.map(
+                    lambda path: sign_file(path, get_file_identifier(path)), paths
+                ),
+            )
+        )
+
+
+def get_main_executable(bundle_path: Path) -> Path:
+    with open(bundle_path / "Contents" / "Info.plist", "rb") as file:
+        info = plistlib.loads(file.read())
+
+    return bundle_path / "Contents" / "MacOS" / info["CFBundleExecutable"]
+
+
+def get_nested_paths(bundle_path: Path) -> List[Path]:
+    main_executable = get_main_executable(bundle_path)
+    res = []
+
+    for root, _, file_names in os.walk(bundle_path / "Contents"):
+        for file_name in sorted(file_names):
+            path = Path(root) / file_name
+
+            if path != main_executable and is_macho_file(path):
+                res.append(path)
+
+    return res
+
+
+def sign_main_executable(
+    bundle_path: Path,
+    entitlements: Optional[bytes],
+    cdhashes: Dict[Path, List[bytes]],
+    jobs: int,
+):
+    contents_directory = bundle_path / "Contents"
+
+    with open(contents_directory / "Info.plist", "rb") as file:
+        info_plist = file.read()
+
+    info = plistlib.loads(info_plist)
+    main_executable = contents_directory / "MacOS" / info["CFBundleExecutable"]
+
+    code_resources = build_code_resources(
+        contents_directory, main_executable, cdhashes
+    )
+    os.makedirs(contents_directory / "_CodeSignature", exist_ok=True)
+
+    with open(contents_directory / "_CodeSignature" / "CodeResources", "wb") as file:
+        file.write(code_resources)
+
+    sign_file(
+        main_executable,
+        info["CFBundleIdentifier"],
+        entitlements,
+        {
+            CSSLOT_INFOSLOT: hashlib.sha256(info_plist).digest(),
+            CSSLOT_RESOURCEDIR: hashlib.sha256(code_resources).digest(),
+        },
+        jobs,
+    )
+
+
+def sign_bundle(bundle_path: Path, entitlements: Optional[bytes], jobs: int):
+    # Nested code is signed first, its code directory hashes end up in CodeResources.
+    nested_paths = get_nested_paths(bundle_path)
+    cdhashes = sign_nested_files(nested_paths, jobs)
+    sign_main_executable(bundle_path, entitlements, cdhashes, jobs)
+
+    print(f"Signed {bundle_path} and {len(nested_paths)} nested files")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    entitlements = None
+
+    if args.entitlements is not None:
+        with open(args.entitlements, "rb") as file:
+            entitlements = file.read()
+
+    if input_path.is_dir():
+        sign_bundle(input_path, entitlements, args.jobs)
+    else:
+        sign_file(
+            input_path,
+            args.identifier or get_file_identifier(input_path),
+            entitlements,
+            {},
+            args.jobs,
+        )
@@ -1,9 +1,21 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
-import platform
 import shutil
-import subprocess
+import sys
+from typing import Optional
+
+from artifact_cache import (
+    ArtifactCache,
+    add_cache_arguments,
+    create_cache_from_arguments,
+)
+from macho import is_fat_file, write_fat_file
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
 
 parser = argparse.ArgumentParser(
     description="Construct Universal dylibs for nuget package"
@@ -16,29 +28,13 @@ parser.add_argument(
 )
 parser.add_argument("output_directory", help="Output directory")
 parser.add_argument("rglob", help="rglob")
-
-args = parser.parse_args()
-
-# Use Apple LLVM on Darwin, otherwise standard LLVM.
-if platform.system() == "Darwin":
-    LIPO = "lipo"
-else:
-    LIPO = shutil.which("llvm-lipo")
-
-    if LIPO is None:
-        for llvm_ver in [15, 14, 13]:
-            lipo_path = shutil.which(f"llvm-lipo-{llvm_ver}")
-            if lipo_path is not None:
-                LIPO = lipo_path
-                break
-
-if LIPO is None:
-    raise Exception("Cannot find a valid location for LLVM lipo!")
-
-arm64_input_directory: Path = Path(args.arm64_input_directory)
-x86_64_input_directory: Path = Path(args.x86_64_input_directory)
-output_directory: Path = Path(args.output_directory)
-rglob = args.rglob
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files to process in parallel",
+)
+add_cache_arguments(parser)
 
 
 def get_new_name(
@@ -48,48 +44,107 @@ def get_new_name(
     return Path(os.path.join(output_directory, input_component))
 
 
-def is_fat_file(dylib_path: Path) -> str:
-    res = subprocess.check_output([LIPO, "-info", str(dylib_path.absolute())]).decode(
-        "utf-8"
-    )
-
-    return not res.split("\n")[0].startswith("Non-fat file")
-
-
 def construct_universal_dylib(
-    arm64_input_dylib_path: Path, x86_64_input_dylib_path: Path, output_dylib_path: Path
+    arm64_input_dylib_path: Path,
+    x86_64_input_dylib_path: Path,
+    output_dylib_path: Path,
+    cache: Optional[ArtifactCache] = None,
 ):
     if output_dylib_path.exists() or output_dylib_path.is_symlink():
         os.remove(output_dylib_path)
 
     os.makedirs(output_dylib_path.parent, exist_ok=True)
 
+    # Links are kept as is, they can point to another directory once deduped.
     if arm64_input_dylib_path.is_symlink():
-        os.symlink(
-            os.path.basename(arm64_input_dylib_path.resolve()), output_dylib_path
-        )
+        os.symlink(os.readlink(arm64_input_dylib_path), output_dylib_path)
     else:
         if is_fat_file(arm64_input_dylib_path) or not x86_64_input_dylib_path.exists():
-            with open(output_dylib_path, "wb") as dst:
-                with open(arm64_input_dylib_path, "rb") as src:
-                    dst.write(src.read())
+            shutil.copyfile(arm64_input_dylib_path, output_dylib_path)
         else:
-            subprocess.check_call(
-                [
-                    LIPO,
-                    str(arm64_input_dylib_path.absolute()),
-                    str(x86_64_input_dylib_path.absolute()),
-                    "-output",
-                    str(output_dylib_path.absolute()),
-                    "-create",
-                ]
-            )
+            input_paths = [arm64_input_dylib_path, x86_64_input_dylib_path]
+            cache_key = None
+
+            if cache is not None:
+                cache_key = cache.compute_key("universal", input_paths, [])
+
+            with build_trace.span(str(output_dylib_path), "universal") as trace_args:
+                trace_args["cached"] = cache_key is not None and cache.restore(
+                    cache_key, output_dylib_path
+                )
+
+                if not trace_args["cached"]:
+                    write_fat_file(output_dylib_path, input_paths)
 
+                    if cache_key is not None:
+                        cache.store(cache_key, output_dylib_path)
+
+        shutil.copymode(arm64_input_dylib_path, output_dylib_path)
+
+
+def construct_universal_tree(
+    arm64_input_directory: Path,
+    x86_64_input_directory: Path,
+    output_directory: Path,
+    rglob: str,
+    jobs: int,
+    cache: Optional[ArtifactCache] = None,
+):
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            (
+                path,
+                executor.submit(
+                    construct_universal_dylib,
+                    path,
+                    get_new_name(arm64_input_directory, x86_64_input_directory, path),
+                    get_new_name(arm64_input_directory, output_directory, path),
+                    cache,
+                ),
+            )
+            for path in arm64_input_directory.rglob(rglob)
+        ]
+
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f"{path}: {e}")
+
+    if errors:
+        for error in errors:
+            print(error)
+
+        raise Exception(f"Cannot construct {len(errors)} universal files")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("construct_universal_dylib")
+
+    arm64_input_directory: Path = Path(args.arm64_input_directory)
+    x86_64_input_directory: Path = Path(args.x86_64_input_directory)
+    output_directory: Path = Path(args.output_directory)
+    rglob = args.rglob
+    cache = create_cache_from_arguments(args)
+
+    print(rglob)
+
+    try:
+        with build_trace.span("construct universal tree", rglob=rglob):
+            construct_universal_tree(
+                arm64_input_directory,
+                x86_64_input_directory,
+                output_directory,
+                rglob,
+                args.jobs,
+                cache,
+            )
+    finally:
+        if cache is not None:
+            with build_trace.span("evict cache"):
+                cache.evict()
 
-print(rglob)
-for path in arm64_input_directory.rglob("**/*.dylib"):
-    construct_universal_dylib(
-        path,
-        get_new_name(arm64_input_directory, x86_64_input_directory, path),
-        get_new_name(arm64_input_directory, output_directory, path),
-    )
+            print(cache.get_report())
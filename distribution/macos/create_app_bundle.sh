@@ -5,6 +5,7 @@ set -e
 PUBLISH_DIRECTORY=$1
 OUTPUT_DIRECTORY=$2
 ENTITLEMENTS_FILE_PATH=$3
+SKIP_FIXUP=$4
 
 APP_BUNDLE_DIRECTORY="$OUTPUT_DIRECTORY/Ryujinx.app"
 
@@ -29,22 +30,27 @@ cp -r "$PUBLISH_DIRECTORY/THIRDPARTY.md" "$APP_BUNDLE_DIRECTORY/Contents/Resourc
 
 echo -n "APPL????" > "$APP_BUNDLE_DIRECTORY/Contents/PkgInfo"
 
+# The fixup can be left to create_universal_app_bundle.py when building a universal bundle
+if [ "$SKIP_FIXUP" == "--skip-fixup" ];
+then
+    exit 0
+fi
+
+# Identical libraries are only kept once
+python3 dedupe_libraries.py "$APP_BUNDLE_DIRECTORY"
+
 # Fixup libraries and executable
 python3 bundle_fix_up.py "$APP_BUNDLE_DIRECTORY" MacOS/Ryujinx
 
 # Now sign it
 if ! [ -x "$(command -v codesign)" ];
 then
-    if ! [ -x "$(command -v rcodesign)" ];
-    then
-        echo "Cannot find rcodesign on your system, please install rcodesign."
-        exit 1
-    fi
-
-    # cargo install apple-codesign
-    echo "Usign rcodesign for ad-hoc signing"
-    rcodesign sign --entitlements-xml-path "$ENTITLEMENTS_FILE_PATH" "$APP_BUNDLE_DIRECTORY"
+    echo "Using codesign.py for ad-hoc signing"
+    python3 codesign.py --entitlements "$ENTITLEMENTS_FILE_PATH" "$APP_BUNDLE_DIRECTORY"
 else
     echo "Usign codesign for ad-hoc signing"
     codesign --entitlements "$ENTITLEMENTS_FILE_PATH" -f --deep -s - "$APP_BUNDLE_DIRECTORY"
-fi
\ No newline at end of file
+fi
+
+# Check the Mach-O structure, .NET bundle and library links
+python3 verify_app_bundle.py "$APP_BUNDLE_DIRECTORY"
@@ -50,34 +50,14 @@ rm -rf "$TEMP_DIRECTORY/publish_x64/libarmeilleure-jitsupport.dylib"
 rm -rf "$TEMP_DIRECTORY/publish_arm64/libsoundio.dylib"
 
 pushd "$BASE_DIR/distribution/macos"
-./create_app_bundle.sh "$TEMP_DIRECTORY/publish_x64" "$TEMP_DIRECTORY/output_x64" "$ENTITLEMENTS_FILE_PATH"
-./create_app_bundle.sh "$TEMP_DIRECTORY/publish_arm64" "$TEMP_DIRECTORY/output_arm64" "$ENTITLEMENTS_FILE_PATH"
+./create_app_bundle.sh "$TEMP_DIRECTORY/publish_x64" "$TEMP_DIRECTORY/output_x64" "$ENTITLEMENTS_FILE_PATH" --skip-fixup
+./create_app_bundle.sh "$TEMP_DIRECTORY/publish_arm64" "$TEMP_DIRECTORY/output_arm64" "$ENTITLEMENTS_FILE_PATH" --skip-fixup
 popd
 
-rm -rf "$UNIVERSAL_APP_BUNDLE"
 mkdir -p "$OUTPUT_DIRECTORY"
 
-# Let's copy one of the two different app bundle and remove the executable
-cp -R "$ARM64_APP_BUNDLE" "$UNIVERSAL_APP_BUNDLE"
-rm "$UNIVERSAL_APP_BUNDLE/$EXECUTABLE_SUB_PATH"
-
-# Make it libraries universal
-python3 "$BASE_DIR/distribution/macos/construct_universal_dylib.py" "$ARM64_APP_BUNDLE" "$X64_APP_BUNDLE" "$UNIVERSAL_APP_BUNDLE" "**/*.dylib"
-
-if ! [ -x "$(command -v lipo)" ];
-then
-    if ! [ -x "$(command -v llvm-lipo-14)" ];
-    then
-        LIPO=llvm-lipo
-    else
-        LIPO=llvm-lipo-14
-    fi
-else
-    LIPO=lipo
-fi
-
-# Make the executable universal
-$LIPO "$ARM64_APP_BUNDLE/$EXECUTABLE_SUB_PATH" "$X64_APP_BUNDLE/$EXECUTABLE_SUB_PATH" -output "$UNIVERSAL_APP_BUNDLE/$EXECUTABLE_SUB_PATH" -create
+# Dedupe and fixup both app bundles and make their libraries and executable universal in one go
+python3 "$BASE_DIR/distribution/macos/create_universal_app_bundle.py" --dedupe "$ARM64_APP_BUNDLE" "$X64_APP_BUNDLE" "$UNIVERSAL_APP_BUNDLE"
 
 # Patch up the Info.plist to have appropriate version
 #sed -r -i.bck "s/\%\%RYUJINX_BUILD_VERSION\%\%/$VERSION/g;" "$UNIVERSAL_APP_BUNDLE/Contents/Info.plist"
@@ -87,27 +67,27 @@ rm "$UNIVERSAL_APP_BUNDLE/Contents/Info.plist.bck"
 # Now sign it
 if ! [ -x "$(command -v codesign)" ];
 then
-    if ! [ -x "$(command -v rcodesign)" ];
-    then
-        echo "Cannot find rcodesign on your system, please install rcodesign."
-        exit 1
-    fi
-
-    # NOTE: Currently require https://github.com/indygreg/apple-platform-rs/pull/44 to work on other OSes.
-    # cargo install --git "https://github.com/marysaka/apple-platform-rs" --branch "fix/adhoc-app-bundle" apple-codesign --bin "rcodesign"
-    echo "Using rcodesign for ad-hoc signing"
-    rcodesign sign --entitlements-xml-path "$ENTITLEMENTS_FILE_PATH" "$UNIVERSAL_APP_BUNDLE"
+    echo "Using codesign.py for ad-hoc signing"
+    python3 "$BASE_DIR/distribution/macos/codesign.py" --entitlements "$ENTITLEMENTS_FILE_PATH" "$UNIVERSAL_APP_BUNDLE"
 else
     echo "Using codesign for ad-hoc signing"
     codesign --entitlements "$ENTITLEMENTS_FILE_PATH" -f --deep -s - "$UNIVERSAL_APP_BUNDLE"
 fi
 
+# Catch broken bundles and unresolved libraries before they reach users
+python3 "$BASE_DIR/distribution/macos/verify_app_bundle.py" "$UNIVERSAL_APP_BUNDLE"
+
 echo "Creating archive"
 pushd "$OUTPUT_DIRECTORY"
-tar --exclude "Ryujinx.app/Contents/MacOS/Ryujinx" -cvf "$RELEASE_TAR_FILE_NAME" Ryujinx.app 1> /dev/null
-python3 "$BASE_DIR/distribution/misc/add_tar_exec.py" "$RELEASE_TAR_FILE_NAME" "Ryujinx.app/Contents/MacOS/Ryujinx" "Ryujinx.app/Contents/MacOS/Ryujinx"
-gzip -9 < "$RELEASE_TAR_FILE_NAME" > "$RELEASE_TAR_FILE_NAME.gz"
-rm "$RELEASE_TAR_FILE_NAME"
+python3 "$BASE_DIR/distribution/misc/add_tar_exec.py" --source-directory Ryujinx.app "$RELEASE_TAR_FILE_NAME.gz" "Ryujinx.app/Contents/MacOS/Ryujinx" "Ryujinx.app/Contents/MacOS/Ryujinx"
+
+# Smaller downloads for users who only need one architecture, these are not published yet
+if [ "$RYUJINX_THIN_ARCHIVES" == "1" ];
+then
+    echo "Creating per-architecture archives"
+    THIN_RELEASE_TAR_FILE_NAME="${RELEASE_TAR_FILE_NAME/universal/\{arch\}}.gz"
+    python3 "$BASE_DIR/distribution/macos/thin_app_bundle.py" --sign --entitlements "$ENTITLEMENTS_FILE_PATH" --tar-name "$OUTPUT_DIRECTORY/$THIN_RELEASE_TAR_FILE_NAME" --executable-sub-path "$EXECUTABLE_SUB_PATH" "$UNIVERSAL_APP_BUNDLE" "$TEMP_DIRECTORY/thin"
+fi
 
 # Create legacy update package for Avalonia to not left behind old testers.
 #if [ "$VERSION" != "1.1.0" ];
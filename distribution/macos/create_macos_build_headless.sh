@@ -59,38 +59,18 @@ rm "$UNIVERSAL_OUTPUT/$EXECUTABLE_SUB_PATH"
 # Make it libraries universal
 python3 "$BASE_DIR/distribution/macos/construct_universal_dylib.py" "$ARM64_OUTPUT" "$X64_OUTPUT" "$UNIVERSAL_OUTPUT" "**/*.dylib"
 
-if ! [ -x "$(command -v lipo)" ];
-then
-    if ! [ -x "$(command -v llvm-lipo-14)" ];
-    then
-        LIPO=llvm-lipo
-    else
-        LIPO=llvm-lipo-14
-    fi
-else
-    LIPO=lipo
-fi
-
 # Make the executable universal
-$LIPO "$ARM64_OUTPUT/$EXECUTABLE_SUB_PATH" "$X64_OUTPUT/$EXECUTABLE_SUB_PATH" -output "$UNIVERSAL_OUTPUT/$EXECUTABLE_SUB_PATH" -create
+python3 "$BASE_DIR/distribution/macos/construct_universal_dylib.py" "$ARM64_OUTPUT" "$X64_OUTPUT" "$UNIVERSAL_OUTPUT" "$EXECUTABLE_SUB_PATH"
 
 # Now sign it
 if ! [ -x "$(command -v codesign)" ];
 then
-    if ! [ -x "$(command -v rcodesign)" ];
-    then
-        echo "Cannot find rcodesign on your system, please install rcodesign."
-        exit 1
-    fi
-
-    # NOTE: Currently require https://github.com/indygreg/apple-platform-rs/pull/44 to work on other OSes.
-    # cargo install --git "https://github.com/marysaka/apple-platform-rs" --branch "fix/adhoc-app-bundle" apple-codesign --bin "rcodesign"
-    echo "Using rcodesign for ad-hoc signing"
+    echo "Using codesign.py for ad-hoc signing"
     for FILE in "$UNIVERSAL_OUTPUT"/*; do
         if [[ $(file "$FILE") == *"Mach-O"* ]]; then
-            rcodesign sign --entitlements-xml-path "$ENTITLEMENTS_FILE_PATH" "$FILE"
+            python3 "$BASE_DIR/distribution/macos/codesign.py" --entitlements "$ENTITLEMENTS_FILE_PATH" "$FILE"
         fi
-    done  
+    done
 else
     echo "Using codesign for ad-hoc signing"
     for FILE in "$UNIVERSAL_OUTPUT"/*; do
@@ -102,10 +82,7 @@ fi
 
 echo "Creating archive"
 pushd "$OUTPUT_DIRECTORY"
-tar --exclude "publish/Ryujinx.Headless.SDL2" -cvf "$RELEASE_TAR_FILE_NAME" publish 1> /dev/null
-python3 "$BASE_DIR/distribution/misc/add_tar_exec.py" "$RELEASE_TAR_FILE_NAME" "publish/Ryujinx.Headless.SDL2" "publish/Ryujinx.Headless.SDL2"
-gzip -9 < "$RELEASE_TAR_FILE_NAME" > "$RELEASE_TAR_FILE_NAME.gz"
-rm "$RELEASE_TAR_FILE_NAME"
+python3 "$BASE_DIR/distribution/misc/add_tar_exec.py" --source-directory publish "$RELEASE_TAR_FILE_NAME.gz" "publish/Ryujinx.Headless.SDL2" "publish/Ryujinx.Headless.SDL2"
 popd
 
 echo "Done"
\ No newline at end of file
@@ -0,0 +1,143 @@
+import argparse
+import os
+from pathlib import Path
+import shutil
+import sys
+import time
+
+from artifact_cache import add_cache_arguments, create_cache_from_arguments
+from bundle_fix_up import fixup_app_bundle
+from construct_universal_dylib import construct_universal_tree
+from dedupe_libraries import (
+    dedupe_app_bundles,
+    estimate_saved_time,
+    format_dedupe_report,
+    get_libraries_size,
+)
+from dylib_graph import DylibGraph, get_roots, prune_app_bundles
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Fixup ARM64 and x86_64 app bundles and merge them into a universal one"
+)
+parser.add_argument("arm64_input_directory", help="ARM64 application bundle path")
+parser.add_argument("x86_64_input_directory", help="x86_64 application bundle path")
+parser.add_argument("output_directory", help="Universal application bundle path")
+parser.add_argument(
+    "--executable-sub-path",
+    default="MacOS/Ryujinx",
+    help="Main executable sub path, relative to Contents",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files to process in parallel",
+)
+parser.add_argument(
+    "--prune",
+    action="store_true",
+    help="Remove the libraries unreachable from the executable and the roots",
+)
+parser.add_argument(
+    "--root",
+    action="append",
+    default=[],
+    help="Library loaded at runtime (dlopen, P/Invoke), by name or Contents sub path",
+)
+parser.add_argument("--roots-file", help="File listing one library root per line")
+parser.add_argument(
+    "--dedupe",
+    action="store_true",
+    help="Replace identical libraries by symlinks to a single copy before fixup",
+)
+add_cache_arguments(parser)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("create_universal_app_bundle")
+
+    arm64_input_directory: Path = Path(args.arm64_input_directory)
+    x86_64_input_directory: Path = Path(args.x86_64_input_directory)
+    output_directory: Path = Path(args.output_directory)
+    executable_sub_path = Path("Contents") / args.executable_sub_path
+
+    # Both bundles share the same cache and library fixup code, only paying for
+    # interpreter startup once.
+    cache = create_cache_from_arguments(args)
+
+    try:
+        saved_size = 0
+
+        if args.dedupe:
+            with build_trace.span("dedupe libraries"):
+                (duplicates, saved_size) = dedupe_app_bundles(
+                    [arm64_input_directory, x86_64_input_directory], args.jobs
+                )
+
+            print(format_dedupe_report(duplicates, saved_size))
+
+        processed_size = get_libraries_size(
+            [arm64_input_directory, x86_64_input_directory]
+        )
+        start_time = time.perf_counter()
+
+        for input_directory in (arm64_input_directory, x86_64_input_directory):
+            with build_trace.span("fixup app bundle", bundle=str(input_directory)):
+                fixup_app_bundle(
+                    input_directory, args.executable_sub_path, args.jobs, cache
+                )
+
+        if args.prune:
+            with build_trace.span("prune dylibs"):
+                graphs = []
+
+                for input_directory in (arm64_input_directory, x86_64_input_directory):
+                    root_names = get_roots(
+                        input_directory / executable_sub_path,
+                        args.root,
+                        args.roots_file,
+                    )
+                    graphs.append(
+                        DylibGraph.build(
+                            input_directory, args.executable_sub_path, root_names
+                        )
+                    )
+
+                for path in prune_app_bundles(graphs):
+                    print(f"Removed unreachable library {path}")
+
+        with build_trace.span("copy app bundle"):
+            if output_directory.exists():
+                shutil.rmtree(output_directory)
+
+            # Everything that is not a Mach-O file is taken from the ARM64 bundle.
+            shutil.copytree(arm64_input_directory, output_directory, symlinks=True)
+            os.remove(output_directory / executable_sub_path)
+
+        for rglob in ("**/*.dylib", str(executable_sub_path)):
+            with build_trace.span("construct universal tree", rglob=rglob):
+                construct_universal_tree(
+                    arm64_input_directory,
+                    x86_64_input_directory,
+                    output_directory,
+                    rglob,
+                    args.jobs,
+                    cache,
+                )
+
+        if args.dedupe:
+            saved_time = estimate_saved_time(
+                time.perf_counter() - start_time, processed_size, saved_size
+            )
+            print(f"Dedupe: about {saved_time:.2f}s of fixup and merging saved")
+    finally:
+        if cache is not None:
+            with build_trace.span("evict cache"):
+                cache.evict()
+
+            print(cache.get_report())
@@ -0,0 +1,193 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from bundle_fix_up import LibraryIndex
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Replace identical native libraries of application bundles by "
+    "symlinks to a single copy"
+)
+parser.add_argument(
+    "input_directory",
+    nargs="+",
+    help="Application bundle paths, bundles merged later must be deduped together",
+)
+parser.add_argument(
+    "--dry-run", action="store_true", help="Only report the duplicate libraries"
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of libraries to hash in parallel",
+)
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(1024 * 1024)
+
+            if not data:
+                break
+
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def is_regular_file(path: Path) -> bool:
+    return path.is_file() and not path.is_symlink()
+
+
+def get_canonical_sort_key(relative_path: str) -> Tuple[bool, int, str]:
+    # Frameworks is searched first by the fixup, it is where copies are kept.
+    return (
+        not relative_path.startswith("Frameworks/"),
+        relative_path.count("/"),
+        relative_path,
+    )
+
+
+def find_duplicate_libraries(
+    input_directories: List[Path], jobs: int
+) -> Dict[str, List[str]]:
+    content_directories = [
+        input_directory / "Contents" for input_directory in input_directories
+    ]
+    relative_paths = set()
+
+    for content_directory in content_directories:
+        library_index = LibraryIndex.build(content_directory)
+        relative_paths.update(
+            path.relative_to(content_directory).as_posix()
+            for path in library_index.libraries
+        )
+
+    def get_digests(relative_path: str) -> Tuple[Optional[str], ...]:
+        res = []
+
+        for content_directory in content_directories:
+            path = content_directory / relative_path
+
+            if is_regular_file(path):
+                res.append(hash_file(path))
+            else:
+                res.append(None)
+
+        return tuple(res)
+
+    sorted_paths = sorted(relative_paths, key=get_canonical_sort_key)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        digests = list(executor.map(get_digests, sorted_paths))
+
+    # Libraries are only the same if they are in every bundle, otherwise merging
+    # the bundles would lose one of the variants.
+    groups: Dict[Tuple[Optional[str], ...], List[str]] = {}
+
+    for relative_path, key in zip(sorted_paths, digests):
+        groups.setdefault(key, []).append(relative_path)
+
+    return {paths[0]: paths[1:] for paths in groups.values() if len(paths) > 1}
+
+
+def link_duplicate_libraries(
+    input_directories: List[Path], duplicates: Dict[str, List[str]]
+) -> int:
+    saved_size = 0
+
+    for input_directory in input_directories:
+        content_directory = input_directory / "Contents"
+
+        for canonical_path, relative_paths in duplicates.items():
+            for relative_path in relative_paths:
+                path = content_directory / relative_path
+
+                if not is_regular_file(path):
+                    continue
+
+                saved_size += os.path.getsize(path)
+                os.remove(path)
+                os.symlink(
+                    os.path.relpath(content_directory / canonical_path, path.parent),
+                    path,
+                )
+
+    return saved_size
+
+
+def dedupe_app_bundles(
+    input_directories: List[Path], jobs: int, dry_run: bool = False
+) -> Tuple[Dict[str, List[str]], int]:
+    with build_trace.span("find duplicate libraries"):
+        duplicates = find_duplicate_libraries(input_directories, jobs)
+
+    if dry_run:
+        saved_size = sum(
+            os.path.getsize(input_directory / "Contents" / relative_path)
+            for input_directory in input_directories
+            for relative_paths in duplicates.values()
+            for relative_path in relative_paths
+            if is_regular_file(input_directory / "Contents" / relative_path)
+        )
+    else:
+        with build_trace.span("link duplicate libraries"):
+            saved_size = link_duplicate_libraries(input_directories, duplicates)
+
+    build_trace.add_counter("dedupe_saved_bytes", saved_size)
+
+    return (duplicates, saved_size)
+
+
+def get_libraries_size(input_directories: List[Path]) -> int:
+    return sum(
+        os.path.getsize(path)
+        for input_directory in input_directories
+        for path in LibraryIndex.build(input_directory / "Contents").libraries
+    )
+
+
+def estimate_saved_time(elapsed: float, processed_size: int, saved_size: int) -> float:
+    # Fixup, merging and signing are roughly linear with the library sizes.
+    if processed_size == 0:
+        return 0.0
+
+    return elapsed * saved_size / processed_size
+
+
+def format_dedupe_report(duplicates: Dict[str, List[str]], saved_size: int) -> str:
+    lines = []
+
+    for canonical_path, relative_paths in duplicates.items():
+        for relative_path in relative_paths:
+            lines.append(f"{relative_path} -> {canonical_path}")
+
+    lines.append(
+        f"Dedupe: {sum(len(paths) for paths in duplicates.values())} duplicate "
+        f"libraries, {saved_size} bytes no longer fixed up, signed and archived"
+    )
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("dedupe_libraries")
+
+    (duplicates, saved_size) = dedupe_app_bundles(
+        [Path(path) for path in args.input_directory], args.jobs, args.dry_run
+    )
+
+    print(format_dedupe_report(duplicates, saved_size))
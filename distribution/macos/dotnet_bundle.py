@@ -0,0 +1,720 @@
+import errno
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from typing import List, Optional, Tuple, Union
+import zlib
+
+from macho import (
+    LC_CODE_SIGNATURE,
+    LC_DYLD_CHAINED_FIXUPS,
+    LC_SEGMENT_64,
+    LC_SYMTAB,
+    MachOLoadCommand,
+    MachOSlice,
+    align_up,
+    get_page_size,
+)
+
+BUNDLE_SIGNATURE = hashlib.sha256(b".net core bundle\n").digest()
+
+FILE_TYPE_UNKNOWN = 0
+FILE_TYPE_ASSEMBLY = 1
+FILE_TYPE_NATIVE_BINARY = 2
+FILE_TYPE_DEPS_JSON = 3
+FILE_TYPE_RUNTIME_CONFIG_JSON = 4
+FILE_TYPE_SYMBOLS = 5
+
+# The host reads those before the runtime is up, the SDK never compresses them.
+UNCOMPRESSED_FILE_TYPES = (FILE_TYPE_DEPS_JSON, FILE_TYPE_RUNTIME_CONFIG_JSON)
+
+# Compressed entries were introduced with .NET 6 bundles.
+COMPRESSION_MIN_MAJOR_VERSION = 6
+
+ALIGN_REQUIREMENTS = 4096
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+ZERO_PAGE = bytes(ALIGN_REQUIREMENTS)
+
+BUNDLE_SEGMENT_NAME = b"__DOTNET_BUNDLE"
+VM_PROT_READ = 0x1
+
+BundleSource = Union[bytes, bytearray, mmap.mmap]
+
+
+class BundleReader(object):
+    data: memoryview
+    offset: int
+
+    def __init__(self, data: BundleSource, offset: int = 0) -> None:
+        self.data = memoryview(data)
+        self.offset = offset
+
+    def read(self, format: str) -> tuple:
+        res = struct.unpack_from(format, self.data, self.offset)
+        self.offset += struct.calcsize(format)
+
+        return res
+
+    def read_string(self) -> str:
+        first_byte = self.data[self.offset]
+
+        if (first_byte & 0x80) == 0:
+            size = first_byte
+            self.offset += 1
+        else:
+            second_byte = self.data[self.offset + 1]
+
+            assert (second_byte & 0x80) == 0
+
+            size = (second_byte << 7) | (first_byte & 0x7F)
+            self.offset += 2
+
+        res = str(self.data[self.offset : self.offset + size], "utf-8")
+        self.offset += size
+
+        return res
+
+
+def write_embedded_string(file, string: str):
+    raw_str = string.encode("utf-8")
+    raw_str_len = len(raw_str)
+
+    assert raw_str_len < 0x7FFF
+
+    if raw_str_len > 0x7F:
+        file.write(struct.pack("b", raw_str_len & 0x7F | 0x80))
+        file.write(struct.pack("b", raw_str_len >> 7))
+    else:
+        file.write(struct.pack("b", raw_str_len))
+
+    file.write(raw_str)
+
+
+def write_padding(file, size: int):
+    zero_page = memoryview(ZERO_PAGE)
+
+    while size > 0:
+        chunk_size = min(size, len(zero_page))
+        file.write(zero_page[:chunk_size])
+        size -= chunk_size
+
+
+def copy_file_data(source, source_offset: int, output, size: int):
+    # Let the kernel copy between the two files if possible.
+    output.flush()
+    source_fd = source.fileno()
+    output_fd = output.fileno()
+    output_offset = output.tell()
+
+    for copy_function in (
+        getattr(os, "copy_file_range", None),
+        getattr(os, "sendfile", None) if sys.platform == "linux" else None,
+    ):
+        if copy_function is None:
+            continue
+
+        try:
+            while size > 0:
+                if copy_function is os.sendfile:
+                    os.lseek(output_fd, output_offset, os.SEEK_SET)
+                    copied = os.sendfile(output_fd, source_fd, source_offset, size)
+                else:
+                    copied = copy_function(
+                        source_fd, output_fd, size, source_offset, output_offset
+                    )
+
+                if copied == 0:
+                    break
+
+                source_offset += copied
+                output_offset += copied
+                size -= copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+                raise
+
+        if size == 0:
+            break
+
+    output.seek(output_offset)
+
+    # Otherwise fallback to a bounded buffered copy.
+    if size > 0:
+        buffer = memoryview(bytearray(min(size, COPY_CHUNK_SIZE)))
+        source.seek(source_offset)
+
+        while size > 0:
+            chunk_size = source.readinto(buffer[: min(size, len(buffer))])
+
+            if not chunk_size:
+                raise Exception("Unexpected end of file while copying bundle data")
+
+            output.write(buffer[:chunk_size])
+            size -= chunk_size
+
+
+def get_padding_size(offset: int, alignment: int) -> int:
+    return (alignment - offset % alignment) % alignment
+
+
+def compress_entry_data(data: bytes, level: int) -> bytes:
+    # Raw deflate stream, as written by DeflateStream in the SDK bundler.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_entry_data(data: bytes, size: int) -> bytes:
+    res = zlib.decompress(data, -zlib.MAX_WBITS, size)
+
+    if len(res) != size:
+        raise Exception(f"Decompressed {len(res)} bytes but expected {size}")
+
+    return res
+
+
+class BundleFileEntry(object):
+    offset: int
+    size: int
+    compressed_size: int
+    file_type: int
+    relative_path: str
+    source: Optional[memoryview]
+    source_offset: int
+    duplicate_of: Optional["BundleFileEntry"]
+
+    def __init__(
+        self,
+        offset: int,
+        size: int,
+        compressed_size: int,
+        file_type: int,
+        relative_path: str,
+        data: Optional[bytes] = None,
+        source: Optional[memoryview] = None,
+    ) -> None:
+        self.offset = offset
+        self.size = size
+        self.compressed_size = compressed_size
+        self.file_type = file_type
+        self.relative_path = relative_path
+        self.source = source
+        self.source_offset = offset
+        self.duplicate_of = None
+        self._data = data
+
+    @property
+    def stored_size(self) -> int:
+        if self.compressed_size != 0:
+            return self.compressed_size
+
+        return self.size
+
+    @property
+    def needs_alignment(self) -> bool:
+        # Only uncompressed assemblies are mapped in place and need to be aligned.
+        return self.file_type == FILE_TYPE_ASSEMBLY and self.compressed_size == 0
+
+    @property
+    def data(self) -> Union[bytes, memoryview]:
+        # Payloads are only sliced out of the original file when needed.
+        if self._data is None:
+            return self.source[
+                self.source_offset : self.source_offset + self.stored_size
+            ]
+
+        return self._data
+
+    @data.setter
+    def data(self, value: bytes):
+        self._data = value
+
+    def write(self, file, source_file=None, alignment: int = ALIGN_REQUIREMENTS):
+        self.offset = file.tell()
+
+        if self.needs_alignment:
+            padding_size = get_padding_size(self.offset, alignment)
+            write_padding(file, padding_size)
+            self.offset += padding_size
+
+        if self._data is None and source_file is not None:
+            copy_file_data(source_file, self.source_offset, file, self.stored_size)
+        else:
+            file.write(self.data)
+
+    def write_header(self, file):
+        file.write(
+            struct.pack(
+                "QQQb", self.offset, self.size, self.compressed_size, self.file_type
+            )
+        )
+        write_embedded_string(file, self.relative_path)
+
+
+class BundleManifest(object):
+    major: int
+    minor: int
+    bundle_id: str
+    deps_json: BundleFileEntry
+    runtimeconfig_json: BundleFileEntry
+    flags: int
+    files: List[BundleFileEntry]
+    alignment: int
+    layout: Optional[List[BundleFileEntry]]
+
+    def __init__(
+        self,
+        major: int,
+        minor: int,
+        bundle_id: str,
+        deps_json: BundleFileEntry,
+        runtimeconfig_json: BundleFileEntry,
+        flags: int,
+        files: List[BundleFileEntry],
+    ) -> None:
+        self.major = major
+        self.minor = minor
+        self.bundle_id = bundle_id
+        self.deps_json = deps_json
+        self.runtimeconfig_json = runtimeconfig_json
+        self.flags = flags
+        self.files = files
+        self.alignment = ALIGN_REQUIREMENTS
+        self.layout = None
+
+    def write(self, file, source_file=None) -> int:
+        # Payloads are streamed from source_file when given, instead of the mapping.
+        # They are written in manifest order unless a layout was planned.
+        for bundle_file in self.layout or self.files:
+            if bundle_file.duplicate_of is None:
+                bundle_file.write(file, source_file, self.alignment)
+
+        # Duplicated entries point to the data of the first one.
+        for bundle_file in self.files:
+            if bundle_file.duplicate_of is not None:
+                bundle_file.offset = bundle_file.duplicate_of.offset
+
+        bundle_header_offset = file.tell()
+        file.write(struct.pack("iiI", self.major, self.minor, len(self.files)))
+        write_embedded_string(file, self.bundle_id)
+
+        if self.deps_json is not None:
+            deps_json_location_offset = self.deps_json.offset
+            deps_json_location_size = self.deps_json.size
+        else:
+            deps_json_location_offset = 0
+            deps_json_location_size = 0
+
+        if self.runtimeconfig_json is not None:
+            runtimeconfig_json_location_offset = self.runtimeconfig_json.offset
+            runtimeconfig_json_location_size = self.runtimeconfig_json.size
+        else:
+            runtimeconfig_json_location_offset = 0
+            runtimeconfig_json_location_size = 0
+
+        file.write(
+            struct.pack("qq", deps_json_location_offset, deps_json_location_size)
+        )
+        file.write(
+            struct.pack(
+                "qq",
+                runtimeconfig_json_location_offset,
+                runtimeconfig_json_location_size,
+            )
+        )
+        file.write(struct.pack("q", self.flags))
+
+        for bundle_file in self.files:
+            bundle_file.write_header(file)
+
+        return bundle_header_offset
+
+
+def get_bundle_base_offset(bundle: BundleManifest) -> int:
+    # Entries might not be laid out in manifest order.
+    return min(bundle_file.offset for bundle_file in bundle.files)
+
+
+def read_file_entry(reader: BundleReader) -> BundleFileEntry:
+    (
+        offset,
+        size,
+        compressed_size,
+        file_type,
+    ) = reader.read("QQQb")
+    relative_path = reader.read_string()
+
+    return BundleFileEntry(
+        offset,
+        size,
+        compressed_size,
+        file_type,
+        relative_path,
+        source=reader.data,
+    )
+
+
+def find_bundle_signature(data: BundleSource) -> int:
+    return data.find(BUNDLE_SIGNATURE)
+
+
+def get_dotnet_bundle_data(
+    data: BundleSource,
+) -> Optional[Tuple[int, int, BundleManifest]]:
+    offset = find_bundle_signature(data)
+
+    if offset == -1:
+        return None
+
+    (header_offset,) = struct.unpack_from("q", data, offset - 8)
+    reader = BundleReader(data, header_offset)
+
+    (
+        major,
+        minor,
+        files_count,
+    ) = reader.read("iiI")
+
+    bundle_id = reader.read_string()
+
+    # v2 header
+    (
+        deps_json_location_offset,
+        deps_json_location_size,
+    ) = reader.read("qq")
+    (
+        runtimeconfig_json_location_offset,
+        runtimeconfig_json_location_size,
+    ) = reader.read("qq")
+    (flags,) = reader.read("q")
+
+    files = []
+
+    deps_json = None
+    runtimeconfig_json = None
+
+    for _ in range(files_count):
+        file_entry = read_file_entry(reader)
+
+        files.append(file_entry)
+
+        if file_entry.offset == deps_json_location_offset:
+            deps_json = file_entry
+        elif file_entry.offset == runtimeconfig_json_location_offset:
+            runtimeconfig_json = file_entry
+
+    file_entry = files[0]
+
+    return (
+        file_entry.offset,
+        header_offset,
+        BundleManifest(
+            major, minor, bundle_id, deps_json, runtimeconfig_json, flags, files
+        ),
+    )
+
+
+def map_file(file) -> mmap.mmap:
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def fixup_linkedit(file, data: bytes, new_size: int):
+    offset = 0
+
+    (
+        macho_magic,
+        macho_cputype,
+        macho_cpusubtype,
+        macho_filetype,
+        macho_ncmds,
+        macho_sizeofcmds,
+        macho_flags,
+        macho_reserved,
+    ) = struct.unpack("IiiIIIII", data[offset : offset + 0x20])
+
+    offset += 0x20
+
+    linkedit_offset = None
+    symtab_offset = None
+    codesign_offset = None
+
+    for _ in range(macho_ncmds):
+        (cmd, cmdsize) = struct.unpack("II", data[offset : offset + 8])
+
+        if cmd == LC_SEGMENT_64:
+            (
+                cmd,
+                cmdsize,
+                segname_raw,
+                vmaddr,
+                vmsize,
+                fileoff,
+                filesize,
+                maxprot,
+                initprot,
+                nsects,
+                flags,
+            ) = struct.unpack("II16sQQQQiiII", data[offset : offset + 72])
+            segname = segname_raw.decode("utf-8").split("\0")[0]
+
+            if segname == "__LINKEDIT":
+                linkedit_offset = offset
+        elif cmd == LC_SYMTAB:
+            symtab_offset = offset
+        elif cmd == LC_CODE_SIGNATURE:
+            codesign_offset = offset
+
+        offset += cmdsize
+        pass
+
+    assert linkedit_offset is not None and symtab_offset is not None
+
+    # If there is a codesign section, clean it up.
+    if codesign_offset is not None:
+        (
+            codesign_cmd,
+            codesign_cmdsize,
+            codesign_dataoff,
+            codesign_datasize,
+        ) = struct.unpack("IIII", data[codesign_offset : codesign_offset + 16])
+        file.seek(codesign_offset)
+        write_padding(file, codesign_cmdsize)
+
+        macho_ncmds -= 1
+        macho_sizeofcmds -= codesign_cmdsize
+        file.seek(0)
+        file.write(
+            struct.pack(
+                "IiiIIIII",
+                macho_magic,
+                macho_cputype,
+                macho_cpusubtype,
+                macho_filetype,
+                macho_ncmds,
+                macho_sizeofcmds,
+                macho_flags,
+                macho_reserved,
+            )
+        )
+
+        # The new bundle can be written over the old signature, only clear what is left.
+        codesign_start = max(codesign_dataoff, new_size)
+        codesign_end = codesign_dataoff + codesign_datasize
+
+        if codesign_start < codesign_end:
+            file.seek(codesign_start)
+            write_padding(file, codesign_end - codesign_start)
+
+    (
+        symtab_cmd,
+        symtab_cmdsize,
+        symtab_symoff,
+        symtab_nsyms,
+        symtab_stroff,
+        symtab_strsize,
+    ) = struct.unpack("IIIIII", data[symtab_offset : symtab_offset + 24])
+
+    symtab_strsize = new_size - symtab_stroff
+
+    new_symtab = struct.pack(
+        "IIIIII",
+        symtab_cmd,
+        symtab_cmdsize,
+        symtab_symoff,
+        symtab_nsyms,
+        symtab_stroff,
+        symtab_strsize,
+    )
+
+    file.seek(symtab_offset)
+    file.write(new_symtab)
+
+    (
+        linkedit_cmd,
+        linkedit_cmdsize,
+        linkedit_segname_raw,
+        linkedit_vmaddr,
+        linkedit_vmsize,
+        linkedit_fileoff,
+        linkedit_filesize,
+        linkedit_maxprot,
+        linkedit_initprot,
+        linkedit_nsects,
+        linkedit_flags,
+    ) = struct.unpack("II16sQQQQiiII", data[linkedit_offset : linkedit_offset + 72])
+
+    linkedit_filesize = new_size - linkedit_fileoff
+    linkedit_vmsize = linkedit_filesize
+
+    new_linkedit = struct.pack(
+        "II16sQQQQiiII",
+        linkedit_cmd,
+        linkedit_cmdsize,
+        linkedit_segname_raw,
+        linkedit_vmaddr,
+        linkedit_vmsize,
+        linkedit_fileoff,
+        linkedit_filesize,
+        linkedit_maxprot,
+        linkedit_initprot,
+        linkedit_nsects,
+        linkedit_flags,
+    )
+    file.seek(linkedit_offset)
+    file.write(new_linkedit)
+
+
+def write_bundle_executable(
+    output,
+    data: BundleSource,
+    source_file,
+    bundle: BundleManifest,
+    bundle_base_offset: Optional[int] = None,
+) -> int:
+    # Once moved to its own segment, the bundle must stay there.
+    if has_bundle_segment(source_file, len(data)):
+        return write_bundle_segment_executable(
+            output, data, source_file, bundle, bundle_base_offset
+        )
+
+    # Everything before the bundle is kept as is, the bundle is then written back
+    # and the executable fixed up to cover it again.
+    if bundle_base_offset is None:
+        bundle_base_offset = get_bundle_base_offset(bundle)
+
+    copy_file_data(source_file, 0, output, bundle_base_offset)
+
+    bundle_header_offset = bundle.write(output, source_file)
+    new_size = output.tell()
+
+    output.seek(find_bundle_signature(data) - 8)
+    output.write(struct.pack("q", bundle_header_offset))
+
+    # The code signature is invalidated anyway, drop it if it was past the bundle.
+    fixup_linkedit(output, data, new_size)
+    output.truncate(new_size)
+
+    return new_size
+
+
+def has_bundle_segment(source_file, size: int) -> bool:
+    macho_slice = MachOSlice.parse(source_file, 0, size)
+
+    return macho_slice.get_segment_command(BUNDLE_SEGMENT_NAME) is not None
+
+
+def write_bundle_segment_executable(
+    output,
+    data: BundleSource,
+    source_file,
+    bundle: BundleManifest,
+    bundle_base_offset: Optional[int] = None,
+) -> int:
+    # The bundle gets its own segment right before __LINKEDIT instead of being
+    # appended to it, so that tools rewriting __LINKEDIT keep it intact.
+    macho_slice = MachOSlice.parse(source_file, 0, len(data))
+
+    if not macho_slice.is_64:
+        raise Exception("Only 64-bit executables are supported")
+
+    # Chained fixups describe every segment, adding one would require rewriting them.
+    if macho_slice.find_commands(LC_DYLD_CHAINED_FIXUPS):
+        raise Exception("Executables using chained fixups are not supported")
+
+    linkedit_command = macho_slice.get_segment_command(b"__LINKEDIT")
+    segment_command = macho_slice.get_segment_command(BUNDLE_SEGMENT_NAME)
+
+    if linkedit_command is None:
+        raise Exception("Missing __LINKEDIT segment")
+
+    (linkedit_vmaddr, _, linkedit_fileoff, linkedit_filesize) = struct.unpack(
+        "<QQQQ", linkedit_command.data[24:56]
+    )
+
+    if segment_command is not None:
+        (segment_vmaddr, _, segment_fileoff, _) = struct.unpack(
+            "<QQQQ", segment_command.data[24:56]
+        )
+        linkedit_end = linkedit_fileoff + linkedit_filesize
+    else:
+        if bundle_base_offset is None:
+            bundle_base_offset = get_bundle_base_offset(bundle)
+
+        if bundle_base_offset < linkedit_fileoff:
+            raise Exception("The bundle is not at the end of the executable")
+
+        # Everything before the bundle is the original __LINKEDIT content.
+        segment_vmaddr = linkedit_vmaddr
+        segment_fileoff = linkedit_fileoff
+        linkedit_end = bundle_base_offset
+        segment_command = MachOLoadCommand(LC_SEGMENT_64, b"")
+        macho_slice.commands.insert(
+            macho_slice.commands.index(linkedit_command), segment_command
+        )
+
+    # The code signature is invalidated anyway and always comes last.
+    for command in macho_slice.find_commands(LC_CODE_SIGNATURE):
+        (dataoff,) = struct.unpack("<I", command.data[8:12])
+        linkedit_end = min(linkedit_end, max(dataoff, linkedit_fileoff))
+        macho_slice.commands.remove(command)
+
+    page_size = get_page_size(macho_slice.cputype)
+
+    copy_file_data(source_file, 0, output, segment_fileoff)
+    bundle_header_offset = bundle.write(output, source_file)
+    new_linkedit_fileoff = align_up(output.tell(), page_size)
+    write_padding(output, new_linkedit_fileoff - output.tell())
+
+    new_linkedit_filesize = linkedit_end - linkedit_fileoff
+    copy_file_data(source_file, linkedit_fileoff, output, new_linkedit_filesize)
+    new_size = output.tell()
+
+    segment_size = new_linkedit_fileoff - segment_fileoff
+    segment_command.data = struct.pack(
+        "<II16sQQQQiiII",
+        LC_SEGMENT_64,
+        72,
+        BUNDLE_SEGMENT_NAME,
+        segment_vmaddr,
+        segment_size,
+        segment_fileoff,
+        segment_size,
+        VM_PROT_READ,
+        VM_PROT_READ,
+        0,
+        0,
+    )
+    linkedit_command.data = (
+        linkedit_command.data[:24]
+        + struct.pack(
+            "<QQQQ",
+            segment_vmaddr + segment_size,
+            align_up(new_linkedit_filesize, page_size),
+            new_linkedit_fileoff,
+            new_linkedit_filesize,
+        )
+        + linkedit_command.data[56:]
+    )
+    macho_slice.shift_linkedit_offsets(new_linkedit_fileoff - linkedit_fileoff)
+
+    # The string table was stretched over the bundle, bring it back to its content.
+    for command in macho_slice.find_commands(LC_SYMTAB):
+        (stroff, strsize) = struct.unpack("<II", command.data[16:24])
+        command.data = (
+            command.data[:20]
+            + struct.pack("<I", max(0, min(strsize, new_size - stroff)))
+            + command.data[24:]
+        )
+
+    output.seek(0)
+    output.write(macho_slice.build_header())
+
+    output.seek(find_bundle_signature(data) - 8)
+    output.write(struct.pack("q", bundle_header_offset))
+    output.truncate(new_size)
+
+    return new_size
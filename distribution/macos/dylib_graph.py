@@ -0,0 +1,370 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+from typing import Dict, Iterable, List, Optional, Set
+
+from bundle_fix_up import LIBRARY_SUFFIXES, SYSTEM_LIBRARY_PREFIXES, LibraryIndex
+from dotnet_bundle import get_dotnet_bundle_data, map_file
+from macho import MachOFile
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Report and prune the dylibs of an application bundle"
+)
+parser.add_argument("input_directory", help="Input directory (Application path)")
+parser.add_argument("executable_sub_path", help="Main executable sub path")
+parser.add_argument(
+    "--root",
+    action="append",
+    default=[],
+    help="Library loaded at runtime (dlopen, P/Invoke), by name or Contents sub path",
+)
+parser.add_argument("--roots-file", help="File listing one library root per line")
+parser.add_argument(
+    "--prune", action="store_true", help="Remove the unreachable libraries"
+)
+
+
+def get_native_assets(deps_json: dict) -> List[str]:
+    # Native assets of packages are what the runtime dlopen for P/Invoke.
+    res = []
+
+    for target in deps_json.get("targets", {}).values():
+        for library in target.values():
+            paths = list(library.get("native", {}).keys())
+            paths.extend(
+                path
+                for path, asset in library.get("runtimeTargets", {}).items()
+                if asset.get("assetType") == "native"
+            )
+
+            for path in paths:
+                name = os.path.basename(path)
+
+                if name not in res:
+                    res.append(name)
+
+    return res
+
+
+def get_bundle_native_assets(executable_path: Path) -> List[str]:
+    with open(executable_path, "rb") as file:
+        bundle_data = get_dotnet_bundle_data(map_file(file))
+
+    if bundle_data is None or bundle_data[2].deps_json is None:
+        return []
+
+    return get_native_assets(json.loads(bytes(bundle_data[2].deps_json.data)))
+
+
+def read_roots_file(path: str) -> List[str]:
+    with open(path, "r") as file:
+        lines = [line.strip() for line in file.read().splitlines()]
+
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+class DylibGraph(object):
+    content_directory: Path
+    executable_path: Path
+    library_index: LibraryIndex
+    search_path: List[Path]
+    roots: List[Path]
+    missing_roots: List[str]
+    dependencies: Dict[Path, List[Path]]
+    unresolved: Dict[Path, List[str]]
+
+    def __init__(
+        self,
+        content_directory: Path,
+        executable_path: Path,
+        library_index: LibraryIndex,
+    ) -> None:
+        self.content_directory = content_directory
+        self.executable_path = executable_path
+        self.library_index = library_index
+        self.search_path = [
+            executable_path.parent,
+            content_directory / "Frameworks",
+            content_directory / "Resources/lib",
+        ]
+        self.roots = []
+        self.missing_roots = []
+        self.dependencies = {}
+        self.unresolved = {}
+
+    @staticmethod
+    def build(
+        input_directory: Path, executable_sub_path: str, root_names: Iterable[str]
+    ) -> "DylibGraph":
+        content_directory = input_directory / "Contents"
+        executable_path = content_directory / executable_sub_path
+        res = DylibGraph(
+            content_directory,
+            executable_path,
+            LibraryIndex.build(content_directory),
+        )
+
+        res.add_root(executable_path)
+
+        for name in root_names:
+            if "/" in name:
+                path = content_directory / name
+                path = path if path.exists() else None
+            else:
+                path = res.library_index.find(name, res.search_path)
+
+            if path is None:
+                res.missing_roots.append(name)
+            else:
+                res.add_root(path)
+
+        return res
+
+    def add_root(self, path: Path):
+        # Symlinks are followed so that every library is only visited once.
+        path = path.resolve()
+
+        if path not in self.roots:
+            self.roots.append(path)
+
+        pending = [path]
+
+        while pending:
+            current = pending.pop()
+
+            if current in self.dependencies:
+                continue
+
+            self.dependencies[current] = []
+            search_path = [current.parent] + self.search_path
+
+            for dependency in MachOFile.open(current).get_dylib_dependencies():
+                if dependency.startswith(SYSTEM_LIBRARY_PREFIXES):
+                    continue
+
+                dependency_path = self.library_index.find(
+                    os.path.basename(dependency), search_path
+                )
+
+                if dependency_path is None:
+                    self.unresolved.setdefault(current, []).append(dependency)
+                    continue
+
+                dependency_path = dependency_path.resolve()
+
+                # Libraries depend on themselves through their install name.
+                if dependency_path == current:
+                    continue
+
+                self.dependencies[current].append(dependency_path)
+                pending.append(dependency_path)
+
+    def get_reachable(self) -> Set[Path]:
+        return set(self.dependencies.keys())
+
+    def get_unreachable(self) -> List[Path]:
+        reachable = self.get_reachable()
+
+        return [
+            path
+            for path in self.library_index.libraries
+            if path.resolve() not in reachable
+        ]
+
+    def get_dead_files(self) -> List[Path]:
+        # Symlinks to an unreachable library go away with it.
+        reachable = self.get_reachable()
+        res = []
+
+        for _, directory_files in self.library_index.directories.values():
+            for path in directory_files.values():
+                if (
+                    path.name.endswith(LIBRARY_SUFFIXES)
+                    and path.resolve() not in reachable
+                ):
+                    res.append(path)
+
+        return res
+
+    def find_cycles(self) -> List[List[Path]]:
+        # Tarjan's strongly connected components, without recursion.
+        index = {}
+        low_link = {}
+        stack = []
+        on_stack = set()
+        res = []
+
+        for start in self.dependencies:
+            if start in index:
+                continue
+
+            work = [(start, 0)]
+
+            while work:
+                (node, child_index) = work.pop()
+
+                if child_index == 0:
+                    index[node] = low_link[node] = len(index)
+                    stack.append(node)
+                    on_stack.add(node)
+
+                children = self.dependencies[node]
+
+                if child_index < len(children):
+                    work.append((node, child_index + 1))
+                    child = children[child_index]
+
+                    if child not in index:
+                        work.append((child, 0))
+                    elif child in on_stack:
+                        low_link[node] = min(low_link[node], index[child])
+
+                    continue
+
+                if low_link[node] == index[node]:
+                    component = []
+
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+
+                        if member == node:
+                            break
+
+                    if len(component) > 1:
+                        res.append(sorted(component))
+
+                if work:
+                    parent = work[-1][0]
+                    low_link[parent] = min(low_link[parent], low_link[node])
+
+        return res
+
+    def find_duplicates(self) -> List[List[Path]]:
+        groups: Dict[str, List[Path]] = {}
+
+        for path in self.library_index.libraries:
+            with open(path, "rb") as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+
+            groups.setdefault(f"sha256:{digest}", []).append(path)
+            groups.setdefault(f"name:{path.name}", []).append(path)
+
+        res = []
+
+        for paths in groups.values():
+            if len(paths) > 1 and sorted(paths) not in res:
+                res.append(sorted(paths))
+
+        return res
+
+    def get_report(self) -> str:
+        lines = []
+
+        def add_section(title: str, paths: List[Path]):
+            lines.append(f"{title}: {len(paths)}")
+
+            for path in paths:
+                lines.append(f"  {self.get_relative_path(path)}")
+
+        add_section("Roots", self.roots)
+        lines.append(f"Missing roots: {len(self.missing_roots)}")
+        lines.extend(f"  {name}" for name in self.missing_roots)
+
+        lines.append(f"Unresolved dependencies: {len(self.unresolved)}")
+
+        for path, dependencies in self.unresolved.items():
+            for dependency in dependencies:
+                lines.append(f"  {self.get_relative_path(path)} -> {dependency}")
+
+        add_section("Unreachable libraries", self.get_unreachable())
+
+        cycles = self.find_cycles()
+        lines.append(f"Cycles: {len(cycles)}")
+
+        for cycle in cycles:
+            lines.append("  " + ", ".join(self.get_relative_path(p) for p in cycle))
+
+        duplicates = self.find_duplicates()
+        lines.append(f"Duplicates: {len(duplicates)}")
+
+        for paths in duplicates:
+            lines.append("  " + ", ".join(self.get_relative_path(p) for p in paths))
+
+        return "\n".join(lines)
+
+    def get_relative_path(self, path: Path) -> str:
+        try:
+            return path.relative_to(self.content_directory.resolve()).as_posix()
+        except ValueError:
+            return path.relative_to(self.content_directory).as_posix()
+
+
+def prune_app_bundles(graphs: List[DylibGraph]) -> List[Path]:
+    # Bundles of different architectures are merged afterward, a library is kept
+    # as long as one of them needs it.
+    needed: Set[str] = set()
+
+    for graph in graphs:
+        needed.update(
+            path.relative_to(graph.content_directory).as_posix()
+            for path in graph.library_index.libraries
+            if path.resolve() in graph.get_reachable()
+        )
+
+    res = []
+
+    for graph in graphs:
+        for path in graph.get_dead_files():
+            relative_path = path.relative_to(graph.content_directory).as_posix()
+            target_path = path.resolve().relative_to(
+                graph.content_directory.resolve()
+            )
+
+            if relative_path not in needed and target_path.as_posix() not in needed:
+                os.remove(path)
+                res.append(path)
+
+    return res
+
+
+def get_roots(
+    executable_path: Path, root_names: List[str], roots_file: Optional[str]
+) -> List[str]:
+    res = get_bundle_native_assets(executable_path) + root_names
+
+    if roots_file is not None:
+        res.extend(read_roots_file(roots_file))
+
+    return res
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("dylib_graph")
+
+    input_directory = Path(args.input_directory)
+    root_names = get_roots(
+        input_directory / "Contents" / args.executable_sub_path,
+        args.root,
+        args.roots_file,
+    )
+
+    with build_trace.span("build dylib graph"):
+        graph = DylibGraph.build(input_directory, args.executable_sub_path, root_names)
+
+    print(graph.get_report())
+
+    if args.prune:
+        with build_trace.span("prune dylibs"):
+            removed_paths = prune_app_bundles([graph])
+
+        print(f"Removed {len(removed_paths)} files")
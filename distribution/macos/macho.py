@@ -0,0 +1,552 @@
+import shutil
+import struct
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+
+MH_EXECUTE = 0x2
+MH_DYLIB = 0x6
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_TYPE_X86 = 0x7
+CPU_TYPE_ARM = 0xC
+CPU_TYPE_X86_64 = CPU_TYPE_X86 | CPU_ARCH_ABI64
+CPU_TYPE_ARM64 = CPU_TYPE_ARM | CPU_ARCH_ABI64
+
+CPU_TYPE_NAMES = {CPU_TYPE_X86_64: "x86_64", CPU_TYPE_ARM64: "arm64"}
+
+LC_REQ_DYLD = 0x80000000
+
+LC_SEGMENT = 0x1
+LC_SYMTAB = 0x2
+LC_DYSYMTAB = 0xB
+LC_LOAD_DYLIB = 0xC
+LC_ID_DYLIB = 0xD
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_SEGMENT_64 = 0x19
+LC_RPATH = 0x1C | LC_REQ_DYLD
+LC_CODE_SIGNATURE = 0x1D
+LC_SEGMENT_SPLIT_INFO = 0x1E
+LC_REEXPORT_DYLIB = 0x1F | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_DYLD_INFO = 0x22
+LC_DYLD_INFO_ONLY = 0x22 | LC_REQ_DYLD
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+LC_FUNCTION_STARTS = 0x26
+LC_DATA_IN_CODE = 0x29
+LC_DYLIB_CODE_SIGN_DRS = 0x2B
+LC_LINKER_OPTIMIZATION_HINT = 0x2E
+LC_DYLD_EXPORTS_TRIE = 0x33 | LC_REQ_DYLD
+LC_DYLD_CHAINED_FIXUPS = 0x34 | LC_REQ_DYLD
+
+DYLIB_LOAD_COMMANDS = (
+    LC_LOAD_DYLIB,
+    LC_LOAD_WEAK_DYLIB,
+    LC_REEXPORT_DYLIB,
+    LC_LAZY_LOAD_DYLIB,
+    LC_LOAD_UPWARD_DYLIB,
+)
+
+# Offsets of the __LINKEDIT data referenced by each load command.
+LINKEDIT_OFFSET_FIELDS = {
+    LC_SYMTAB: (8, 16),
+    LC_DYSYMTAB: (32, 40, 48, 56, 64, 72),
+    LC_DYLD_INFO: (8, 16, 24, 32, 40),
+    LC_DYLD_INFO_ONLY: (8, 16, 24, 32, 40),
+    LC_CODE_SIGNATURE: (8,),
+    LC_SEGMENT_SPLIT_INFO: (8,),
+    LC_FUNCTION_STARTS: (8,),
+    LC_DATA_IN_CODE: (8,),
+    LC_DYLIB_CODE_SIGN_DRS: (8,),
+    LC_LINKER_OPTIMIZATION_HINT: (8,),
+    LC_DYLD_EXPORTS_TRIE: (8,),
+    LC_DYLD_CHAINED_FIXUPS: (8,),
+}
+
+# Sections that never occupy space in the file.
+S_ZEROFILL = 0x1
+S_GB_ZEROFILL = 0xC
+S_THREAD_LOCAL_ZEROFILL = 0x12
+SECTION_TYPE_MASK = 0xFF
+
+
+def align_up(value: int, alignment: int) -> int:
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+def read_magic(data: bytes) -> int:
+    if len(data) < 4:
+        return 0
+
+    (magic,) = struct.unpack(">I", data[:4])
+
+    if magic in (FAT_MAGIC, FAT_MAGIC_64):
+        return magic
+
+    (magic,) = struct.unpack("<I", data[:4])
+
+    return magic
+
+
+class MachOLoadCommand(object):
+    cmd: int
+    data: bytes
+
+    def __init__(self, cmd: int, data: bytes) -> None:
+        self.cmd = cmd
+        self.data = data
+
+    def get_string(self, field_offset: int) -> str:
+        (string_offset,) = struct.unpack(
+            "<I", self.data[field_offset : field_offset + 4]
+        )
+        raw_string = self.data[string_offset:]
+
+        return raw_string.split(b"\0", 1)[0].decode("utf-8")
+
+
+class MachOSlice(object):
+    offset: int
+    size: int
+    is_64: bool
+    cputype: int
+    cpusubtype: int
+    filetype: int
+    flags: int
+    reserved: int
+    commands: List[MachOLoadCommand]
+    header_size: int
+    commands_limit: int
+    original_commands_size: int
+    dirty: bool
+
+    def __init__(self, offset: int, size: int) -> None:
+        self.offset = offset
+        self.size = size
+        self.commands = []
+        self.dirty = False
+
+    @staticmethod
+    def parse(file, offset: int, size: int) -> "MachOSlice":
+        res = MachOSlice(offset, size)
+
+        file.seek(offset)
+        raw_header = file.read(0x20)
+        magic = read_magic(raw_header)
+
+        if magic == MH_MAGIC_64:
+            res.is_64 = True
+            res.header_size = 0x20
+            (
+                _,
+                res.cputype,
+                res.cpusubtype,
+                res.filetype,
+                ncmds,
+                sizeofcmds,
+                res.flags,
+                res.reserved,
+            ) = struct.unpack("<IiiIIIII", raw_header)
+        elif magic == MH_MAGIC:
+            res.is_64 = False
+            res.header_size = 0x1C
+            (
+                _,
+                res.cputype,
+                res.cpusubtype,
+                res.filetype,
+                ncmds,
+                sizeofcmds,
+                res.flags,
+            ) = struct.unpack("<IiiIIII", raw_header[:0x1C])
+            res.reserved = 0
+        else:
+            raise Exception(f"Unsupported Mach-O magic 0x{magic:08x} at {offset}")
+
+        file.seek(offset + res.header_size)
+        raw_commands = file.read(sizeofcmds)
+
+        if len(raw_commands) != sizeofcmds:
+            raise Exception("Truncated Mach-O load commands")
+
+        commands_offset = 0
+
+        for _ in range(ncmds):
+            (cmd, cmdsize) = struct.unpack(
+                "<II", raw_commands[commands_offset : commands_offset + 8]
+            )
+
+            if cmdsize < 8 or commands_offset + cmdsize > sizeofcmds:
+                raise Exception(f"Invalid Mach-O load command size {cmdsize}")
+
+            res.commands.append(
+                MachOLoadCommand(
+                    cmd, raw_commands[commands_offset : commands_offset + cmdsize]
+                )
+            )
+            commands_offset += cmdsize
+
+        res.original_commands_size = sizeofcmds
+        res.commands_limit = res.compute_commands_limit()
+
+        return res
+
+    def compute_commands_limit(self) -> int:
+        # Load commands can grow up to the first byte of file content.
+        limit = self.size
+
+        for command in self.commands:
+            if command.cmd == LC_SEGMENT_64:
+                (fileoff, filesize, nsects) = struct.unpack(
+                    "<QQ8xI", command.data[40:68]
+                )
+                section_format = "<16s16sQQIIIIIIII"
+                section_offset = 72
+            elif command.cmd == LC_SEGMENT:
+                (fileoff, filesize, nsects) = struct.unpack(
+                    "<II8xI", command.data[32:52]
+                )
+                section_format = "<16s16sIIIIIIIII"
+                section_offset = 56
+            else:
+                continue
+
+            if fileoff != 0 and filesize != 0:
+                limit = min(limit, fileoff)
+
+            section_size = struct.calcsize(section_format)
+
+            for _ in range(nsects):
+                section = struct.unpack(
+                    section_format,
+                    command.data[section_offset : section_offset + section_size],
+                )
+                section_file_offset = section[4]
+                section_flags = section[8]
+                section_type = section_flags & SECTION_TYPE_MASK
+
+                if section_file_offset != 0 and section_type not in (
+                    S_ZEROFILL,
+                    S_GB_ZEROFILL,
+                    S_THREAD_LOCAL_ZEROFILL,
+                ):
+                    limit = min(limit, section_file_offset)
+
+                section_offset += section_size
+
+        return limit
+
+    @property
+    def command_alignment(self) -> int:
+        return 8 if self.is_64 else 4
+
+    def find_commands(self, *cmds: int) -> List[MachOLoadCommand]:
+        return [command for command in self.commands if command.cmd in cmds]
+
+    def get_segment_command(self, name: bytes) -> Optional[MachOLoadCommand]:
+        for command in self.find_commands(LC_SEGMENT_64):
+            if command.data[8:24].split(b"\0", 1)[0] == name:
+                return command
+
+        return None
+
+    def shift_linkedit_offsets(self, delta: int):
+        for command in self.commands:
+            for field_offset in LINKEDIT_OFFSET_FIELDS.get(command.cmd, ()):
+                (value,) = struct.unpack_from("<I", command.data, field_offset)
+
+                # Unused tables have a zero offset.
+                if value != 0:
+                    command.data = (
+                        command.data[:field_offset]
+                        + struct.pack("<I", value + delta)
+                        + command.data[field_offset + 4 :]
+                    )
+
+        self.dirty = True
+
+    def get_dylib_id(self) -> Optional[str]:
+        for command in self.find_commands(LC_ID_DYLIB):
+            return command.get_string(8)
+
+        return None
+
+    def get_dylib_dependencies(self) -> List[str]:
+        return [
+            command.get_string(8)
+            for command in self.find_commands(*DYLIB_LOAD_COMMANDS)
+        ]
+
+    def get_rpaths(self) -> List[str]:
+        return [command.get_string(8) for command in self.find_commands(LC_RPATH)]
+
+    def build_string_command(self, header: bytes, string: str) -> bytes:
+        raw_string = string.encode("utf-8") + b"\0"
+        cmdsize = align_up(len(header) + len(raw_string), self.command_alignment)
+
+        return header + raw_string + b"\0" * (cmdsize - len(header) - len(raw_string))
+
+    def build_dylib_command(self, command: MachOLoadCommand, name: str) -> bytes:
+        (timestamp, current_version, compatibility_version) = struct.unpack(
+            "<III", command.data[12:24]
+        )
+        cmdsize = align_up(24 + len(name.encode("utf-8")) + 1, self.command_alignment)
+
+        return self.build_string_command(
+            struct.pack(
+                "<IIIIII",
+                command.cmd,
+                cmdsize,
+                24,
+                timestamp,
+                current_version,
+                compatibility_version,
+            ),
+            name,
+        )
+
+    def set_dylib_id(self, new_id: str):
+        for command in self.find_commands(LC_ID_DYLIB):
+            command.data = self.build_dylib_command(command, new_id)
+            self.dirty = True
+
+    def change_dylib_link(self, old: str, new: str):
+        for command in self.find_commands(*DYLIB_LOAD_COMMANDS):
+            if command.get_string(8) == old:
+                command.data = self.build_dylib_command(command, new)
+                self.dirty = True
+
+    def add_rpath(self, rpath: str):
+        if rpath in self.get_rpaths():
+            return
+
+        cmdsize = align_up(12 + len(rpath.encode("utf-8")) + 1, self.command_alignment)
+        data = self.build_string_command(
+            struct.pack("<III", LC_RPATH, cmdsize, 12), rpath
+        )
+        self.commands.append(MachOLoadCommand(LC_RPATH, data))
+        self.dirty = True
+
+    def build_header(self) -> bytes:
+        raw_commands = b"".join(command.data for command in self.commands)
+
+        if self.header_size + len(raw_commands) > self.commands_limit:
+            raise Exception(
+                f"Not enough header padding for load commands "
+                f"({self.header_size + len(raw_commands)} > {self.commands_limit})"
+            )
+
+        if self.is_64:
+            header = struct.pack(
+                "<IiiIIIII",
+                MH_MAGIC_64,
+                self.cputype,
+                self.cpusubtype,
+                self.filetype,
+                len(self.commands),
+                len(raw_commands),
+                self.flags,
+                self.reserved,
+            )
+        else:
+            header = struct.pack(
+                "<IiiIIII",
+                MH_MAGIC,
+                self.cputype,
+                self.cpusubtype,
+                self.filetype,
+                len(self.commands),
+                len(raw_commands),
+                self.flags,
+            )
+
+        # Clear whatever was left behind by longer, previous load commands.
+        padding_size = max(0, self.original_commands_size - len(raw_commands))
+
+        return header + raw_commands + b"\0" * padding_size
+
+
+class MachOFile(object):
+    path: Path
+    fat_magic: Optional[int]
+    slices: List[MachOSlice]
+
+    def __init__(
+        self, path: Path, fat_magic: Optional[int], slices: List[MachOSlice]
+    ) -> None:
+        self.path = path
+        self.fat_magic = fat_magic
+        self.slices = slices
+
+    @staticmethod
+    def open(path: Path) -> "MachOFile":
+        with open(path, "rb") as file:
+            magic = read_magic(file.read(4))
+            file.seek(0, 2)
+            file_size = file.tell()
+
+            if magic in (FAT_MAGIC, FAT_MAGIC_64):
+                slices = [
+                    MachOSlice.parse(file, offset, size)
+                    for (_, _, offset, size, _) in read_fat_archs(file)
+                ]
+
+                return MachOFile(path, magic, slices)
+
+            return MachOFile(path, None, [MachOSlice.parse(file, 0, file_size)])
+
+    @property
+    def is_fat(self) -> bool:
+        return self.fat_magic is not None
+
+    def get_dylib_id(self) -> Optional[str]:
+        for macho_slice in self.slices:
+            dylib_id = macho_slice.get_dylib_id()
+
+            if dylib_id is not None:
+                return dylib_id
+
+        return None
+
+    def get_dylib_dependencies(self) -> List[str]:
+        res = []
+
+        for macho_slice in self.slices:
+            for dependency in macho_slice.get_dylib_dependencies():
+                if dependency not in res:
+                    res.append(dependency)
+
+        return res
+
+    def get_rpaths(self) -> List[str]:
+        res = []
+
+        for macho_slice in self.slices:
+            for rpath in macho_slice.get_rpaths():
+                if rpath not in res:
+                    res.append(rpath)
+
+        return res
+
+    def set_dylib_id(self, new_id: str):
+        for macho_slice in self.slices:
+            macho_slice.set_dylib_id(new_id)
+
+    def change_dylib_link(self, old: str, new: str):
+        for macho_slice in self.slices:
+            macho_slice.change_dylib_link(old, new)
+
+    def add_rpath(self, rpath: str):
+        for macho_slice in self.slices:
+            macho_slice.add_rpath(rpath)
+
+    def write(self):
+        dirty_slices = [macho_slice for macho_slice in self.slices if macho_slice.dirty]
+
+        if not dirty_slices:
+            return
+
+        # Build every header first so a failure leaves the file untouched.
+        headers = [
+            (macho_slice, macho_slice.build_header()) for macho_slice in dirty_slices
+        ]
+
+        with open(self.path, "r+b") as file:
+            for macho_slice, header in headers:
+                file.seek(macho_slice.offset)
+                file.write(header)
+                macho_slice.original_commands_size = (
+                    len(header) - macho_slice.header_size
+                )
+                macho_slice.dirty = False
+
+
+def read_fat_archs(file) -> List[Tuple[int, int, int, int, int]]:
+    file.seek(0)
+    (magic, nfat_arch) = struct.unpack(">II", file.read(8))
+
+    res = []
+
+    for _ in range(nfat_arch):
+        if magic == FAT_MAGIC_64:
+            (cputype, cpusubtype, offset, size, align, _) = struct.unpack(
+                ">iiQQII", file.read(32)
+            )
+        else:
+            (cputype, cpusubtype, offset, size, align) = struct.unpack(
+                ">iiIII", file.read(20)
+            )
+
+        res.append((cputype, cpusubtype, offset, size, align))
+
+    return res
+
+
+def is_fat_file(path: Path) -> bool:
+    with open(path, "rb") as file:
+        return read_magic(file.read(4)) in (FAT_MAGIC, FAT_MAGIC_64)
+
+
+def get_fat_alignment(cputype: int) -> int:
+    # Same slice alignment as lipo, the page size of the target.
+    if cputype in (CPU_TYPE_ARM, CPU_TYPE_ARM64):
+        return 14
+
+    return 12
+
+
+def get_page_size(cputype: int) -> int:
+    return 1 << get_fat_alignment(cputype)
+
+
+def write_fat_file(output_path: Path, input_paths: List[Path]):
+    archs = []
+
+    for input_path in input_paths:
+        with open(input_path, "rb") as file:
+            raw_header = file.read(12)
+            file.seek(0, 2)
+            size = file.tell()
+
+        if read_magic(raw_header) not in (MH_MAGIC, MH_MAGIC_64):
+            raise Exception(f"{input_path} is not a thin Mach-O file")
+
+        (cputype, cpusubtype) = struct.unpack("<ii", raw_header[4:12])
+        archs.append(
+            (get_fat_alignment(cputype), cputype, cpusubtype, size, input_path)
+        )
+
+    if len({arch[1:3] for arch in archs}) != len(archs):
+        raise Exception(f"Duplicate architectures in {input_paths}")
+
+    archs.sort(key=lambda arch: (arch[0], arch[1]))
+
+    fat_archs = []
+    offset = 8 + len(archs) * 20
+
+    for align, cputype, cpusubtype, size, input_path in archs:
+        offset = align_up(offset, 1 << align)
+        fat_archs.append((cputype, cpusubtype, offset, size, align, input_path))
+        offset += size
+
+    if offset > 0xFFFFFFFF:
+        raise Exception(f"{output_path} is too big for a 32-bit fat header")
+
+    with open(output_path, "wb") as output:
+        output.write(struct.pack(">II", FAT_MAGIC, len(fat_archs)))
+
+        for cputype, cpusubtype, offset, size, align, _ in fat_archs:
+            output.write(
+                struct.pack(">iiIII", cputype, cpusubtype, offset, size, align)
+            )
+
+        # Seeking past the end leaves zeros behind for the alignment padding.
+        for _, _, offset, _, _, input_path in fat_archs:
+            output.seek(offset)
+
+            with open(input_path, "rb") as input:
+                shutil.copyfileobj(input, output, 1024 * 1024)
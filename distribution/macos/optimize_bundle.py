@@ -0,0 +1,437 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from dotnet_bundle import (
+    COMPRESSION_MIN_MAJOR_VERSION,
+    FILE_TYPE_ASSEMBLY,
+    UNCOMPRESSED_FILE_TYPES,
+    BundleFileEntry,
+    BundleManifest,
+    compress_entry_data,
+    decompress_entry_data,
+    get_bundle_base_offset,
+    get_dotnet_bundle_data,
+    get_padding_size,
+    map_file,
+    write_bundle_executable,
+    write_bundle_segment_executable,
+)
+from macho import MachOFile, get_page_size
+
+parser = argparse.ArgumentParser(
+    description="Optimize the .NET single-file bundle embedded in an executable"
+)
+parser.add_argument("executable_path", help="Executable containing the bundle")
+parser.add_argument(
+    "--output", help="Output executable path (defaults to rewriting the input)"
+)
+parser.add_argument(
+    "--compress",
+    action="store_true",
+    help="Deflate compress eligible entries (everything but assemblies by default)",
+)
+parser.add_argument(
+    "--compress-assemblies",
+    action="store_true",
+    help="Also compress assemblies, they are then loaded from memory at startup",
+)
+parser.add_argument(
+    "--decompress",
+    action="store_true",
+    help="Decompress every compressed entry for a faster startup",
+)
+parser.add_argument("--level", type=int, default=9, help="Compression level")
+parser.add_argument(
+    "--dedupe",
+    action="store_true",
+    help="Store the data of identical entries only once",
+)
+parser.add_argument(
+    "--layout",
+    action="store_true",
+    help="Align assemblies to the target page size and pack small entries into "
+    "the alignment padding",
+)
+parser.add_argument(
+    "--alignment",
+    type=int,
+    help="Assembly alignment used by --layout (defaults to the target page size)",
+)
+parser.add_argument(
+    "--startup-order",
+    help="File listing the bundle paths of the assemblies loaded at startup, one per "
+    "line, to lay them out first and contiguously",
+)
+parser.add_argument(
+    "--segment",
+    action="store_true",
+    help="Move the bundle into a dedicated __DOTNET_BUNDLE segment ahead of "
+    "__LINKEDIT so that Mach-O tools preserve it",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of entries to process in parallel",
+)
+
+EntryResult = Tuple[BundleFileEntry, int, Optional[bytes], float]
+
+
+def compress_entry(bundle_file: BundleFileEntry, level: int) -> EntryResult:
+    compressed_data = compress_entry_data(bundle_file.data, level)
+
+    # Like the SDK, only keep the compressed data if it is smaller.
+    if len(compressed_data) >= bundle_file.size:
+        return (bundle_file, bundle_file.size, None, 0)
+
+    start_time = time.perf_counter()
+    decompress_entry_data(compressed_data, bundle_file.size)
+    inflate_time = time.perf_counter() - start_time
+
+    return (bundle_file, len(compressed_data), compressed_data, inflate_time)
+
+
+def decompress_entry(bundle_file: BundleFileEntry) -> EntryResult:
+    start_time = time.perf_counter()
+    data = decompress_entry_data(bundle_file.data, bundle_file.size)
+    inflate_time = time.perf_counter() - start_time
+
+    return (bundle_file, bundle_file.size, data, inflate_time)
+
+
+def compress_bundle(
+    bundle: BundleManifest, compress_assemblies: bool, level: int, jobs: int
+) -> List[EntryResult]:
+    if bundle.major < COMPRESSION_MIN_MAJOR_VERSION:
+        raise Exception(f"Bundle version {bundle.major} does not support compression")
+
+    bundle_files = [
+        bundle_file
+        for bundle_file in bundle.files
+        if bundle_file.compressed_size == 0
+        and bundle_file.file_type not in UNCOMPRESSED_FILE_TYPES
+        and (compress_assemblies or bundle_file.file_type != FILE_TYPE_ASSEMBLY)
+    ]
+
+    # zlib releases the GIL, entries are compressed in parallel.
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(
+            executor.map(lambda entry: compress_entry(entry, level), bundle_files)
+        )
+
+    for bundle_file, stored_size, data, _ in results:
+        if data is not None:
+            bundle_file.data = data
+            bundle_file.compressed_size = stored_size
+
+    return results
+
+
+def decompress_bundle(bundle: BundleManifest, jobs: int) -> List[EntryResult]:
+    bundle_files = [
+        bundle_file for bundle_file in bundle.files if bundle_file.compressed_size != 0
+    ]
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = [
+            (bundle_file, bundle_file.compressed_size, data, inflate_time)
+            for (bundle_file, _, data, inflate_time) in executor.map(
+                decompress_entry, bundle_files
+            )
+        ]
+
+    for bundle_file, _, data, _ in results:
+        bundle_file.data = data
+        bundle_file.compressed_size = 0
+
+    return results
+
+
+def print_compression_report(results: List[EntryResult], decompress: bool):
+    # Every compressed entry has to be inflated in memory when the app starts.
+    rows = []
+
+    for bundle_file, stored_size, data, inflate_time in results:
+        if decompress:
+            (old_size, new_size) = (stored_size, bundle_file.size)
+        else:
+            (old_size, new_size) = (bundle_file.size, stored_size)
+
+        rows.append((old_size - new_size, new_size, inflate_time, bundle_file))
+
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    print(f"{'Saved':>12} {'Stored':>12} {'Inflate':>10}  Entry")
+
+    for saved_size, stored_size, inflate_time, bundle_file in rows:
+        print(
+            f"{saved_size:>12} {stored_size:>12} {inflate_time * 1000:>8.2f}ms  "
+            f"{bundle_file.relative_path}"
+        )
+
+    total_saved_size = sum(row[0] for row in rows)
+    total_inflate_time = sum(row[2] for row in rows)
+
+    if decompress:
+        print(
+            f"Decompressed {len(rows)} entries: {-total_saved_size} bytes larger, "
+            f"{total_inflate_time * 1000:.1f}ms less inflating at startup"
+        )
+    else:
+        compressed_count = len([row for row in rows if row[0] > 0])
+        print(
+            f"Compressed {compressed_count} of {len(rows)} entries: "
+            f"{total_saved_size} bytes saved, "
+            f"{total_inflate_time * 1000:.1f}ms more inflating at startup"
+        )
+
+
+def get_entry_digest(bundle_file: BundleFileEntry) -> bytes:
+    return hashlib.sha256(bundle_file.data).digest()
+
+
+def dedupe_bundle(bundle: BundleManifest, jobs: int) -> int:
+    # hashlib releases the GIL on large buffers, entries are hashed in parallel.
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        digests = list(executor.map(get_entry_digest, bundle.files))
+
+    # Aligned entries can only share data with other aligned entries.
+    unique_files: Dict[tuple, BundleFileEntry] = {}
+    duplicates: Dict[int, List[BundleFileEntry]] = {}
+
+    for bundle_file, digest in zip(bundle.files, digests):
+        key = (
+            digest,
+            bundle_file.size,
+            bundle_file.compressed_size,
+            bundle_file.needs_alignment,
+        )
+        unique_file = unique_files.setdefault(key, bundle_file)
+
+        if unique_file is not bundle_file:
+            bundle_file.duplicate_of = unique_file
+            duplicates.setdefault(id(unique_file), [unique_file]).append(bundle_file)
+
+    saved_size = 0
+
+    for bundle_files in duplicates.values():
+        group_saved_size = bundle_files[0].stored_size * (len(bundle_files) - 1)
+        saved_size += group_saved_size
+        print(
+            f"{group_saved_size:>12}  "
+            + ", ".join(bundle_file.relative_path for bundle_file in bundle_files)
+        )
+
+    duplicate_count = sum(len(bundle_files) - 1 for bundle_files in duplicates.values())
+    print(f"Dedupe: {duplicate_count} duplicate entries, {saved_size} bytes saved")
+
+    return saved_size
+
+
+def get_stored_files(bundle: BundleManifest) -> List[BundleFileEntry]:
+    return [
+        bundle_file for bundle_file in bundle.files if bundle_file.duplicate_of is None
+    ]
+
+
+def get_layout_padding(
+    layout: List[BundleFileEntry], start_offset: int, alignment: int
+) -> int:
+    offset = start_offset
+    padding_size = 0
+
+    for bundle_file in layout:
+        if bundle_file.duplicate_of is not None:
+            continue
+
+        if bundle_file.needs_alignment:
+            entry_padding_size = get_padding_size(offset, alignment)
+            padding_size += entry_padding_size
+            offset += entry_padding_size
+
+        offset += bundle_file.stored_size
+
+    return padding_size
+
+
+def read_startup_order(path: str) -> List[str]:
+    with open(path, "r") as file:
+        lines = [line.strip() for line in file.read().splitlines()]
+
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def plan_layout(
+    bundle: BundleManifest,
+    start_offset: int,
+    alignment: int,
+    startup_order: List[str],
+) -> List[BundleFileEntry]:
+    startup_index = {path: index for (index, path) in enumerate(startup_order)}
+
+    for path in startup_order:
+        if not any(bundle_file.relative_path == path for bundle_file in bundle.files):
+            print(f"Warning: {path} from the startup order is not in the bundle")
+
+    # Assemblies loaded at startup go first so readahead picks them up together,
+    # the sort being stable the others keep their manifest order.
+    aligned_files = sorted(
+        [
+            bundle_file
+            for bundle_file in get_stored_files(bundle)
+            if bundle_file.needs_alignment
+        ],
+        key=lambda bundle_file: startup_index.get(
+            bundle_file.relative_path, len(startup_index)
+        ),
+    )
+    other_files = [
+        bundle_file
+        for bundle_file in get_stored_files(bundle)
+        if not bundle_file.needs_alignment
+    ]
+    remaining_files = sorted(
+        other_files, key=lambda bundle_file: bundle_file.stored_size, reverse=True
+    )
+
+    layout = []
+    offset = start_offset
+
+    for aligned_file in aligned_files:
+        gap_size = get_padding_size(offset, alignment)
+
+        # Best fit decreasing, the largest entries that still fit go first.
+        if gap_size != 0:
+            for bundle_file in list(remaining_files):
+                if bundle_file.stored_size <= gap_size:
+                    layout.append(bundle_file)
+                    remaining_files.remove(bundle_file)
+                    offset += bundle_file.stored_size
+                    gap_size -= bundle_file.stored_size
+
+        layout.append(aligned_file)
+        offset += gap_size + aligned_file.stored_size
+
+    packed_files = set(id(bundle_file) for bundle_file in layout)
+    layout.extend(
+        bundle_file
+        for bundle_file in other_files
+        if id(bundle_file) not in packed_files
+    )
+
+    return layout
+
+
+def optimize_layout(bundle: BundleManifest, alignment: int, startup_order: List[str]):
+    start_offset = get_bundle_base_offset(bundle)
+    old_padding_size = get_layout_padding(
+        bundle.layout or bundle.files, start_offset, bundle.alignment
+    )
+
+    layout = plan_layout(bundle, start_offset, alignment, startup_order)
+    new_padding_size = get_layout_padding(layout, start_offset, alignment)
+
+    # Without small entries to pack, the current order might already be as good.
+    if (
+        not startup_order
+        and alignment == bundle.alignment
+        and new_padding_size >= old_padding_size
+    ):
+        print(f"Layout: keeping the current layout ({old_padding_size} bytes padding)")
+        return
+
+    bundle.layout = layout
+    bundle.alignment = alignment
+
+    print(
+        f"Layout: {alignment} bytes alignment, padding went from {old_padding_size} "
+        f"to {new_padding_size} bytes"
+    )
+
+
+def get_target_alignment(executable_path: Path) -> int:
+    macho_file = MachOFile.open(executable_path)
+
+    if macho_file.is_fat:
+        raise Exception(f"{executable_path} is not a thin executable")
+
+    return get_page_size(macho_file.slices[0].cputype)
+
+
+def rewrite_executable(
+    executable_path: Path, output_path: Path, transform, segment: bool = False
+):
+    with open(executable_path, "rb") as source_file:
+        data = map_file(source_file)
+        bundle_data = get_dotnet_bundle_data(data)
+
+        if bundle_data is None:
+            raise Exception(f"{executable_path} does not contain a .NET bundle")
+
+        # Entries might be replaced, the bundle starts where the original one did.
+        (_, _, bundle) = bundle_data
+        bundle_base_offset = get_bundle_base_offset(bundle)
+        transform(bundle)
+
+        # Write to a temporary file first, the output might be the input.
+        (fd, temp_path) = tempfile.mkstemp(
+            dir=output_path.parent, prefix=f".{output_path.name}."
+        )
+
+        try:
+            with os.fdopen(fd, "w+b") as output:
+                write_executable = write_bundle_executable
+
+                if segment:
+                    write_executable = write_bundle_segment_executable
+
+                write_executable(output, data, source_file, bundle, bundle_base_offset)
+
+            shutil.copymode(executable_path, temp_path)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            raise
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.compress and args.decompress:
+        raise Exception("--compress and --decompress are mutually exclusive")
+
+    executable_path = Path(args.executable_path)
+    output_path = Path(args.output or args.executable_path)
+
+    def transform(bundle: BundleManifest):
+        if args.compress or args.compress_assemblies:
+            results = compress_bundle(
+                bundle, args.compress_assemblies, args.level, args.jobs
+            )
+            print_compression_report(results, False)
+        elif args.decompress:
+            results = decompress_bundle(bundle, args.jobs)
+            print_compression_report(results, True)
+
+        if args.dedupe:
+            dedupe_bundle(bundle, args.jobs)
+
+        # The layout depends on which entries are compressed, it must come last.
+        if args.layout:
+            optimize_layout(
+                bundle,
+                args.alignment or get_target_alignment(executable_path),
+                read_startup_order(args.startup_order) if args.startup_order else [],
+            )
+
+    rewrite_executable(executable_path, output_path, transform, args.segment)
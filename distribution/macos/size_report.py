@@ -0,0 +1,345 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import struct
+import sys
+import tempfile
+import zlib
+from typing import Dict, List, Tuple
+
+from dotnet_bundle import get_dotnet_bundle_data, map_file
+from macho import (
+    CPU_TYPE_NAMES,
+    FAT_MAGIC,
+    FAT_MAGIC_64,
+    LC_SEGMENT,
+    LC_SEGMENT_64,
+    MH_DYLIB,
+    MH_EXECUTE,
+    MH_MAGIC,
+    MH_MAGIC_64,
+    MachOFile,
+    MachOSlice,
+    read_magic,
+)
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
+from release_delta import extract_release  # noqa: E402
+
+REPORT_VERSION = 1
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+parser = argparse.ArgumentParser(
+    description="Break down the size of a release and compare it to another one"
+)
+parser.add_argument(
+    "release", help="Application bundle, release archive or JSON report"
+)
+parser.add_argument(
+    "--compare", help="Previous application bundle, release archive or JSON report"
+)
+parser.add_argument("--output", help="Write the JSON report (or diff) to this path")
+parser.add_argument(
+    "--limit", type=int, default=20, help="Number of rows printed per category"
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files to compress in parallel",
+)
+
+
+def add_row(rows: List[dict], category: str, name: str, size: int, **extra):
+    row = {"category": category, "name": name, "size": size}
+    row.update(extra)
+    rows.append(row)
+
+
+def get_arch_name(macho_slice: MachOSlice) -> str:
+    return CPU_TYPE_NAMES.get(macho_slice.cputype, f"cpu{macho_slice.cputype:#x}")
+
+
+def get_segments(macho_slice: MachOSlice) -> List[Tuple[str, int, int]]:
+    res = []
+
+    for command in macho_slice.find_commands(LC_SEGMENT_64, LC_SEGMENT):
+        if command.cmd == LC_SEGMENT_64:
+            (segname, _, _, fileoff, filesize) = struct.unpack_from(
+                "<16sQQQQ", command.data, 8
+            )
+        else:
+            (segname, _, _, fileoff, filesize) = struct.unpack_from(
+                "<16sIIII", command.data, 8
+            )
+
+        res.append((segname.split(b"\0", 1)[0].decode("utf-8"), fileoff, filesize))
+
+    return res
+
+
+def add_bundle_rows(rows: List[dict], name: str, data: bytes):
+    bundle_data = get_dotnet_bundle_data(data)
+
+    if bundle_data is None:
+        return
+
+    (_, _, bundle) = bundle_data
+    end_offset = None
+    padding_size = 0
+
+    # Every entry is counted once, gaps between them are alignment padding.
+    for entry in sorted(bundle.files, key=lambda entry: entry.offset):
+        if end_offset is not None and entry.offset < end_offset:
+            continue
+
+        if end_offset is not None:
+            padding_size += entry.offset - end_offset
+
+        add_row(
+            rows,
+            "bundle_entry",
+            f"{name} {entry.relative_path}",
+            entry.stored_size,
+            uncompressed_size=entry.size,
+        )
+        end_offset = entry.offset + entry.stored_size
+
+    add_row(rows, "padding", f"{name} .NET bundle", padding_size)
+
+
+def add_macho_rows(rows: List[dict], path: Path, name: str, data) -> str:
+    macho_file = MachOFile.open(path)
+    kind = "macho"
+
+    if macho_file.is_fat:
+        add_row(
+            rows,
+            "padding",
+            f"{name} [fat]",
+            len(data) - sum(macho_slice.size for macho_slice in macho_file.slices),
+        )
+
+    for macho_slice in macho_file.slices:
+        slice_name = f"{name} [{get_arch_name(macho_slice)}]"
+        add_row(rows, "arch", slice_name, macho_slice.size)
+        add_row(
+            rows,
+            "padding",
+            f"{slice_name} load commands",
+            macho_slice.commands_limit
+            - macho_slice.header_size
+            - macho_slice.original_commands_size,
+        )
+
+        for segment_name, _, filesize in get_segments(macho_slice):
+            if filesize != 0:
+                add_row(rows, "segment", f"{slice_name} {segment_name}", filesize)
+
+        if macho_slice.filetype == MH_DYLIB:
+            kind = "dylib"
+        elif macho_slice.filetype == MH_EXECUTE:
+            kind = "executable"
+            slice_data = data
+
+            # Bundle offsets are relative to the slice.
+            if macho_file.is_fat:
+                slice_data = data[
+                    macho_slice.offset : macho_slice.offset + macho_slice.size
+                ]
+
+            add_bundle_rows(rows, slice_name, slice_data)
+
+    return kind
+
+
+def get_compressed_size(data) -> int:
+    compressor = zlib.compressobj(9)
+    view = memoryview(data)
+    res = 0
+
+    for offset in range(0, len(view), COMPRESS_BLOCK_SIZE):
+        res += len(compressor.compress(view[offset : offset + COMPRESS_BLOCK_SIZE]))
+
+    return res + len(compressor.flush())
+
+
+def scan_file(path: Path, name: str) -> List[dict]:
+    rows = []
+
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            data = b""
+        else:
+            data = map_file(file)
+
+    kind = "other"
+
+    if read_magic(data[:4]) in (MH_MAGIC, MH_MAGIC_64, FAT_MAGIC, FAT_MAGIC_64):
+        kind = add_macho_rows(rows, path, name, data)
+
+    # Files are compressed on their own, this closely estimates what each of them
+    # adds to the .tar.gz.
+    add_row(
+        rows,
+        "file",
+        name,
+        len(data),
+        compressed_size=get_compressed_size(data),
+        kind=kind,
+    )
+
+    return rows
+
+
+def create_report(root: Path, jobs: int) -> dict:
+    paths = []
+
+    for directory, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = Path(directory) / file_name
+
+            if not path.is_symlink():
+                paths.append(path)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(
+            executor.map(
+                lambda path: scan_file(path, path.relative_to(root).as_posix()),
+                sorted(paths),
+            )
+        )
+
+    rows = [row for result in results for row in result]
+    kinds: Dict[str, List[int]] = {}
+
+    for row in rows:
+        if row["category"] == "file":
+            totals = kinds.setdefault(row["kind"], [0, 0])
+            totals[0] += row["size"]
+            totals[1] += row["compressed_size"]
+
+    for kind, (size, compressed_size) in kinds.items():
+        add_row(rows, "kind", kind, size, compressed_size=compressed_size)
+
+    file_rows = [row for row in rows if row["category"] == "file"]
+
+    return {
+        "version": REPORT_VERSION,
+        "name": root.name,
+        "total_size": sum(row["size"] for row in file_rows),
+        "compressed_size": sum(row["compressed_size"] for row in file_rows),
+        "rows": rows,
+    }
+
+
+def load_report(path: Path, jobs: int) -> dict:
+    if path.suffix == ".json":
+        with open(path, "r") as file:
+            report = json.load(file)
+
+        if report.get("version") != REPORT_VERSION:
+            raise Exception(f"{path}: unsupported report version")
+
+        return report
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        with build_trace.span("scan release", path=str(path)):
+            report = create_report(extract_release(path, temp_directory), jobs)
+
+    if path.is_file():
+        report["archive_size"] = os.path.getsize(path)
+
+    return report
+
+
+def diff_reports(old_report: dict, new_report: dict) -> dict:
+    old_rows = {(row["category"], row["name"]): row for row in old_report["rows"]}
+    new_rows = {(row["category"], row["name"]): row for row in new_report["rows"]}
+    rows = []
+
+    for key in sorted(set(old_rows.keys()) | set(new_rows.keys())):
+        old_size = old_rows[key]["size"] if key in old_rows else 0
+        new_size = new_rows[key]["size"] if key in new_rows else 0
+
+        if old_size != new_size:
+            add_row(
+                rows,
+                key[0],
+                key[1],
+                new_size - old_size,
+                old_size=old_size,
+                new_size=new_size,
+            )
+
+    res = {"version": REPORT_VERSION, "rows": rows}
+
+    for key in ("total_size", "compressed_size", "archive_size"):
+        if key in old_report and key in new_report:
+            res[key] = new_report[key] - old_report[key]
+
+    return res
+
+
+def format_size(value: int) -> str:
+    return f"{value / 1024:,.1f} KiB"
+
+
+def format_report(report: dict, limit: int, is_diff: bool) -> str:
+    lines = []
+
+    for key in ("total_size", "compressed_size", "archive_size"):
+        if key in report:
+            value = report[key]
+            sign = "+" if is_diff and value > 0 else ""
+            lines.append(f"{key}: {sign}{format_size(value)}")
+
+    categories: Dict[str, List[dict]] = {}
+
+    for row in report["rows"]:
+        categories.setdefault(row["category"], []).append(row)
+
+    for category, rows in categories.items():
+        rows.sort(key=lambda row: abs(row["size"]), reverse=True)
+        total = sum(row["size"] for row in rows)
+
+        lines.append("")
+        lines.append(f"{category} ({len(rows)} rows, {format_size(total)})")
+
+        for row in rows[:limit]:
+            if is_diff:
+                details = (
+                    f"{format_size(row['old_size'])} -> {format_size(row['new_size'])}"
+                )
+                size = ("+" if row["size"] > 0 else "") + format_size(row["size"])
+            else:
+                details = ""
+                size = format_size(row["size"])
+
+                if "compressed_size" in row:
+                    details = f"{format_size(row['compressed_size'])} compressed"
+
+            lines.append(f"  {size:>14} {details:>30}  {row['name']}")
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("size_report")
+
+    report = load_report(Path(args.release), args.jobs)
+    is_diff = args.compare is not None
+
+    if is_diff:
+        report = diff_reports(load_report(Path(args.compare), args.jobs), report)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    print(format_report(report, args.limit, is_diff))
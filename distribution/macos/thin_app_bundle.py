@@ -0,0 +1,233 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import struct
+import sys
+from typing import List, Optional
+
+from codesign import get_file_identifier, is_macho_file, sign_bundle, sign_file
+from dotnet_bundle import (
+    copy_file_data,
+    find_bundle_signature,
+    get_dotnet_bundle_data,
+    map_file,
+)
+from macho import (
+    CPU_TYPE_ARM64,
+    CPU_TYPE_X86_64,
+    FAT_MAGIC,
+    FAT_MAGIC_64,
+    MH_MAGIC,
+    MH_MAGIC_64,
+    read_fat_archs,
+    read_magic,
+)
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+from add_tar_exec import create_tar  # noqa: E402
+import build_trace  # noqa: E402
+
+ARCHITECTURES = {"arm64": CPU_TYPE_ARM64, "x64": CPU_TYPE_X86_64}
+
+parser = argparse.ArgumentParser(
+    description="Extract per-architecture packages from a universal application"
+)
+parser.add_argument(
+    "input_directory", help="Universal application bundle or publish directory"
+)
+parser.add_argument(
+    "output_directory", help="Output directory, receiving one directory per arch"
+)
+parser.add_argument(
+    "--arch",
+    action="append",
+    choices=ARCHITECTURES.keys(),
+    help="Architecture to extract, all of them by default",
+)
+parser.add_argument(
+    "--tar-name",
+    help="Also create a tarball for each arch, {arch} is replaced by its name",
+)
+parser.add_argument(
+    "--executable-sub-path",
+    action="append",
+    default=[],
+    help="Executable sub path forced to be executable in the tarball",
+)
+parser.add_argument(
+    "--sign", action="store_true", help="Ad-hoc sign the extracted packages again"
+)
+parser.add_argument("--entitlements", help="Entitlements plist of the main executable")
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files to process in parallel",
+)
+
+
+def check_dotnet_bundle(path: Path):
+    # Slices are copied as is, the bundle offsets are relative to the slice and
+    # must still point inside of it.
+    with open(path, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+
+        if file_size == 0:
+            return
+
+        data = map_file(file)
+        offset = find_bundle_signature(data)
+
+        if offset == -1:
+            return
+
+        (bundle_header_offset,) = struct.unpack_from("q", data, offset - 8)
+
+        if not 0 < bundle_header_offset < file_size:
+            raise Exception(f"{path}: .NET bundle header is outside of the slice")
+
+        (_, _, bundle) = get_dotnet_bundle_data(data)
+
+    if any(entry.offset + entry.stored_size > file_size for entry in bundle.files):
+        raise Exception(f"{path}: .NET bundle entries are outside of the slice")
+
+
+def get_cputype(file) -> int:
+    file.seek(4)
+
+    return int.from_bytes(file.read(4), "little", signed=True)
+
+
+def thin_file(input_path: Path, output_path: Path, cputype: int) -> bool:
+    with open(input_path, "rb") as input:
+        magic = read_magic(input.read(4))
+
+        if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+            if magic in (MH_MAGIC, MH_MAGIC_64) and get_cputype(input) != cputype:
+                return False
+
+            shutil.copyfile(input_path, output_path)
+            shutil.copymode(input_path, output_path)
+
+            return True
+
+        archs = [arch for arch in read_fat_archs(input) if arch[0] == cputype]
+
+        if not archs:
+            return False
+
+        (_, _, offset, size, _) = archs[0]
+
+        with open(output_path, "wb") as output:
+            copy_file_data(input, offset, output, size)
+
+    shutil.copymode(input_path, output_path)
+    check_dotnet_bundle(output_path)
+
+    return True
+
+
+def thin_tree(
+    input_directory: Path, output_directory: Path, cputype: int, jobs: int
+) -> List[Path]:
+    if output_directory.exists():
+        shutil.rmtree(output_directory)
+
+    paths = []
+
+    for root, directory_names, file_names in os.walk(input_directory):
+        directory = Path(root)
+        output_root = output_directory / directory.relative_to(input_directory)
+        os.makedirs(output_root)
+
+        for name in sorted(directory_names + file_names):
+            path = directory / name
+
+            if path.is_symlink():
+                os.symlink(os.readlink(path), output_root / name)
+            elif name in file_names:
+                paths.append(path)
+
+    # Libraries built for another arch cannot be loaded and are left out.
+    skipped_paths = []
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            (
+                path,
+                executor.submit(
+                    thin_file,
+                    path,
+                    output_directory / path.relative_to(input_directory),
+                    cputype,
+                ),
+            )
+            for path in paths
+        ]
+
+        for path, future in futures:
+            if not future.result():
+                skipped_paths.append(path)
+
+    return skipped_paths
+
+
+def sign_tree(directory: Path, entitlements: Optional[bytes], jobs: int):
+    if (directory / "Contents").is_dir():
+        sign_bundle(directory, entitlements, jobs)
+        return
+
+    for path in sorted(directory.iterdir()):
+        if path.is_file() and not path.is_symlink() and is_macho_file(path):
+            sign_file(path, get_file_identifier(path), entitlements, {}, jobs)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("thin_app_bundle")
+
+    input_directory = Path(args.input_directory)
+    output_directory = Path(args.output_directory)
+    entitlements = None
+
+    if args.entitlements is not None:
+        with open(args.entitlements, "rb") as file:
+            entitlements = file.read()
+
+    if not args.sign and (input_directory / "Contents/_CodeSignature").exists():
+        print("Warning: the bundle signature is invalidated, use --sign to redo it")
+
+    for arch in args.arch or ARCHITECTURES.keys():
+        arch_directory = output_directory / arch / input_directory.name
+
+        with build_trace.span("thin tree", arch=arch):
+            skipped_paths = thin_tree(
+                input_directory, arch_directory, ARCHITECTURES[arch], args.jobs
+            )
+
+        for path in skipped_paths:
+            print(f"{arch}: skipped {path}, no {arch} slice")
+
+        if args.sign:
+            with build_trace.span("sign", arch=arch):
+                sign_tree(arch_directory, entitlements, args.jobs)
+
+        if args.tar_name is not None:
+            tar_path = output_directory / args.tar_name.format(arch=arch)
+
+            with build_trace.span("create tar", arch=arch):
+                create_tar(
+                    str(tar_path),
+                    str(arch_directory),
+                    [
+                        f"{input_directory.name}/{sub_path}"
+                        for sub_path in args.executable_sub_path
+                    ],
+                    args.jobs,
+                    input_directory.name,
+                )
+
+            print(f"{arch}: {tar_path} is {os.path.getsize(tar_path)} bytes")
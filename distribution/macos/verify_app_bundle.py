@@ -0,0 +1,436 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bundle_fix_up import SYSTEM_LIBRARY_PREFIXES
+from dotnet_bundle import (
+    BUNDLE_SEGMENT_NAME,
+    COMPRESSION_MIN_MAJOR_VERSION,
+    find_bundle_signature,
+    get_dotnet_bundle_data,
+    map_file,
+)
+from macho import (
+    CPU_TYPE_NAMES,
+    DYLIB_LOAD_COMMANDS,
+    FAT_MAGIC,
+    FAT_MAGIC_64,
+    LC_CODE_SIGNATURE,
+    LC_DYSYMTAB,
+    LC_LOAD_WEAK_DYLIB,
+    LC_SEGMENT,
+    LC_SEGMENT_64,
+    LC_SYMTAB,
+    LINKEDIT_OFFSET_FIELDS,
+    MH_EXECUTE,
+    MH_MAGIC,
+    MH_MAGIC_64,
+    MachOSlice,
+    get_page_size,
+    read_fat_archs,
+    read_magic,
+)
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+import build_trace  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Check the Mach-O structure, .NET bundle and library links of a "
+    "fixed up application bundle"
+)
+parser.add_argument(
+    "input_directory", help="Application bundle or publish directory to verify"
+)
+parser.add_argument(
+    "--executable-sub-path",
+    default="MacOS/Ryujinx",
+    help="Main executable sub path, relative to Contents for application bundles",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files to verify in parallel",
+)
+
+MACHO_MAGICS = (MH_MAGIC, MH_MAGIC_64, FAT_MAGIC, FAT_MAGIC_64)
+
+
+def get_arch_name(cputype: int) -> str:
+    return CPU_TYPE_NAMES.get(cputype, f"cpu{cputype:#x}")
+
+
+class FileReport(object):
+    path: Path
+    name: str
+    cputypes: List[int]
+    rpaths: Dict[int, List[str]]
+    links: List[Tuple[int, str, bool]]
+    problems: List[str]
+
+    def __init__(self, path: Path, name: str) -> None:
+        self.path = path
+        self.name = name
+        self.cputypes = []
+        self.rpaths = {}
+        self.links = []
+        self.problems = []
+
+    def get_location(self, cputype: Optional[int]) -> str:
+        if cputype is None or len(self.cputypes) < 2:
+            return self.name
+
+        return f"{self.name} [{get_arch_name(cputype)}]"
+
+    def add_problem(self, cputype: Optional[int], message: str):
+        self.problems.append(f"{self.get_location(cputype)}: {message}")
+
+
+def get_segments(macho_slice: MachOSlice) -> List[Tuple[bytes, int, int]]:
+    res = []
+
+    for command in macho_slice.find_commands(LC_SEGMENT_64, LC_SEGMENT):
+        if command.cmd == LC_SEGMENT_64:
+            (name, fileoff, filesize) = struct.unpack_from(
+                "<16s16xQQ", command.data, 8
+            )
+        else:
+            (name, fileoff, filesize) = struct.unpack_from("<16s8xII", command.data, 8)
+
+        res.append((name.split(b"\0", 1)[0], fileoff, filesize))
+
+    return res
+
+
+def verify_load_commands(macho_slice: MachOSlice) -> List[str]:
+    res = []
+    commands_end = macho_slice.header_size + macho_slice.original_commands_size
+
+    if commands_end > macho_slice.commands_limit:
+        res.append("load commands overlap the file content")
+
+    for command in macho_slice.commands:
+        if len(command.data) % macho_slice.command_alignment != 0:
+            res.append(f"load command {command.cmd:#x} is not aligned")
+
+    segments = get_segments(macho_slice)
+
+    for name, fileoff, filesize in segments:
+        if fileoff + filesize > macho_slice.size:
+            res.append(f"segment {name.decode()} is outside of the file")
+
+    linkedit = [segment for segment in segments if segment[0] == b"__LINKEDIT"]
+
+    if not linkedit:
+        res.append("missing __LINKEDIT segment")
+        return res
+
+    (_, linkedit_fileoff, linkedit_filesize) = linkedit[0]
+    linkedit_end = linkedit_fileoff + linkedit_filesize
+
+    # Anything after __LINKEDIT is dropped by strip and rejected by codesign.
+    if any(fileoff > linkedit_fileoff for _, fileoff, _ in segments):
+        res.append("__LINKEDIT is not the last segment")
+    elif linkedit_end < macho_slice.size:
+        res.append(
+            f"{macho_slice.size - linkedit_end} bytes after __LINKEDIT are not "
+            "covered by any segment"
+        )
+
+    # Unused tables have a zero offset.
+    def check_range(name: str, offset: int, size: int):
+        if offset != 0 and (offset < linkedit_fileoff or offset + size > linkedit_end):
+            res.append(f"{name} is outside of __LINKEDIT")
+
+    for command in macho_slice.commands:
+        name = f"load command {command.cmd:#x} data"
+
+        if command.cmd == LC_SYMTAB:
+            (symoff, nsyms, stroff, strsize) = struct.unpack_from(
+                "<IIII", command.data, 8
+            )
+            nlist_size = 16 if macho_slice.is_64 else 12
+            check_range("symbol table", symoff, nsyms * nlist_size)
+            check_range("string table", stroff, strsize)
+        elif command.cmd == LC_DYSYMTAB:
+            # Followed by entry counts rather than sizes.
+            for field_offset in LINKEDIT_OFFSET_FIELDS[command.cmd]:
+                (offset,) = struct.unpack_from("<I", command.data, field_offset)
+                check_range(name, offset, 0)
+        else:
+            for field_offset in LINKEDIT_OFFSET_FIELDS.get(command.cmd, ()):
+                (offset, size) = struct.unpack_from("<II", command.data, field_offset)
+                check_range(name, offset, size)
+
+    for command in macho_slice.find_commands(LC_CODE_SIGNATURE):
+        (dataoff, datasize) = struct.unpack_from("<II", command.data, 8)
+
+        if dataoff + datasize != linkedit_end:
+            res.append("the code signature is not at the end of __LINKEDIT")
+
+    return res
+
+
+def verify_dotnet_bundle(data, macho_slice: MachOSlice) -> List[str]:
+    marker_offset = find_bundle_signature(data)
+
+    if marker_offset == -1:
+        return []
+
+    (header_offset,) = struct.unpack_from("q", data, marker_offset - 8)
+
+    # Apphosts that are not single-file keep the marker with a zero offset.
+    if header_offset == 0:
+        return []
+
+    if not 0 < header_offset < len(data):
+        return [f".NET bundle header offset {header_offset} is out of range"]
+
+    try:
+        (_, _, bundle) = get_dotnet_bundle_data(data)
+    except Exception as e:
+        return [f".NET bundle header cannot be read: {e}"]
+
+    # Everything must be covered by a segment, or Mach-O tools drop it.
+    segments = [
+        (fileoff, fileoff + filesize)
+        for name, fileoff, filesize in get_segments(macho_slice)
+        if name in (b"__LINKEDIT", BUNDLE_SEGMENT_NAME)
+    ]
+
+    def is_covered(start: int, end: int) -> bool:
+        return any(
+            segment_start <= start and end <= segment_end
+            for segment_start, segment_end in segments
+        )
+
+    res = []
+
+    if not is_covered(header_offset, header_offset + 1):
+        res.append(".NET bundle header is not covered by a segment")
+
+    for entry in bundle.files:
+        end_offset = entry.offset + entry.stored_size
+
+        if entry.offset <= 0 or end_offset > len(data):
+            res.append(f".NET bundle entry {entry.relative_path} is out of range")
+        elif not is_covered(entry.offset, end_offset):
+            res.append(
+                f".NET bundle entry {entry.relative_path} is not covered by a segment"
+            )
+
+        if entry.compressed_size != 0 and bundle.major < COMPRESSION_MIN_MAJOR_VERSION:
+            res.append(
+                f".NET bundle entry {entry.relative_path} is compressed, which "
+                f"bundle version {bundle.major} does not support"
+            )
+
+    return res
+
+
+def verify_slice(report: FileReport, data, offset: int, size: int) -> Optional[int]:
+    try:
+        macho_slice = MachOSlice.parse(data, offset, size)
+    except Exception as e:
+        report.add_problem(None, str(e))
+        return None
+
+    cputype = macho_slice.cputype
+    report.cputypes.append(cputype)
+    report.rpaths[cputype] = macho_slice.get_rpaths()
+    problems = verify_load_commands(macho_slice)
+
+    # Bundle offsets are relative to the slice.
+    if macho_slice.filetype == MH_EXECUTE:
+        if offset != 0 or size != len(data):
+            data = data[offset : offset + size]
+
+        problems.extend(verify_dotnet_bundle(data, macho_slice))
+
+    for problem in problems:
+        report.add_problem(cputype, problem)
+
+    for command in macho_slice.find_commands(*DYLIB_LOAD_COMMANDS):
+        report.links.append(
+            (cputype, command.get_string(8), command.cmd == LC_LOAD_WEAK_DYLIB)
+        )
+
+    return cputype
+
+
+def verify_file(path: Path, name: str) -> Optional[FileReport]:
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < 4:
+            return None
+
+        data = map_file(file)
+
+    magic = read_magic(data[:4])
+
+    if magic not in MACHO_MAGICS:
+        return None
+
+    report = FileReport(path, name)
+
+    if magic in (MH_MAGIC, MH_MAGIC_64):
+        verify_slice(report, data, 0, len(data))
+        return report
+
+    fat_archs = read_fat_archs(data)
+    ranges = []
+
+    for cputype, _, offset, size, align in fat_archs:
+        location = f"{name} [{get_arch_name(cputype)}]"
+
+        if offset + size > len(data):
+            report.problems.append(f"{location}: slice is outside of the file")
+            continue
+
+        # Slices are mapped as is, they must start on a page of their arch.
+        if offset % get_page_size(cputype) != 0 or offset % (1 << align) != 0:
+            report.problems.append(f"{location}: slice is not page aligned")
+
+        if any(start < offset + size and offset < end for start, end in ranges):
+            report.problems.append(f"{location}: slice overlaps another one")
+
+        ranges.append((offset, offset + size))
+
+        if cputype in report.cputypes:
+            report.problems.append(f"{location}: duplicate slice")
+        elif verify_slice(report, data, offset, size) not in (cputype, None):
+            report.problems.append(f"{location}: cputype does not match the slice")
+
+    return report
+
+
+def resolve_install_name(
+    name: str, loader_path: Path, executable_path: Path, rpaths: List[str]
+) -> List[Path]:
+    def expand(path: str) -> str:
+        if path.startswith("@executable_path/"):
+            return str(executable_path.parent) + path[len("@executable_path") :]
+        elif path.startswith("@loader_path/"):
+            return str(loader_path.parent) + path[len("@loader_path") :]
+
+        return path
+
+    if name.startswith("@rpath/"):
+        return [Path(expand(rpath)) / name[len("@rpath/") :] for rpath in rpaths]
+
+    return [Path(expand(name))]
+
+
+def verify_links(
+    reports: Dict[Path, FileReport], root: Path, executable_path: Path
+) -> List[str]:
+    res = []
+    executable_report = reports.get(executable_path)
+
+    for path, report in reports.items():
+        for cputype, name, weak in report.links:
+            if name.startswith(SYSTEM_LIBRARY_PREFIXES):
+                continue
+
+            # dyld also searches the rpaths of the executable loading the library.
+            rpaths = list(report.rpaths[cputype])
+
+            if executable_report is not None:
+                rpaths.extend(executable_report.rpaths.get(cputype, []))
+
+            location = report.get_location(cputype)
+            resolved_path = next(
+                (
+                    candidate
+                    for candidate in resolve_install_name(
+                        name, path, executable_path, rpaths
+                    )
+                    if candidate.exists()
+                ),
+                None,
+            )
+
+            if resolved_path is None:
+                if not weak:
+                    res.append(f"{location}: cannot resolve {name}")
+
+                continue
+
+            resolved_path = resolved_path.resolve()
+            library_report = reports.get(resolved_path)
+
+            if root not in resolved_path.parents:
+                res.append(f"{location}: {name} is outside of the bundle")
+            elif library_report is None or cputype not in library_report.cputypes:
+                res.append(f"{location}: {name} has no {get_arch_name(cputype)} slice")
+
+    return res
+
+
+def verify_app_bundle(
+    input_directory: Path, executable_sub_path: str, jobs: int
+) -> List[str]:
+    root = input_directory / "Contents"
+
+    if not root.is_dir():
+        root = input_directory
+
+    root = root.resolve()
+    executable_path = root / executable_sub_path
+    paths = []
+
+    for directory, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = Path(directory) / file_name
+
+            if not path.is_symlink():
+                paths.append(path)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(
+            executor.map(
+                lambda path: verify_file(path, path.relative_to(root).as_posix()),
+                sorted(paths),
+            )
+        )
+
+    reports = {report.path: report for report in results if report is not None}
+    res = []
+
+    if executable_path not in reports:
+        res.append(f"{executable_sub_path}: missing main executable")
+
+    for report in reports.values():
+        res.extend(report.problems)
+
+    res.extend(verify_links(reports, root, executable_path))
+
+    return res
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("verify_app_bundle")
+
+    start_time = time.perf_counter()
+
+    with build_trace.span("verify app bundle"):
+        problems = verify_app_bundle(
+            Path(args.input_directory), args.executable_sub_path, args.jobs
+        )
+
+    for problem in problems:
+        print(problem)
+
+    print(
+        f"Verified {args.input_directory} in {time.perf_counter() - start_time:.2f}s, "
+        f"{len(problems)} problems"
+    )
+
+    if problems:
+        sys.exit(1)
@@ -0,0 +1,405 @@
+import argparse
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from artifact_cache import (
+    ArtifactCache,
+    add_cache_arguments,
+    create_cache_from_arguments,
+)
+from bundle_fix_up import LIBRARY_SUFFIXES, LibraryIndex, fixup_dylibs, fixup_executable
+from codesign import (
+    get_nested_paths,
+    is_macho_file,
+    sign_main_executable,
+    sign_nested_files,
+)
+from construct_universal_dylib import construct_universal_dylib
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "misc"))
+
+from add_tar_exec import IncrementalTar  # noqa: E402
+import build_trace  # noqa: E402
+
+ARCHITECTURES = ("arm64", "x64")
+RESOURCES_DIRECTORY = Path(__file__).resolve().parent
+
+# Same files and layout as create_app_bundle.sh.
+STATIC_FILES = {
+    "Info.plist": "Info.plist",
+    "Resources/Ryujinx.icns": "Ryujinx.icns",
+    "Resources/updater.sh": "updater.sh",
+}
+
+parser = argparse.ArgumentParser(
+    description="Watch the publish directories and incrementally update the "
+    "universal application bundle"
+)
+parser.add_argument("arm64_publish_directory", help="ARM64 publish directory")
+parser.add_argument("x86_64_publish_directory", help="x86_64 publish directory")
+parser.add_argument("output_directory", help="Output directory")
+parser.add_argument(
+    "--executable-name", default="Ryujinx", help="Main executable file name"
+)
+parser.add_argument(
+    "--exclude",
+    action="append",
+    default=["x64:libarmeilleure-jitsupport.dylib", "arm64:libsoundio.dylib"],
+    help="arch:file name left out of the bundle of that arch",
+)
+parser.add_argument(
+    "--sign", action="store_true", help="Ad-hoc sign the bundle after every change"
+)
+parser.add_argument("--entitlements", help="Entitlements plist of the main executable")
+parser.add_argument("--tar-name", help="Also keep this .tar.gz up to date")
+parser.add_argument(
+    "--interval", type=float, default=1.0, help="Polling interval in seconds"
+)
+parser.add_argument(
+    "--once", action="store_true", help="Build the bundle once and exit"
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of files to process in parallel",
+)
+add_cache_arguments(parser)
+
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+class WatchSession(object):
+    publish_directories: Dict[str, Path]
+    staging_directories: Dict[str, Path]
+    bundle_directory: Path
+    executable_name: str
+    excludes: Dict[str, Set[str]]
+    snapshots: Dict[str, Snapshot]
+    failed_snapshots: Optional[Dict[str, Snapshot]]
+    library_indexes: Dict[str, LibraryIndex]
+    cdhashes: Dict[Path, List[bytes]]
+    entitlements: Optional[bytes]
+    sign: bool
+    archive: Optional[IncrementalTar]
+    tar_path: Optional[Path]
+    jobs: int
+    cache: Optional[ArtifactCache]
+
+    def __init__(
+        self,
+        publish_directories: Dict[str, Path],
+        staging_directory: Path,
+        output_directory: Path,
+        executable_name: str,
+        excludes: List[str],
+        jobs: int,
+        cache: Optional[ArtifactCache] = None,
+    ) -> None:
+        self.publish_directories = publish_directories
+        self.staging_directories = {
+            arch: staging_directory / arch / "Ryujinx.app" for arch in ARCHITECTURES
+        }
+        self.bundle_directory = output_directory / "Ryujinx.app"
+        self.executable_name = executable_name
+        self.excludes = {arch: set() for arch in ARCHITECTURES}
+        self.snapshots = {arch: {} for arch in ARCHITECTURES}
+        self.failed_snapshots = None
+        self.library_indexes = {}
+        self.cdhashes = {}
+        self.entitlements = None
+        self.sign = False
+        self.archive = None
+        self.tar_path = None
+        self.jobs = jobs
+        self.cache = cache
+
+        for exclude in excludes:
+            (arch, name) = exclude.split(":", 1)
+            self.excludes[arch].add(name)
+
+    def get_sub_path(self, name: str) -> Optional[str]:
+        # Same mapping as create_app_bundle.sh, everything else is in the .NET bundle.
+        if name == self.executable_name:
+            return f"MacOS/{name}"
+        elif name.endswith(".dylib"):
+            return f"Frameworks/{name}"
+        elif name == "THIRDPARTY.md":
+            return f"Resources/{name}"
+
+        return None
+
+    def scan(self, arch: str) -> Snapshot:
+        res = {}
+
+        with os.scandir(self.publish_directories[arch]) as entries:
+            for entry in entries:
+                sub_path = self.get_sub_path(entry.name)
+
+                if (
+                    sub_path is not None
+                    and entry.is_file()
+                    and entry.name not in self.excludes[arch]
+                ):
+                    stat = entry.stat()
+                    res[sub_path] = (stat.st_mtime_ns, stat.st_size)
+
+        return res
+
+    def scan_all(self) -> Dict[str, Snapshot]:
+        return {arch: self.scan(arch) for arch in ARCHITECTURES}
+
+    def setup(self):
+        for path in list(self.staging_directories.values()) + [self.bundle_directory]:
+            for directory in ("Frameworks", "MacOS", "Resources"):
+                os.makedirs(path / "Contents" / directory, exist_ok=True)
+
+        for sub_path, name in STATIC_FILES.items():
+            shutil.copyfile(
+                RESOURCES_DIRECTORY / name,
+                self.bundle_directory / "Contents" / sub_path,
+            )
+
+        with open(self.bundle_directory / "Contents" / "PkgInfo", "w") as file:
+            file.write("APPL????")
+
+    def update_staging(self, arch: str, snapshot: Snapshot) -> Set[str]:
+        old_snapshot = self.snapshots[arch]
+        content_directory = self.staging_directories[arch] / "Contents"
+        changed = {
+            sub_path
+            for sub_path in set(old_snapshot.keys()) | set(snapshot.keys())
+            if old_snapshot.get(sub_path) != snapshot.get(sub_path)
+        }
+
+        # Adding or removing a library can change how the others resolve, they are
+        # all copied and fixed up again.
+        rebuild_index = (
+            arch not in self.library_indexes or old_snapshot.keys() != snapshot.keys()
+        )
+
+        if rebuild_index:
+            changed.update(
+                sub_path
+                for sub_path in snapshot
+                if sub_path.endswith(LIBRARY_SUFFIXES)
+            )
+
+        for sub_path in sorted(changed):
+            path = content_directory / sub_path
+
+            if sub_path in snapshot:
+                source_path = self.publish_directories[arch] / Path(sub_path).name
+                shutil.copyfile(source_path, path)
+                shutil.copymode(source_path, path)
+            elif path.exists():
+                os.remove(path)
+
+        if rebuild_index:
+            self.library_indexes[arch] = LibraryIndex.build(content_directory)
+
+        library_paths = [
+            content_directory / sub_path
+            for sub_path in sorted(changed)
+            if sub_path.endswith(LIBRARY_SUFFIXES) and sub_path in snapshot
+        ]
+
+        if library_paths:
+            with build_trace.span("fixup dylibs", arch=arch):
+                fixup_dylibs(
+                    self.library_indexes[arch],
+                    [
+                        content_directory / "Frameworks",
+                        content_directory / "Resources/lib",
+                    ],
+                    self.jobs,
+                    self.cache,
+                    library_paths,
+                )
+
+        executable_path = content_directory / "MacOS" / self.executable_name
+
+        if f"MacOS/{self.executable_name}" in changed and executable_path.exists():
+            os.chmod(executable_path, os.stat(executable_path).st_mode | 0o100)
+
+            with build_trace.span("fixup executable", arch=arch):
+                fixup_executable(executable_path)
+
+        return changed
+
+    def update_bundle(self, changed: Set[str]) -> List[Path]:
+        # Everything that is not a Mach-O file is taken from the ARM64 bundle.
+        (arm64_directory, x86_64_directory) = [
+            self.staging_directories[arch] / "Contents" for arch in ARCHITECTURES
+        ]
+        content_directory = self.bundle_directory / "Contents"
+        updated_paths = []
+
+        for sub_path in sorted(changed):
+            output_path = content_directory / sub_path
+
+            if not (arm64_directory / sub_path).exists():
+                if output_path.exists():
+                    os.remove(output_path)
+                    self.cdhashes.pop(output_path, None)
+
+                continue
+
+            if not is_macho_file(arm64_directory / sub_path):
+                shutil.copyfile(arm64_directory / sub_path, output_path)
+            else:
+                with build_trace.span("construct universal file", sub_path=sub_path):
+                    construct_universal_dylib(
+                        arm64_directory / sub_path,
+                        x86_64_directory / sub_path,
+                        output_path,
+                        self.cache,
+                    )
+
+            updated_paths.append(output_path)
+
+        return updated_paths
+
+    def sign_bundle(self, updated_paths: List[Path], full: bool):
+        main_executable = (
+            self.bundle_directory / "Contents/MacOS" / self.executable_name
+        )
+
+        if full:
+            nested_paths = get_nested_paths(self.bundle_directory)
+        else:
+            nested_paths = [
+                path
+                for path in updated_paths
+                if path != main_executable and is_macho_file(path)
+            ]
+
+        # Nested code keeps its signature, only the bundle seal is redone.
+        self.cdhashes.update(sign_nested_files(nested_paths, self.jobs))
+
+        if main_executable.exists():
+            sign_main_executable(
+                self.bundle_directory, self.entitlements, self.cdhashes, self.jobs
+            )
+
+    def update(self, snapshots: Dict[str, Snapshot]) -> int:
+        full = not any(self.snapshots.values())
+        changed = set()
+
+        try:
+            for arch in ARCHITECTURES:
+                with build_trace.span("update staging", arch=arch):
+                    changed.update(self.update_staging(arch, snapshots[arch]))
+        except Exception:
+            # Staging might be half updated, every library is redone next time.
+            self.library_indexes = {}
+            raise
+
+        with build_trace.span("update bundle"):
+            updated_paths = self.update_bundle(changed)
+
+        if self.sign:
+            with build_trace.span("sign"):
+                self.sign_bundle(updated_paths, full)
+
+        if self.archive is not None:
+            with build_trace.span("update archive"):
+                bundle_name = self.bundle_directory.name
+                self.archive.update(
+                    str(self.bundle_directory),
+                    [f"{bundle_name}/Contents/MacOS/{self.executable_name}"],
+                    bundle_name,
+                )
+                self.archive.write(str(self.tar_path))
+
+        self.snapshots = snapshots
+
+        return len(changed)
+
+    def wait_for_changes(self, interval: float) -> Dict[str, Snapshot]:
+        snapshots = self.scan_all()
+
+        while True:
+            time.sleep(interval)
+            new_snapshots = self.scan_all()
+
+            # Publishing writes many files, wait for it to settle. A failed update is
+            # only retried once something changes again.
+            if new_snapshots == snapshots and snapshots not in (
+                self.snapshots,
+                self.failed_snapshots,
+            ):
+                return snapshots
+
+            snapshots = new_snapshots
+
+
+def run_update(session: WatchSession, snapshots: Dict[str, Snapshot]) -> bool:
+    start_time = time.perf_counter()
+
+    try:
+        count = session.update(snapshots)
+    except Exception as e:
+        session.failed_snapshots = snapshots
+        print(f"Update failed: {e}")
+        return False
+
+    print(f"Updated {count} files in {time.perf_counter() - start_time:.2f}s")
+
+    return True
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("watch_app_bundle")
+
+    output_directory = Path(args.output_directory)
+    cache = create_cache_from_arguments(args)
+
+    with tempfile.TemporaryDirectory() as staging_directory:
+        session = WatchSession(
+            {
+                "arm64": Path(args.arm64_publish_directory),
+                "x64": Path(args.x86_64_publish_directory),
+            },
+            Path(staging_directory),
+            output_directory,
+            args.executable_name,
+            args.exclude,
+            args.jobs,
+            cache,
+        )
+        session.sign = args.sign
+
+        if args.entitlements is not None:
+            with open(args.entitlements, "rb") as file:
+                session.entitlements = file.read()
+
+        if args.tar_name is not None:
+            session.archive = IncrementalTar(
+                jobs=args.jobs, spill_directory=staging_directory
+            )
+            session.tar_path = output_directory / args.tar_name
+
+        session.setup()
+
+        try:
+            run_update(session, session.scan_all())
+
+            while not args.once:
+                print("Waiting for changes...")
+                run_update(session, session.wait_for_changes(args.interval))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if session.archive is not None:
+                session.archive.close()
+
+            if cache is not None:
+                cache.evict()
+                print(cache.get_report())
@@ -1,6 +1,16 @@
 import argparse
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import shutil
 import tarfile
+import tempfile
+from typing import IO, Dict, List, Optional, Tuple
+
+import build_trace
+from parallel_gzip import ParallelGzipFile
+
+MEMBER_MEMORY_SIZE = 4 * 1024 * 1024
 
 parser = argparse.ArgumentParser(
     description="Add the main binary to a tar and force it to be executable"
@@ -8,17 +18,210 @@ parser = argparse.ArgumentParser(
 parser.add_argument("input_tar_file", help="input tar file")
 parser.add_argument("main_binary_path", help="Main executable path")
 parser.add_argument("main_binary_tar_path", help="Main executable tar path")
+parser.add_argument(
+    "--source-directory",
+    help="Create the tar from this directory in a single pass instead of appending "
+    "the main binary to it, compressed if it ends with .gz",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of threads used for compression",
+)
+
+
+def add_tree(tar: tarfile.TarFile, path: str, filter, arcname: str = None):
+    if arcname is None:
+        arcname = path
+
+    # Same order as TarFile.add, one entry at a time so that each file gets a span.
+    with build_trace.span(path, "tar"):
+        tar.add(path, arcname, recursive=False, filter=filter)
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            add_tree(
+                tar, os.path.join(path, name), filter, os.path.join(arcname, name)
+            )
+
+
+def create_tar(
+    tar_file: str,
+    source_directory: str,
+    executable_tar_paths: list,
+    jobs: int,
+    arcname: str = None,
+):
+    def apply_overrides(tar_info: tarfile.TarInfo) -> tarfile.TarInfo:
+        if tar_info.name in executable_tar_paths:
+            tar_info.mode = 0o755
+
+        return tar_info
+
+    # Files are streamed one after the other straight into the (compressed) output.
+    with open(tar_file, "wb") as output:
+        if tar_file.endswith(".gz"):
+            with ParallelGzipFile(output, 9, jobs=jobs) as gz:
+                with tarfile.open(
+                    fileobj=gz, mode="w|", format=tarfile.GNU_FORMAT
+                ) as tar:
+                    add_tree(tar, source_directory, apply_overrides, arcname)
+
+            build_trace.add_counter("gzip_bytes_in", gz.bytes_in)
+            build_trace.add_counter("gzip_bytes_out", gz.bytes_out)
+            print(gz.get_report())
+        else:
+            with tarfile.open(
+                fileobj=output, mode="w|", format=tarfile.GNU_FORMAT
+            ) as tar:
+                add_tree(tar, source_directory, apply_overrides, arcname)
+
+
+def list_tree(path: str, arcname: str) -> List[Tuple[str, str]]:
+    # Same order as add_tree.
+    res = [(path, arcname)]
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            res.extend(list_tree(os.path.join(path, name), os.path.join(arcname, name)))
+
+    return res
+
+
+class IncrementalTar(object):
+    level: int
+    jobs: int
+    spill_directory: Optional[str]
+    members: Dict[str, Tuple[tuple, IO[bytes], int]]
+    order: List[str]
+
+    def __init__(
+        self, level: int = 9, jobs: int = 1, spill_directory: Optional[str] = None
+    ) -> None:
+        self.level = level
+        self.jobs = jobs
+        self.spill_directory = spill_directory
+        self.members = {}
+        self.order = []
+        self._tar = tarfile.open(
+            fileobj=io.BytesIO(), mode="w", format=tarfile.GNU_FORMAT
+        )
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def open_member(self) -> IO[bytes]:
+        # Small members stay in memory, large ones like the main executable go to disk.
+        return tempfile.SpooledTemporaryFile(
+            MEMBER_MEMORY_SIZE, dir=self.spill_directory
+        )
+
+    def build_member(self, path: str, arcname: str, mode: int) -> Tuple[IO[bytes], int]:
+        tar_info = self._tar.gettarinfo(path, arcname)
+
+        if mode is not None:
+            tar_info.mode = mode
+
+        member = self.open_member()
+
+        with ParallelGzipFile(
+            member, self.level, jobs=self.jobs, executor=self._executor
+        ) as gz:
+            gz.write(
+                tar_info.tobuf(tarfile.GNU_FORMAT, self._tar.encoding, self._tar.errors)
+            )
+
+            if tar_info.isreg():
+                with open(path, "rb") as file:
+                    tarfile.copyfileobj(file, gz, tar_info.size)
+
+                gz.write(bytes(-tar_info.size % tarfile.BLOCKSIZE))
+
+        return (member, gz.bytes_in)
+
+    def update(
+        self, source_directory: str, executable_tar_paths: list, arcname: str = None
+    ) -> int:
+        # Gzip members can be concatenated, only entries that changed are compressed
+        # again.
+        entries = list_tree(source_directory, arcname or source_directory)
+        updated_count = 0
+
+        for path, name in entries:
+            stat = os.lstat(path)
+            key = (stat.st_mtime_ns, stat.st_size, stat.st_mode, stat.st_ino)
+
+            if name in self.members and self.members[name][0] == key:
+                continue
+
+            with build_trace.span(path, "tar"):
+                mode = 0o755 if name in executable_tar_paths else None
+                (member, member_size) = self.build_member(path, name, mode)
+
+            if name in self.members:
+                self.members[name][1].close()
+
+            self.members[name] = (key, member, member_size)
+            updated_count += 1
+
+        self.order = [name for _, name in entries]
+
+        for name in set(self.members.keys()) - set(self.order):
+            self.members.pop(name)[1].close()
+
+        return updated_count
+
+    def write(self, tar_file: str):
+        size = 0
+
+        with open(tar_file, "wb") as output:
+            for name in self.order:
+                (_, member, member_size) = self.members[name]
+                member.seek(0)
+                shutil.copyfileobj(member, output)
+                size += member_size
+
+            # End of archive marker, padded to a full record like tarfile does.
+            end_size = 2 * tarfile.BLOCKSIZE
+            end_size += -(size + end_size) % tarfile.RECORDSIZE
+
+            with ParallelGzipFile(
+                output, self.level, jobs=self.jobs, executor=self._executor
+            ) as gz:
+                gz.write(bytes(end_size))
+
+    def close(self):
+        for _, member, _ in self.members.values():
+            member.close()
+
+        self.members = {}
+        self.order = []
+        self._executor.shutdown()
+
+
+def add_executable_to_tar(tar_file: str, binary_path: str, binary_tar_path: str):
+    with open(binary_path, "rb") as f:
+        with tarfile.open(tar_file, "a") as tar:
+            tar_info = tarfile.TarInfo(binary_tar_path)
+            tar_info.mode = 0o755
+            tar_info.size = os.fstat(f.fileno()).st_size
+
+            tar.addfile(tar_info, f)
 
-args = parser.parse_args()
-input_tar_file = args.input_tar_file
-main_binary_path = args.main_binary_path
-main_binary_tar_path = args.main_binary_tar_path
 
-with open(main_binary_path, "rb") as f:
-    with tarfile.open(input_tar_file, "a") as tar:
-        data = f.read()
-        tar_info = tarfile.TarInfo(main_binary_tar_path)
-        tar_info.mode = 0o755
-        tar_info.size = len(data)
+if __name__ == "__main__":
+    args = parser.parse_args()
+    build_trace.init("add_tar_exec")
+    input_tar_file = args.input_tar_file
+    main_binary_path = args.main_binary_path
+    main_binary_tar_path = args.main_binary_tar_path
+    source_directory = args.source_directory
+    jobs = args.jobs
 
-        tar.addfile(tar_info, BytesIO(data))
+    if source_directory is not None:
+        with build_trace.span("create tar"):
+            create_tar(input_tar_file, source_directory, [main_binary_tar_path], jobs)
+    else:
+        with build_trace.span("add executable to tar"):
+            add_executable_to_tar(
+                input_tar_file, main_binary_path, main_binary_tar_path
+            )
@@ -0,0 +1,282 @@
+import argparse
+import atexit
+import contextlib
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TRACE_DIRECTORY_ENV = "RYUJINX_PACKAGING_TRACE"
+
+
+def get_peak_rss() -> int:
+    if resource is None:
+        return 0
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS but in KiB everywhere else.
+    if sys.platform == "darwin":
+        return peak_rss
+
+    return peak_rss * 1024
+
+
+def get_io_counters() -> Dict[str, int]:
+    # Linux accounts every read and write syscall, including copy_file_range and
+    # sendfile. Elsewhere only the number of blocks actually hitting the disk is known.
+    try:
+        with open("/proc/self/io", "r") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+
+        return {
+            "bytes_read": int(counters["rchar"]),
+            "bytes_written": int(counters["wchar"]),
+        }
+    except (OSError, KeyError, ValueError):
+        pass
+
+    if resource is None:
+        return {}
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return {"blocks_read": usage.ru_inblock, "blocks_written": usage.ru_oublock}
+
+
+class Tracer(object):
+    name: str
+    output_path: Path
+    events: List[dict]
+    counters: Dict[str, int]
+
+    def __init__(self, name: str, output_path: Path) -> None:
+        self.name = name
+        self.output_path = output_path
+        self.events = []
+        self.counters = {"subprocesses": 0}
+        self.pid = os.getpid()
+
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+        self._start_timestamp = time.time() * 1000000
+        self._start_io = get_io_counters()
+
+        self.events.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": 0,
+                "args": {"name": name},
+            }
+        )
+
+    def get_timestamp(self) -> float:
+        return self._start_timestamp + (time.perf_counter() - self._start_time) * 1e6
+
+    def on_audit_event(self, event: str, args: tuple):
+        if event in ("subprocess.Popen", "os.system", "os.posix_spawn", "os.exec"):
+            self.add_counter("subprocesses", 1)
+
+    def add_counter(self, name: str, value: int):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        # Byte and subprocess counts are process wide, they also include the work
+        # of any other thread running at the same time.
+        start_io = get_io_counters()
+        start_subprocesses = self.counters["subprocesses"]
+        start_timestamp = self.get_timestamp()
+
+        try:
+            yield args
+        finally:
+            end_timestamp = self.get_timestamp()
+
+            for key, value in get_io_counters().items():
+                args[key] = value - start_io[key]
+
+            args["subprocesses"] = self.counters["subprocesses"] - start_subprocesses
+            args["peak_rss"] = get_peak_rss()
+
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start_timestamp,
+                "dur": end_timestamp - start_timestamp,
+                "pid": self.pid,
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+
+            with self._lock:
+                self.events.append(event)
+
+    def finish(self):
+        with self._lock:
+            for key, value in get_io_counters().items():
+                self.counters[key] = value - self._start_io[key]
+
+            self.counters["peak_rss"] = get_peak_rss()
+            self.events.append(
+                {
+                    "name": "total",
+                    "cat": "process",
+                    "ph": "X",
+                    "ts": self._start_timestamp,
+                    "dur": self.get_timestamp() - self._start_timestamp,
+                    "pid": self.pid,
+                    "tid": 0,
+                    "args": dict(self.counters),
+                }
+            )
+
+            os.makedirs(self.output_path.parent, exist_ok=True)
+
+            with open(self.output_path, "w") as file:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+            print(get_summary(self.events), file=sys.stderr)
+            print(f"Trace written to {self.output_path}", file=sys.stderr)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def init(name: str) -> Optional[Tracer]:
+    global _tracer
+
+    trace_directory = os.environ.get(TRACE_DIRECTORY_ENV)
+
+    if not trace_directory or _tracer is not None:
+        return _tracer
+
+    _tracer = Tracer(
+        name, Path(trace_directory) / f"{name}.{os.getpid()}.trace.json"
+    )
+    sys.addaudithook(_tracer.on_audit_event)
+    atexit.register(_tracer.finish)
+
+    return _tracer
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, category: str = "phase", **args):
+    if _tracer is None:
+        return contextlib.nullcontext(args)
+
+    return _tracer.span(name, category, **args)
+
+
+def add_counter(name: str, value: int):
+    if _tracer is not None:
+        _tracer.add_counter(name, value)
+
+
+def format_size(value: int) -> str:
+    return f"{value / (1024 * 1024):.1f} MiB"
+
+
+IO_COLUMNS = [
+    ("bytes_read", "Read", format_size),
+    ("bytes_written", "Written", format_size),
+    ("blocks_read", "Blocks read", str),
+    ("blocks_written", "Blocks written", str),
+]
+
+
+def get_summary(events: List[dict], slowest_count: int = 5) -> str:
+    spans = [event for event in events if event["ph"] == "X"]
+    rows = {}
+
+    # Only the I/O counters the host provided are shown, blocks are not bytes.
+    io_columns = [
+        (counter, title, formatter)
+        for (counter, title, formatter) in IO_COLUMNS
+        if any(counter in event["args"] for event in spans)
+    ]
+
+    for event in spans:
+        # Per-file spans are grouped by category, phases by name.
+        key = event["name"] if event["cat"] in ("phase", "process") else event["cat"]
+        row = rows.setdefault(key, [0, 0.0, 0.0, 0] + [0] * len(io_columns))
+        row[0] += 1
+        row[1] += event["dur"]
+        row[2] = max(row[2], event["dur"])
+        row[3] += event["args"].get("subprocesses", 0)
+
+        for index, (counter, _, _) in enumerate(io_columns):
+            row[4 + index] += event["args"].get(counter, 0)
+
+    name_width = max([len(key) for key in rows] + [5])
+    lines = [
+        f"{'Phase':<{name_width}} {'Count':>6} {'Total':>10} {'Max':>10}"
+        + "".join(f" {title:>14}" for (_, title, _) in io_columns)
+        + f" {'Procs':>6}"
+    ]
+
+    for key, row in rows.items():
+        lines.append(
+            f"{key:<{name_width}} {row[0]:>6} {row[1] / 1e6:>9.3f}s "
+            f"{row[2] / 1e6:>9.3f}s"
+            + "".join(
+                f" {formatter(value):>14}"
+                for ((_, _, formatter), value) in zip(io_columns, row[4:])
+            )
+            + f" {row[3]:>6}"
+        )
+
+    file_spans = [event for event in spans if event["cat"] not in ("phase", "process")]
+    file_spans.sort(key=lambda event: event["dur"], reverse=True)
+
+    if file_spans:
+        lines.append("")
+        lines.append("Slowest files:")
+
+        for event in file_spans[:slowest_count]:
+            lines.append(f"  {event['dur'] / 1e6:>9.3f}s {event['name']}")
+
+    peak_rss = max(
+        [event["args"].get("peak_rss", 0) for event in spans] + [0]
+    )
+    lines.append("")
+    lines.append(f"Peak RSS: {format_size(peak_rss)}")
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge packaging traces and print their summary"
+    )
+    parser.add_argument("trace_files", nargs="+", help="Trace files to merge")
+    parser.add_argument("--output", help="Merged Chrome trace output path")
+
+    args = parser.parse_args()
+
+    events = []
+
+    for trace_file in args.trace_files:
+        with open(trace_file, "r") as file:
+            events.extend(json.load(file)["traceEvents"])
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    print(get_summary(events))
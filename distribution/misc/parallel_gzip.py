@@ -0,0 +1,179 @@
+import argparse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import shutil
+import struct
+import time
+from typing import Deque, Optional
+import zlib
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+GZIP_OS_UNIX = 3
+
+
+def compress_block(data: bytes, dictionary: Optional[bytes], level: int) -> bytes:
+    if dictionary is not None:
+        compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            -zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY,
+            dictionary,
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    # A sync flush ends the block on a byte boundary without marking the stream as done,
+    # so blocks can simply be concatenated.
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    fileobj: object
+    level: int
+    block_size: int
+    jobs: int
+    bytes_in: int
+    bytes_out: int
+
+    def __init__(
+        self,
+        fileobj,
+        level: int = 9,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        jobs: Optional[int] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ) -> None:
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.jobs = jobs or os.cpu_count() or 1
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+        self._buffer = bytearray()
+        self._dictionary = None
+        self._crc = 0
+        self._pending: Deque[Future] = deque()
+        # A shared executor is left running for the next files.
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=self.jobs)
+        self._start_time = time.perf_counter()
+        self._end_time = None
+
+        if level == 9:
+            extra_flags = 2
+        elif level == 1:
+            extra_flags = 4
+        else:
+            extra_flags = 0
+
+        self._write_output(
+            b"\x1f\x8b\x08\x00" + struct.pack("<IBB", 0, extra_flags, GZIP_OS_UNIX)
+        )
+
+    def _write_output(self, data: bytes):
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def _submit_block(self, data: bytes):
+        # zlib releases the GIL while compressing, so the blocks really run in parallel.
+        self._pending.append(
+            self._executor.submit(compress_block, data, self._dictionary, self.level)
+        )
+        self._dictionary = data[-DICTIONARY_SIZE:]
+
+        # Only keep a bounded amount of blocks in flight.
+        while len(self._pending) > self.jobs * 2:
+            self._write_output(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+
+        size = len(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self.bytes_in += size
+        self._buffer += data
+
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            self._submit_block(block)
+
+        return size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self._buffer:
+            self._submit_block(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        while self._pending:
+            self._write_output(self._pending.popleft().result())
+
+        if self._owns_executor:
+            self._executor.shutdown()
+
+        # Terminate the deflate stream with an empty final block.
+        self._write_output(
+            zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+        )
+        self._write_output(
+            struct.pack("<II", self._crc & 0xFFFFFFFF, self.bytes_in & 0xFFFFFFFF)
+        )
+
+        self.closed = True
+        self._end_time = time.perf_counter()
+
+    def __enter__(self) -> "ParallelGzipFile":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_report(self) -> str:
+        end_time = self._end_time or time.perf_counter()
+        elapsed = max(end_time - self._start_time, 1e-9)
+        ratio = self.bytes_out / self.bytes_in if self.bytes_in else 0
+
+        return (
+            f"Compressed {self.bytes_in / (1024 * 1024):.1f} MiB to "
+            f"{self.bytes_out / (1024 * 1024):.1f} MiB "
+            f"(ratio {ratio:.3f}) in {elapsed:.2f}s "
+            f"({self.bytes_in / (1024 * 1024) / elapsed:.1f} MiB/s, {self.jobs} jobs)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-threaded gzip compression")
+    parser.add_argument("input_file", help="Input file")
+    parser.add_argument("output_file", help="Output gzip file")
+    parser.add_argument("--level", type=int, default=9, help="Compression level")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1, help="Number of threads"
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=DEFAULT_BLOCK_SIZE,
+        help="Size of the blocks compressed in parallel",
+    )
+
+    args = parser.parse_args()
+
+    with open(args.input_file, "rb") as input, open(args.output_file, "wb") as output:
+        with ParallelGzipFile(output, args.level, args.block_size, args.jobs) as gz:
+            shutil.copyfileobj(input, gz, args.block_size)
+
+        print(gz.get_report())
@@ -0,0 +1,542 @@
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import os
+from pathlib import Path, PurePosixPath
+import shutil
+import struct
+import tarfile
+import tempfile
+from typing import IO, Callable, Dict, List, Optional, Tuple
+
+from parallel_gzip import ParallelGzipFile
+
+DELTA_VERSION = 1
+DELTA_BLOCK_SIZE = 4096
+COPY_BUFFER_SIZE = 1024 * 1024
+PATCH_MEMORY_SIZE = 4 * 1024 * 1024
+
+MANIFEST_NAME = "manifest.json"
+PATCH_MAGIC = b"RJDELTA\x01"
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+
+# A patch is only worth it if it is noticeably smaller than the file itself.
+PATCH_MAX_RATIO = 0.75
+
+parser = argparse.ArgumentParser(
+    description="Create and apply delta update packages between two releases"
+)
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+create_parser = subparsers.add_parser(
+    "create", help="Create a delta package between two release archives"
+)
+create_parser.add_argument("old_release", help="Previous release archive or directory")
+create_parser.add_argument("new_release", help="New release archive or directory")
+create_parser.add_argument("output_path", help="Output delta package (.tar.gz)")
+create_parser.add_argument(
+    "--jobs", type=int, default=os.cpu_count() or 1, help="Number of parallel jobs"
+)
+
+apply_parser = subparsers.add_parser(
+    "apply", help="Apply a delta package to an installed release"
+)
+apply_parser.add_argument("old_directory", help="Installed release directory")
+apply_parser.add_argument("delta_path", help="Delta package")
+apply_parser.add_argument(
+    "output_directory",
+    help="Directory receiving the new release, can be the installed directory",
+)
+
+
+def hash_data(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    file_hash = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(COPY_BUFFER_SIZE)
+
+            if not data:
+                break
+
+            file_hash.update(data)
+
+    return file_hash.hexdigest()
+
+
+def get_block_digest(block: memoryview) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def get_weak_checksum(block: memoryview) -> Tuple[int, int]:
+    # rsync checksum: a is the sum of the bytes, b the sum of every prefix sum.
+    return (sum(block) & 0xFFFF, sum(itertools.accumulate(block)) & 0xFFFF)
+
+
+def add_patch_operation(
+    operations: List[list], operation: bytes, offset: int, size: int
+):
+    if (
+        operations
+        and operations[-1][0] == operation
+        and (operation == OP_LITERAL or operations[-1][1] + operations[-1][2] == offset)
+    ):
+        operations[-1][2] += size
+    else:
+        operations.append([operation, offset, size])
+
+
+def create_patch(old_data, new_data, output):
+    # Old blocks are indexed by a rolling checksum so that they are found at any offset
+    # in the new file, assemblies are only 16 bytes aligned in some .NET bundles.
+    old_view = memoryview(old_data)
+    new_view = memoryview(new_data)
+    block_size = DELTA_BLOCK_SIZE
+    weak_index = set()
+    block_index: Dict[bytes, int] = {}
+
+    for offset in range(0, len(old_view) - block_size + 1, block_size):
+        block = old_view[offset : offset + block_size]
+        (a, b) = get_weak_checksum(block)
+        weak_index.add(a | (b << 16))
+        block_index.setdefault(get_block_digest(block), offset)
+
+    operations: List[list] = []
+    new_size = len(new_view)
+    literal_offset = 0
+    offset = 0
+
+    if new_size >= block_size:
+        (a, b) = get_weak_checksum(new_view[:block_size])
+
+    while offset + block_size <= new_size:
+        if a | (b << 16) in weak_index:
+            block = new_view[offset : offset + block_size]
+            old_offset = block_index.get(get_block_digest(block))
+
+            if (
+                old_offset is not None
+                and old_view[old_offset : old_offset + block_size] == block
+            ):
+                if literal_offset < offset:
+                    add_patch_operation(
+                        operations, OP_LITERAL, literal_offset, offset - literal_offset
+                    )
+
+                add_patch_operation(operations, OP_COPY, old_offset, block_size)
+                offset += block_size
+                literal_offset = offset
+
+                if offset + block_size <= new_size:
+                    (a, b) = get_weak_checksum(new_view[offset : offset + block_size])
+
+                continue
+
+        # Slide the window by one byte.
+        if offset + block_size < new_size:
+            removed = new_view[offset]
+            a = (a - removed + new_view[offset + block_size]) & 0xFFFF
+            b = (b - block_size * removed + a) & 0xFFFF
+
+        offset += 1
+
+    if literal_offset < new_size:
+        add_patch_operation(
+            operations, OP_LITERAL, literal_offset, new_size - literal_offset
+        )
+
+    output.write(PATCH_MAGIC)
+
+    for operation, offset, size in operations:
+        if operation == OP_COPY:
+            output.write(operation + struct.pack("<QQ", offset, size))
+        else:
+            output.write(operation + struct.pack("<Q", size))
+            output.write(new_view[offset : offset + size])
+
+
+def read_exact(file, size: int) -> bytes:
+    data = file.read(size)
+
+    if len(data) != size:
+        raise Exception("Unexpected end of patch")
+
+    return data
+
+
+def copy_data(source, output, size: int):
+    while size > 0:
+        data = source.read(min(size, COPY_BUFFER_SIZE))
+
+        if not data:
+            raise Exception("Unexpected end of data")
+
+        output.write(data)
+        size -= len(data)
+
+
+def apply_patch(old_file, patch_file, output):
+    if patch_file.read(len(PATCH_MAGIC)) != PATCH_MAGIC:
+        raise Exception("Invalid patch magic")
+
+    old_size = os.fstat(old_file.fileno()).st_size
+
+    while True:
+        operation = patch_file.read(1)
+
+        if not operation:
+            break
+        elif operation == OP_COPY:
+            (old_offset, size) = struct.unpack("<QQ", read_exact(patch_file, 16))
+
+            if old_offset + size > old_size:
+                raise Exception("Patch copies past the end of the old file")
+
+            old_file.seek(old_offset)
+            copy_data(old_file, output, size)
+        elif operation == OP_LITERAL:
+            (size,) = struct.unpack("<Q", read_exact(patch_file, 8))
+            copy_data(patch_file, output, size)
+        else:
+            raise Exception(f"Invalid patch operation {operation}")
+
+
+def scan_tree(root: Path) -> Dict[str, Path]:
+    res = {}
+
+    for directory, directory_names, file_names in os.walk(root):
+        for name in directory_names + file_names:
+            path = Path(directory) / name
+            res[path.relative_to(root).as_posix()] = path
+
+    return res
+
+
+def extract_release(release_path: Path, temp_directory: str) -> Path:
+    if release_path.is_dir():
+        return release_path
+
+    with tarfile.open(release_path, "r:*") as tar:
+        if hasattr(tarfile, "tar_filter"):
+            tar.extractall(temp_directory, filter="tar")
+        else:
+            tar.extractall(temp_directory)
+
+    # Paths are relative to the application itself, not to the archive.
+    entries = os.listdir(temp_directory)
+
+    if len(entries) == 1 and os.path.isdir(os.path.join(temp_directory, entries[0])):
+        return Path(temp_directory) / entries[0]
+
+    return Path(temp_directory)
+
+
+def map_file(file):
+    # mmap refuses empty files.
+    if os.fstat(file.fileno()).st_size == 0:
+        return b""
+
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def diff_entry(
+    relative_path: str, new_path: Path, old_path: Optional[Path]
+) -> Tuple[dict, Optional[IO[bytes]]]:
+    entry = {"path": relative_path}
+
+    if new_path.is_symlink():
+        entry["type"] = "symlink"
+        entry["target"] = os.readlink(new_path)
+
+        return (entry, None)
+
+    entry["mode"] = os.stat(new_path).st_mode & 0o777
+
+    if new_path.is_dir():
+        entry["type"] = "directory"
+
+        return (entry, None)
+
+    with open(new_path, "rb") as file:
+        new_data = map_file(file)
+
+    entry["size"] = len(new_data)
+    entry["sha256"] = hash_data(new_data)
+
+    if old_path is not None and old_path.is_file() and not old_path.is_symlink():
+        with open(old_path, "rb") as file:
+            old_data = map_file(file)
+
+        old_hash = hash_data(old_data)
+
+        if old_hash == entry["sha256"]:
+            entry["type"] = "unchanged"
+
+            return (entry, None)
+
+        # Patches of large files mostly made of literals go to disk.
+        patch = tempfile.SpooledTemporaryFile(PATCH_MEMORY_SIZE)
+        create_patch(old_data, new_data, patch)
+
+        if patch.tell() < len(new_data) * PATCH_MAX_RATIO:
+            entry["type"] = "patch"
+            entry["source_sha256"] = old_hash
+
+            return (entry, patch)
+
+        patch.close()
+
+    entry["type"] = "file"
+
+    return (entry, None)
+
+
+def add_tar_data(tar: tarfile.TarFile, name: str, data: bytes):
+    add_tar_file(tar, name, io.BytesIO(data), len(data))
+
+
+def add_tar_file(tar: tarfile.TarFile, name: str, file: IO[bytes], size: int):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = size
+    tar_info.mode = 0o644
+
+    tar.addfile(tar_info, file)
+
+
+def add_delta_entry(
+    tar: tarfile.TarFile, new_path: Path, entry: dict, patch: Optional[IO[bytes]]
+):
+    if entry["type"] == "patch":
+        with patch:
+            size = patch.tell()
+            patch.seek(0)
+            add_tar_file(tar, f"patches/{entry['path']}", patch, size)
+    elif entry["type"] == "file":
+        tar.add(new_path, f"files/{entry['path']}", recursive=False)
+
+
+def create_delta(old_root: Path, new_root: Path, output_path: str, jobs: int):
+    old_files = scan_tree(old_root)
+    new_files = scan_tree(new_root)
+    entries = []
+
+    # hashlib releases the GIL on large buffers, the files are diffed in parallel.
+    # They are written in path order as they complete, only a few are kept around.
+    with open(output_path, "wb") as output, ThreadPoolExecutor(
+        max_workers=max(1, jobs)
+    ) as executor:
+        with ParallelGzipFile(output, 9, jobs=jobs) as gz:
+            with tarfile.open(fileobj=gz, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                pending = collections.deque()
+
+                for relative_path in sorted(new_files.keys()):
+                    pending.append(
+                        executor.submit(
+                            diff_entry,
+                            relative_path,
+                            new_files[relative_path],
+                            old_files.get(relative_path),
+                        )
+                    )
+
+                    while pending and (
+                        len(pending) > 2 * max(1, jobs) or pending[0].done()
+                    ):
+                        (entry, patch) = pending.popleft().result()
+                        add_delta_entry(tar, new_files[entry["path"]], entry, patch)
+                        entries.append(entry)
+
+                while pending:
+                    (entry, patch) = pending.popleft().result()
+                    add_delta_entry(tar, new_files[entry["path"]], entry, patch)
+                    entries.append(entry)
+
+                # The manifest is only known at the end, it is looked up by name.
+                manifest = {"version": DELTA_VERSION, "files": entries}
+                add_tar_data(tar, MANIFEST_NAME, json.dumps(manifest).encode("utf-8"))
+
+        new_size = sum(entry.get("size", 0) for entry in entries)
+
+        for entry_type in ("unchanged", "patch", "file"):
+            type_entries = [entry for entry in entries if entry["type"] == entry_type]
+            size = sum(entry["size"] for entry in type_entries)
+            print(f"{entry_type:>9}: {len(type_entries)} files, {size} bytes")
+
+        removed_count = len(set(old_files.keys()) - set(new_files.keys()))
+        print(f"  removed: {removed_count} files")
+        print(
+            f"Delta package is {gz.bytes_out} bytes for a {new_size} bytes release "
+            f"({gz.bytes_out / max(new_size, 1):.1%})"
+        )
+
+
+class HashingWriter(object):
+    file: object
+    file_hash: object
+    size: int
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.file_hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.file_hash.update(data)
+        self.size += len(data)
+
+
+def write_verified_file(path: Path, entry: dict, write_data: Callable):
+    with open(path, "wb") as file:
+        output = HashingWriter(file)
+        write_data(output)
+
+    if output.size != entry["size"] or output.file_hash.hexdigest() != entry["sha256"]:
+        raise Exception(f"{entry['path']}: hash mismatch after update")
+
+
+def is_inside(root: Path, path: Path) -> bool:
+    return path == root or root in path.parents
+
+
+def get_entry_path(root: Path, relative_path: str) -> Path:
+    # Delta packages are downloaded, nothing may be written outside of the application.
+    posix_path = PurePosixPath(relative_path)
+
+    if posix_path.is_absolute() or ".." in posix_path.parts or not posix_path.parts:
+        raise Exception(f"Invalid delta entry path {relative_path}")
+
+    path = root.joinpath(*posix_path.parts)
+
+    # The entry itself might be a symlink, only its parent is resolved.
+    if not is_inside(root.resolve(), path.parent.resolve() / path.name):
+        raise Exception(f"Delta entry {relative_path} is outside of {root}")
+
+    return path
+
+
+def check_symlink_target(root: Path, path: Path, target: str):
+    target_path = Path(os.path.normpath(path.parent / target))
+
+    if os.path.isabs(target) or not is_inside(root, target_path):
+        raise Exception(f"Delta symlink {path} points outside of {root}")
+
+
+def apply_delta(old_root: Path, delta_path: str, output_root: Path):
+    # Everything is built and verified next to the output before being swapped in.
+    staging_root = output_root.parent / f".{output_root.name}.partial"
+    backup_root = output_root.parent / f".{output_root.name}.old"
+
+    for path in (staging_root, backup_root):
+        if path.exists():
+            shutil.rmtree(path)
+
+    try:
+        with tarfile.open(delta_path, "r:*") as tar:
+            manifest = json.load(tar.extractfile(MANIFEST_NAME))
+
+            if manifest["version"] != DELTA_VERSION:
+                raise Exception(f"Unsupported delta version {manifest['version']}")
+
+            os.makedirs(staging_root)
+            symlinks = []
+
+            for entry in manifest["files"]:
+                path = get_entry_path(staging_root, entry["path"])
+
+                # Created last so that nothing is written through them.
+                if entry["type"] == "symlink":
+                    check_symlink_target(staging_root, path, entry["target"])
+                    symlinks.append((path, entry["target"]))
+                    continue
+
+                os.makedirs(path.parent, exist_ok=True)
+
+                if entry["type"] == "directory":
+                    os.makedirs(path, exist_ok=True)
+                elif entry["type"] == "unchanged":
+                    old_path = get_entry_path(old_root, entry["path"])
+
+                    with open(old_path, "rb") as file:
+                        write_verified_file(
+                            path,
+                            entry,
+                            lambda output: shutil.copyfileobj(
+                                file, output, COPY_BUFFER_SIZE
+                            ),
+                        )
+                elif entry["type"] == "patch":
+                    old_path = get_entry_path(old_root, entry["path"])
+
+                    if hash_file(old_path) != entry["source_sha256"]:
+                        raise Exception(
+                            f"{entry['path']}: installed file does not match the delta"
+                        )
+
+                    with open(old_path, "rb") as file, tar.extractfile(
+                        f"patches/{entry['path']}"
+                    ) as patch_file:
+                        write_verified_file(
+                            path,
+                            entry,
+                            lambda output: apply_patch(file, patch_file, output),
+                        )
+                elif entry["type"] == "file":
+                    with tar.extractfile(f"files/{entry['path']}") as source:
+                        write_verified_file(
+                            path,
+                            entry,
+                            lambda output: shutil.copyfileobj(
+                                source, output, COPY_BUFFER_SIZE
+                            ),
+                        )
+                else:
+                    raise Exception(f"Unknown delta entry type {entry['type']}")
+
+                os.chmod(path, entry["mode"])
+
+            for path, target in symlinks:
+                os.makedirs(path.parent, exist_ok=True)
+                os.symlink(target, path)
+    except BaseException:
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+        raise
+
+    if output_root.exists():
+        os.rename(output_root, backup_root)
+
+    os.rename(staging_root, output_root)
+
+    if backup_root.exists():
+        shutil.rmtree(backup_root)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.command == "create":
+        with tempfile.TemporaryDirectory() as old_directory:
+            with tempfile.TemporaryDirectory() as new_directory:
+                create_delta(
+                    extract_release(Path(args.old_release), old_directory),
+                    extract_release(Path(args.new_release), new_directory),
+                    args.output_path,
+                    args.jobs,
+                )
+    else:
+        apply_delta(
+            Path(args.old_directory),
+            args.delta_path,
+            Path(args.output_directory).resolve(),
+        )